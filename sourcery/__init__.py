@@ -21,6 +21,8 @@
 
 from . import sourceBrowser
 from . import catalogTools
+from . import columnStore
+from . import queryTools
 from . import specFeatures
 from . import tileDir
 
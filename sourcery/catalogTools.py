@@ -21,6 +21,7 @@
 
 from astLib import *
 from scipy import ndimage
+from scipy.spatial import cKDTree
 import numpy as np
 import operator
 import os
@@ -28,11 +29,60 @@ import urllib3
 import sys
 import time
 import astropy.table as atpy
+import astropy.io.fits as pyfits
 import datetime
+import io
+import gzip
+import base64
+from xml.sax.saxutils import quoteattr
 import IPython
+try:
+    import healpy as hp
+except:
+    hp=None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except:
+    pa=None
+try:
+    from mocpy import MOC
+    import astropy.units as u
+except:
+    MOC=None
 
 #-------------------------------------------------------------------------------------------------------------
 XMATCH_RADIUS_DEG=1.4/60.0  # catalog matching radius, for sim comparisons
+MASK_BAND_ROWS=256          # rows read per section when flagging sources in compressed masks
+FITS_BLOCK_BYTES=2880       # FITS files are made of blocks of this size
+
+# Maps numpy dtype (kind, itemsize) to FITS binary table format code and the big-endian dtype used on disk
+FITS_FORMAT_CODES={'b1': ('L', 'S1'),
+                   'u1': ('B', 'u1'),
+                   'i1': ('I', '>i2'),
+                   'i2': ('I', '>i2'),
+                   'u2': ('J', '>i4'),
+                   'i4': ('J', '>i4'),
+                   'u4': ('K', '>i8'),
+                   'i8': ('K', '>i8'),
+                   'u8': ('K', '>i8'),
+                   'f2': ('E', '>f4'),
+                   'f4': ('E', '>f4'),
+                   'f8': ('D', '>f8')}
+
+# Same, for VOTable BINARY2 serialization
+VOTABLE_DATATYPES={'b1': ('boolean', 'S1'),
+                   'u1': ('unsignedByte', 'u1'),
+                   'i1': ('short', '>i2'),
+                   'i2': ('short', '>i2'),
+                   'u2': ('int', '>i4'),
+                   'i4': ('int', '>i4'),
+                   'u4': ('long', '>i8'),
+                   'i8': ('long', '>i8'),
+                   'u8': ('long', '>i8'),
+                   'f2': ('float', '>f4'),
+                   'f4': ('float', '>f4'),
+                   'f8': ('double', '>f8')}
 
 #-------------------------------------------------------------------------------------------------------------
 def makeRADecString(RADeg, decDeg):
@@ -41,6 +91,199 @@ def makeRADecString(RADeg, decDeg):
     """
     return "%.5f_%.5f" % (RADeg, decDeg)
     
+#-------------------------------------------------------------------------------------------------------------
+def normalizeName(name):
+    """Returns the normalized form of an object name used for name searches: case folded, with all 
+    whitespace removed (so that e.g. 'ACT-CL J0102-4915' and 'act-cl  j0102-4915' are the same).
+    
+    """
+    
+    return "".join(str(name).casefold().split())
+
+#-------------------------------------------------------------------------------------------------------------
+def makeTrigrams(normName):
+    """Returns the sorted list of distinct 3-character substrings of a normalized name (see normalizeName), 
+    used for fuzzy name searches. Names shorter than 3 characters give a single 'trigram' (the name itself).
+    
+    """
+    
+    if len(normName) < 3:
+        return [normName]
+    
+    return sorted(set([normName[i:i+3] for i in range(len(normName)-2)]))
+
+#-------------------------------------------------------------------------------------------------------------
+# MongoDB uses this radius (in metres) for spherical distances on GeoJSON points (e.g., in $geoNear)
+MONGODB_SPHERE_RADIUS_M=6378100.0
+
+#-------------------------------------------------------------------------------------------------------------
+def RADecToGeoJSON(RADeg, decDeg):
+    """Returns a GeoJSON point for the given position, for storing in MongoDB and using with 2dsphere 
+    indexes. GeoJSON longitudes run from -180 to 180 degrees, so RA > 180 maps to RA - 360.
+    
+    """
+    
+    if RADeg > 180:
+        lon=RADeg-360.0
+    else:
+        lon=RADeg
+    
+    return {'type': 'Point', 'coordinates': [float(lon), float(decDeg)]}
+
+#-------------------------------------------------------------------------------------------------------------
+def RADecToUnitVectors(RADeg, decDeg):
+    """Converts arrays of RA, dec. (in degrees) into an array of unit vectors (one row per position).
+    
+    """
+    
+    RARad=np.radians(np.atleast_1d(np.array(RADeg, dtype = np.float64)))
+    decRad=np.radians(np.atleast_1d(np.array(decDeg, dtype = np.float64)))
+    cosDec=np.cos(decRad)
+    
+    return np.array([cosDec*np.cos(RARad), cosDec*np.sin(RARad), np.sin(decRad)]).transpose()
+
+#-------------------------------------------------------------------------------------------------------------
+def angleToChord(angleDeg):
+    """Converts angular separation(s) on the sky (degrees) to the straight-line distance between the 
+    corresponding unit vectors.
+    
+    """
+    
+    return 2.0*np.sin(np.radians(np.minimum(angleDeg, 180.0))/2.0)
+
+#-------------------------------------------------------------------------------------------------------------
+def chordToAngle(chord):
+    """Converts straight-line distance(s) between unit vectors into angular separation(s) in degrees.
+    
+    """
+    
+    return np.degrees(2.0*np.arcsin(np.clip(chord/2.0, 0, 1)))
+
+#-------------------------------------------------------------------------------------------------------------
+class SkyIndex(object):
+    """A KD-tree on the unit vectors of a set of sky positions, for matching many positions against a 
+    catalog at once. Working with unit vectors means there are no problems at RA = 0 or near the poles.
+    A SkyIndex can be pickled, so that it can be kept on disk between runs.
+    
+    """
+    
+    def __init__(self, RADeg, decDeg):
+        self.numObjects=len(RADeg)
+        self.tree=cKDTree(RADecToUnitVectors(RADeg, decDeg))
+        
+
+    def queryRadius(self, RADeg, decDeg, radiusDeg):
+        """Finds all catalog objects within radiusDeg (a number, or an array with one radius per 
+        position) of each of the given positions.
+        
+        Returns:
+            Arrays of position indices, catalog indices, and separations (degrees), sorted by position 
+            index and then separation.
+        
+        """
+        
+        vectors=RADecToUnitVectors(RADeg, decDeg)
+        radiusDeg=np.ones(len(vectors))*radiusDeg
+        if len(vectors) == 0 or self.numObjects == 0:
+            return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0)
+        neighboursList=self.tree.query_ball_point(vectors, angleToChord(radiusDeg.max()))
+        inputIndices=np.repeat(np.arange(len(vectors)), [len(n) for n in neighboursList])
+        catalogIndices=np.array(np.concatenate([np.array(n, dtype = np.int64) for n in neighboursList]), dtype = np.int64)
+        sepDeg=chordToAngle(np.linalg.norm(vectors[inputIndices]-self.tree.data[catalogIndices], axis = 1))
+        keep=np.less_equal(sepDeg, radiusDeg[inputIndices])
+        inputIndices, catalogIndices, sepDeg=inputIndices[keep], catalogIndices[keep], sepDeg[keep]
+        order=np.lexsort((sepDeg, inputIndices))
+        
+        return inputIndices[order], catalogIndices[order], sepDeg[order]
+
+
+    def queryNearest(self, RADeg, decDeg, maxRadiusDeg):
+        """Finds the nearest catalog object to each of the given positions, if there is one within 
+        maxRadiusDeg (a number, or an array with one radius per position).
+        
+        Returns:
+            Arrays of position indices, catalog indices, and separations (degrees) - positions without a
+            match are left out.
+        
+        """
+        
+        vectors=RADecToUnitVectors(RADeg, decDeg)
+        maxRadiusDeg=np.ones(len(vectors))*maxRadiusDeg
+        if len(vectors) == 0 or self.numObjects == 0:
+            return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0)
+        chord, catalogIndices=self.tree.query(vectors, k = 1, distance_upper_bound = angleToChord(maxRadiusDeg.max()))
+        sepDeg=chordToAngle(np.where(np.isinf(chord), 2.0, chord))
+        keep=np.logical_and(np.less(catalogIndices, self.numObjects), np.less_equal(sepDeg, maxRadiusDeg))
+        inputIndices=np.arange(len(vectors))
+        
+        return inputIndices[keep], np.array(catalogIndices[keep], dtype = np.int64), sepDeg[keep]
+
+#-------------------------------------------------------------------------------------------------------------
+def findColumn(tab, candidates):
+    """Returns the name of the first column in the astropy table tab that matches (case insensitive) one of
+    the names in candidates, or None if there isn't one.
+    
+    """
+    
+    lowerNames={}
+    for key in tab.colnames:
+        lowerNames[key.lower()]=key
+    for c in candidates:
+        if c.lower() in lowerNames.keys():
+            return lowerNames[c.lower()]
+    
+    return None
+
+#-------------------------------------------------------------------------------------------------------------
+def readUploadedTable(fileName, data):
+    """Reads an uploaded table (FITS, or any text format astropy can guess - e.g., CSV) into an astropy 
+    table. fileName is only used to tell whether the data are FITS.
+    
+    """
+    
+    if data[:6] == b"SIMPLE" or fileName.lower().split(".gz")[0].endswith((".fits", ".fit", ".fts")):
+        if data[:2] == b"\x1f\x8b":
+            data=gzip.decompress(data)
+        tab=atpy.Table.read(io.BytesIO(data), format = 'fits')
+    else:
+        tab=atpy.Table.read(data.decode('utf-8', errors = 'replace'), format = 'ascii')
+    
+    return tab
+
+#-------------------------------------------------------------------------------------------------------------
+def computeColumnStats(values, numBins = 20):
+    """Computes summary statistics for a catalog column, for storing alongside its entry in fieldTypes. 
+    Sentinel values (-99 or NaN for numbers; blank, 'None' or '-99' for text) are counted, but otherwise
+    left out.
+    
+    Returns a dictionary with keys count and numSentinel, plus (for number columns) min, max, and 
+    histogram (a dictionary with keys edges and counts), or (for text columns) numDistinct. Vector 
+    columns only get count.
+    
+    """
+    
+    values=np.asarray(values)
+    stats={'count': int(len(values))}
+    if values.ndim > 1:
+        return stats
+    if values.dtype.kind in ['U', 'S', 'O']:
+        strValues=np.array(values, dtype = str)
+        sentinelMask=np.isin(strValues, ["", "None", "-99"])
+        stats['numSentinel']=int(sentinelMask.sum())
+        stats['numDistinct']=int(len(np.unique(strValues[~sentinelMask])))
+    else:
+        numValues=np.array(values, dtype = np.float64)
+        sentinelMask=np.logical_or(np.isfinite(numValues) == False, np.equal(numValues, -99))
+        stats['numSentinel']=int(sentinelMask.sum())
+        goodValues=numValues[~sentinelMask]
+        if len(goodValues) > 0:
+            stats['min']=float(goodValues.min())
+            stats['max']=float(goodValues.max())
+            counts, edges=np.histogram(goodValues, bins = numBins)
+            stats['histogram']={'edges': [float(e) for e in edges], 'counts': [int(c) for c in counts]}
+    
+    return stats
+
 #-------------------------------------------------------------------------------------------------------------
 def clipSmoothedTanResampledImage(obj, mapData, mapWCS, sizeDeg, gaussSmoothArcSecRadius, 
                                   outFileName = None, sizePix = 200):
@@ -329,3 +572,478 @@ def fetchSDSSRedshifts(cacheDir, name, RADeg, decDeg, redshiftsTable = None):
     
     return SDSSRedshifts
     
+
+#-------------------------------------------------------------------------------------------------------------
+def isFileCompressed(path):
+    """Returns True if the file at path is gzip, bzip2 or zip compressed, judging by its magic bytes (which
+    is how astropy.io.fits decides whether to decompress it on opening).
+    
+    """
+    
+    with open(path, "rb") as inFile:
+        magic=inFile.read(4)
+    
+    return magic[:2] == b'\x1f\x8b' or magic[:3] == b'BZh' or magic == b'PK\x03\x04'
+
+#-------------------------------------------------------------------------------------------------------------
+def flagInMask(RADeg, decDeg, maskPath):
+    """Returns a boolean array, True where the given coordinates land on a pixel > 0 in the mask image
+    at maskPath. All bounds checks and look-ups are vectorized.
+    
+    Uncompressed masks are memory-mapped, so only the pages containing the needed pixels are read. For
+    tile-compressed (or gzipped) masks, we read only sections covering bands of MASK_BAND_ROWS rows that
+    actually contain sources, rather than decompressing the whole image.
+    
+    """
+    
+    flags=np.zeros(len(RADeg), dtype = bool)
+    with pyfits.open(maskPath, memmap = True) as img:
+        # Avoid touching .data here - that would decompress the whole image. The shape comes from the
+        # header, so len(shape) is the same check as data.ndim without reading any pixels
+        ext=None
+        for hdu in img:
+            if isinstance(hdu, (pyfits.ImageHDU, pyfits.PrimaryHDU, pyfits.CompImageHDU)) and len(hdu.shape) == 2:
+                ext=hdu
+                break
+        if ext is None:
+            raise Exception("No 2D image HDU found in mask %s" % (maskPath))
+        wcs=astWCS.WCS(ext.header, mode = 'pyfits')
+        height, width=ext.shape
+        xy=np.array(wcs.wcs2pix(RADeg, decDeg)).reshape(len(RADeg), 2)
+        xs=np.array(xy[:, 0], dtype = int)
+        ys=np.array(xy[:, 1], dtype = int)
+        inBounds=np.logical_and(np.logical_and(xs >= 0, xs < width), np.logical_and(ys >= 0, ys < height))
+        indices=np.where(inBounds)[0]
+        if len(indices) == 0:
+            return flags
+        compressed=isinstance(ext, pyfits.CompImageHDU) or isFileCompressed(maskPath)
+        if compressed == False:
+            flags[indices]=ext.data[ys[indices], xs[indices]] > 0
+        else:
+            bands=ys[indices]//MASK_BAND_ROWS
+            order=np.argsort(bands, kind = 'stable')
+            indices=indices[order]
+            bands=bands[order]
+            splits=np.where(np.diff(bands) != 0)[0]+1
+            for bandIndices in np.split(indices, splits):
+                yMin, yMax=ys[bandIndices].min(), ys[bandIndices].max()
+                xMin, xMax=xs[bandIndices].min(), xs[bandIndices].max()
+                section=ext.section[yMin:yMax+1, xMin:xMax+1]
+                flags[bandIndices]=section[ys[bandIndices]-yMin, xs[bandIndices]-xMin] > 0
+    
+    return flags
+
+#-------------------------------------------------------------------------------------------------------------
+def flagInHEALPixMap(RADeg, decDeg, mapPath, nest = False):
+    """Returns a boolean array, True where the given coordinates land in a HEALPix pixel > 0 in the map
+    stored at mapPath (the first column of the first binary table HDU, as written by healpy.write_map). 
+    Requires healpy.
+    
+    The map is memory-mapped, and only the pixels containing the given coordinates are read, so high 
+    resolution maps (hundreds of MB at nside 4096) are never loaded whole - unless the file itself is
+    compressed. The pixel ordering is taken from the ORDERING keyword in the map header; nest is only used
+    if that is missing. Partial-sky (explicitly indexed) maps are read with healpy.read_map.
+    
+    """
+    
+    if hp is None:
+        raise Exception("healpy is needed to use HEALPix footprint maps")
+    with pyfits.open(mapPath, memmap = True) as img:
+        ext=None
+        for hdu in img:
+            if isinstance(hdu, pyfits.BinTableHDU):
+                ext=hdu
+                break
+        if ext is None:
+            raise Exception("No binary table HDU found in HEALPix map %s" % (mapPath))
+        if ext.header.get('INDXSCHM', 'IMPLICIT').strip().upper() != 'IMPLICIT':
+            footprintMap=hp.read_map(mapPath, nest = nest, dtype = None, partial = True)
+            pixels=hp.ang2pix(hp.npix2nside(len(footprintMap)), RADeg, decDeg, nest = nest, lonlat = True)
+            return footprintMap[pixels] > 0
+        if 'ORDERING' in ext.header.keys():
+            nest=ext.header['ORDERING'].strip().upper().startswith('NEST')
+        # Maps are often stored as vector columns (e.g., 1024 pixels per row) - pixel p is then at 
+        # row p // repeat, element p % repeat
+        values=ext.data.field(0)
+        if values.ndim == 2:
+            repeat=values.shape[1]
+        else:
+            repeat=1
+        if 'NSIDE' in ext.header.keys():
+            nside=ext.header['NSIDE']
+        else:
+            nside=hp.npix2nside(values.shape[0]*repeat)
+        pixels=np.array(hp.ang2pix(nside, RADeg, decDeg, nest = nest, lonlat = True), dtype = np.int64)
+        if repeat > 1:
+            flags=np.array(values[pixels//repeat, pixels % repeat] > 0, dtype = bool)
+        else:
+            flags=np.array(values[pixels] > 0, dtype = bool)
+    
+    return flags
+
+#-------------------------------------------------------------------------------------------------------------
+def RADecToHEALPixels(RADeg, decDeg, nside):
+    """Returns the HEALPix pixel numbers (NESTED ordering) at resolution nside for the given coordinates.
+    With NESTED ordering, the pixel at resolution nside/2**k containing pixel p is p // 4**k, which is what
+    lets sky maps be made at lower resolutions without recomputing pixels. Requires healpy.
+    
+    """
+    
+    if hp is None:
+        raise Exception("healpy is needed to compute HEALPix pixels")
+    
+    return np.array(hp.ang2pix(nside, np.asarray(RADeg, dtype = np.float64), np.asarray(decDeg, dtype = np.float64), 
+                               nest = True, lonlat = True), dtype = np.int64)
+
+#-------------------------------------------------------------------------------------------------------------
+def flagInMOC(RADeg, decDeg, mocPath):
+    """Returns a boolean array, True where the given coordinates are inside the MOC (Multi-Order
+    Coverage map) stored at mocPath. Requires mocpy.
+    
+    """
+    
+    if MOC is None:
+        raise Exception("mocpy is needed to use MOC footprint files")
+    moc=MOC.from_fits(mocPath)
+    
+    return np.array(moc.contains_lonlat(np.array(RADeg)*u.deg, np.array(decDeg)*u.deg), dtype = bool)
+
+#-------------------------------------------------------------------------------------------------------------
+class StreamSink(object):
+    """Minimal write-only file object, which collects whatever is written to it until drained. This lets
+    us use writers that expect a file (gzip, pyarrow) while streaming their output to the client.
+    
+    """
+    
+    def __init__(self):
+        self.buffers=[]
+        self.position=0
+        self.closed=False
+        
+    def write(self, data):
+        data=bytes(data)
+        self.buffers.append(data)
+        self.position=self.position+len(data)
+        return len(data)
+        
+    def tell(self):
+        return self.position
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed=True
+        
+    def writable(self):
+        return True
+    
+    def seekable(self):
+        return False
+    
+    def readable(self):
+        return False
+    
+    def drain(self):
+        """Returns everything written since the last call, as bytes.
+        
+        """
+        data=b"".join(self.buffers)
+        self.buffers=[]
+        return data
+
+#-------------------------------------------------------------------------------------------------------------
+def streamASCIITable(chunks, format = 'ascii'):
+    """Generator that writes a sequence of astropy tables (chunks of rows, all with the same columns) as
+    a single plain text table, yielding encoded text one chunk at a time. The format can be any astropy 
+    ascii writer with a single header line (e.g., 'ascii', 'ascii.csv').
+    
+    """
+    
+    firstChunk=True
+    for chunk in chunks:
+        buf=io.StringIO()
+        chunk.write(buf, format = format)
+        text=buf.getvalue()
+        if firstChunk == False:
+            text=text.split("\n", 1)[-1] # only the first chunk gets the column names line
+        firstChunk=False
+        yield text.encode('utf-8')
+
+#-------------------------------------------------------------------------------------------------------------
+def streamDS9Regions(chunks, color = "cyan"):
+    """Generator version of tab2DS9, yielding a DS9 region file for a sequence of astropy tables (chunks of
+    rows) one chunk at a time.
+    
+    """
+    
+    header="# DS9 region file\n"
+    header=header+'global dashlist=8 3 width=1 font="helvetica 10 normal" select=1 highlite=1 dash=0 fixed=0 edit=1 move=1 delete=1 include=1 source=1\n'
+    yield header.encode('utf-8')
+    for chunk in chunks:
+        lines=[]
+        for obj in chunk:
+            lines.append("fk5;point(%.6f,%.6f) # point=boxcircle color={%s} text={%s}\n" \
+                         % (obj['RADeg'], obj['decDeg'], color, obj['name']))
+        yield "".join(lines).encode('utf-8')
+
+#-------------------------------------------------------------------------------------------------------------
+def getStringFieldWidth(spec):
+    """Returns the width in bytes of the fixed width field used to write the string column described by
+    spec (see makeFITSColumnFormats), once encoded as UTF-8. This is spec['byteWidth'] (the longest value 
+    in the column, in bytes) if given. Otherwise, it is the size of the dtype - for unicode dtypes that 
+    is 4 bytes per character, the most UTF-8 needs, so nothing can be truncated.
+    
+    """
+    
+    if 'byteWidth' in spec.keys():
+        width=spec['byteWidth']
+    else:
+        width=np.dtype(spec['dtype']).itemsize
+    
+    return max(1, int(width))
+
+#-------------------------------------------------------------------------------------------------------------
+def encodeStringColumn(values, width, name):
+    """Encodes the array of strings values as UTF-8, for writing into a fixed width field of width bytes.
+    Raises an exception if any value doesn't fit, rather than truncating it (possibly part way through a
+    character).
+    
+    """
+    
+    encoded=np.char.encode(values, 'utf-8')
+    if encoded.dtype.itemsize > width:
+        raise Exception("values in column '%s' are longer than its field width (%d bytes) when encoded as UTF-8" % (name, width))
+    
+    return encoded
+
+#-------------------------------------------------------------------------------------------------------------
+def makeFITSColumnFormats(columnSpecs):
+    """Given a list of column specifications (dictionaries with keys name, dtype, and optionally shape 
+    for vector columns), returns lists of FITS binary table TFORM codes, and the big-endian numpy dtypes
+    used to pack each column on disk.
+    
+    String columns are written as UTF-8, with the width given by getStringFieldWidth (so specs for unicode
+    columns should give byteWidth, the length in bytes of the longest encoded value, if it is known).
+    
+    """
+    
+    formats=[]
+    recordDtypes=[]
+    for spec in columnSpecs:
+        dt=np.dtype(spec['dtype'])
+        if 'shape' in spec.keys():
+            shape=tuple(spec['shape'])
+        else:
+            shape=()
+        repeat=int(np.prod(shape))
+        if dt.kind in ['U', 'S']:
+            if shape != ():
+                raise Exception("vector string columns are not supported in FITS download (column '%s')" % (spec['name']))
+            width=getStringFieldWidth(spec)
+            formats.append("%dA" % (width))
+            recordDtypes.append(np.dtype('S%d' % (width)))
+        else:
+            key="%s%d" % (dt.kind, dt.itemsize)
+            if key not in FITS_FORMAT_CODES.keys():
+                raise Exception("column '%s' has a type (%s) that can't be written to FITS" % (spec['name'], dt.str))
+            code, recordDtype=FITS_FORMAT_CODES[key]
+            formats.append("%d%s" % (repeat, code))
+            recordDtypes.append(np.dtype((recordDtype, shape)))
+    
+    return formats, recordDtypes
+
+#-------------------------------------------------------------------------------------------------------------
+def streamFITSTable(chunks, columnSpecs, numRows, tableName = None):
+    """Generator that writes a FITS file containing a binary table, built from a sequence of astropy 
+    tables (chunks of rows), yielding bytes one chunk at a time. Only one chunk of rows is held in 
+    memory at once.
+    
+    Because the FITS header must give the number of rows up front, this must be supplied (numRows). If
+    the chunks turn out to contain more rows than that they are truncated; if fewer, the table is padded
+    with blank rows (this can only happen if the database changes while the download is in progress).
+    
+    Args:
+        chunks (iterable): Astropy tables, each containing the columns given in columnSpecs.
+        columnSpecs (list): Dictionaries with keys name, dtype (and optionally shape), defining the 
+            column types in the output file. Values in each chunk are cast to these types.
+        numRows (int): Total number of rows in the table.
+        tableName (str, optional): If given, written as EXTNAME.
+        
+    """
+    
+    formats, recordDtypes=makeFITSColumnFormats(columnSpecs)
+    recordDtype=np.dtype([('f%d' % (i), recordDtypes[i]) for i in range(len(recordDtypes))])
+
+    header=pyfits.Header()
+    header['XTENSION']='BINTABLE'
+    header['BITPIX']=8
+    header['NAXIS']=2
+    header['NAXIS1']=recordDtype.itemsize
+    header['NAXIS2']=numRows
+    header['PCOUNT']=0
+    header['GCOUNT']=1
+    header['TFIELDS']=len(columnSpecs)
+    for i in range(len(columnSpecs)):
+        header['TTYPE%d' % (i+1)]=columnSpecs[i]['name']
+        header['TFORM%d' % (i+1)]=formats[i]
+    if tableName is not None:
+        header['EXTNAME']=tableName
+    yield pyfits.PrimaryHDU().header.tostring().encode('ascii')
+    yield header.tostring().encode('ascii')
+    
+    rowsWritten=0
+    for chunk in chunks:
+        numChunkRows=min(len(chunk), numRows-rowsWritten)
+        if numChunkRows <= 0:
+            continue
+        records=np.zeros(numChunkRows, dtype = recordDtype)
+        for i in range(len(columnSpecs)):
+            values=np.asarray(chunk[columnSpecs[i]['name']])[:numChunkRows]
+            if formats[i][-1] == 'L':
+                records['f%d' % (i)]=np.where(values, b'T', b'F')
+            elif formats[i][-1] == 'A' and values.dtype.kind == 'U':
+                records['f%d' % (i)]=encodeStringColumn(values, recordDtypes[i].itemsize, columnSpecs[i]['name'])
+            else:
+                records['f%d' % (i)]=values
+        rowsWritten=rowsWritten+numChunkRows
+        yield records.tobytes()
+    if rowsWritten < numRows:
+        yield np.zeros(numRows-rowsWritten, dtype = recordDtype).tobytes()
+    
+    dataBytes=numRows*recordDtype.itemsize
+    if dataBytes % FITS_BLOCK_BYTES != 0:
+        yield bytes(FITS_BLOCK_BYTES-(dataBytes % FITS_BLOCK_BYTES))
+
+#-------------------------------------------------------------------------------------------------------------
+def streamGzip(byteChunks):
+    """Generator that gzip-compresses a stream of bytes (e.g., from streamASCIITable) on the fly.
+    
+    """
+    
+    sink=StreamSink()
+    with gzip.GzipFile(fileobj = sink, mode = 'wb', compresslevel = 6) as gzipFile:
+        for data in byteChunks:
+            gzipFile.write(data)
+            yield sink.drain()
+    yield sink.drain()
+
+#-------------------------------------------------------------------------------------------------------------
+def chunkToArrowBatch(chunk):
+    """Converts an astropy table to a pyarrow RecordBatch, preserving column types.
+    
+    """
+    
+    arrays=[]
+    for key in chunk.keys():
+        values=np.asarray(chunk[key])
+        if values.ndim > 1:
+            arrays.append(pa.array(values.tolist()))
+        else:
+            arrays.append(pa.array(values))
+    
+    return pa.RecordBatch.from_arrays(arrays, names = list(chunk.keys()))
+
+#-------------------------------------------------------------------------------------------------------------
+def streamArrowTable(chunks, fileFormat = 'arrow'):
+    """Generator that writes a sequence of astropy tables (chunks of rows) as an Apache Arrow IPC stream
+    (fileFormat = 'arrow') or as a Parquet file (fileFormat = 'parquet', one row group per chunk), 
+    yielding bytes one chunk at a time. Requires pyarrow.
+    
+    """
+    
+    if pa is None:
+        raise Exception("pyarrow is needed for Arrow/Parquet output")
+    sink=StreamSink()
+    writer=None
+    try:
+        for chunk in chunks:
+            batch=chunkToArrowBatch(chunk)
+            if writer is None:
+                if fileFormat == 'arrow':
+                    writer=pa.ipc.new_stream(sink, batch.schema)
+                elif fileFormat == 'parquet':
+                    writer=pq.ParquetWriter(sink, batch.schema)
+                else:
+                    raise Exception("fileFormat should be 'arrow' or 'parquet'")
+            if fileFormat == 'arrow':
+                writer.write_batch(batch)
+            else:
+                writer.write_table(pa.Table.from_batches([batch]))
+            yield sink.drain()
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.drain()
+
+#-------------------------------------------------------------------------------------------------------------
+def streamVOTable(chunks, columnSpecs, tableName = None):
+    """Generator that writes a VOTable with BINARY2 serialization, built from a sequence of astropy 
+    tables (chunks of rows), yielding bytes one chunk at a time. Column types are fixed by columnSpecs 
+    (see streamFITSTable); strings are written as fixed width char arrays of UTF-8 bytes (see 
+    getStringFieldWidth).
+    
+    """
+    
+    fieldDtypes=[]
+    fieldLines=[]
+    for spec in columnSpecs:
+        dt=np.dtype(spec['dtype'])
+        if 'shape' in spec.keys():
+            shape=tuple(spec['shape'])
+        else:
+            shape=()
+        if dt.kind in ['U', 'S']:
+            if shape != ():
+                raise Exception("vector string columns are not supported in VOTable download (column '%s')" % (spec['name']))
+            width=getStringFieldWidth(spec)
+            fieldLines.append('<FIELD name=%s datatype="char" arraysize="%d"/>' % (quoteattr(spec['name']), width))
+            fieldDtypes.append(np.dtype('S%d' % (width)))
+        else:
+            key="%s%d" % (dt.kind, dt.itemsize)
+            if key not in VOTABLE_DATATYPES.keys():
+                raise Exception("column '%s' has a type (%s) that can't be written to VOTable" % (spec['name'], dt.str))
+            datatype, recordDtype=VOTABLE_DATATYPES[key]
+            if shape != ():
+                fieldLines.append('<FIELD name=%s datatype="%s" arraysize="%s"/>' % (quoteattr(spec['name']), datatype,
+                                                                                  "x".join([str(n) for n in shape[::-1]])))
+            else:
+                fieldLines.append('<FIELD name=%s datatype="%s"/>' % (quoteattr(spec['name']), datatype))
+            fieldDtypes.append(np.dtype((recordDtype, shape)))
+    
+    # Each BINARY2 row starts with a bit mask of null flags (all zero here - we use sentinels, not nulls)
+    numFlagBytes=(len(columnSpecs)+7)//8
+    recordDtype=np.dtype([('nullFlags', 'u1', (numFlagBytes,))]+[('f%d' % (i), fieldDtypes[i]) for i in range(len(fieldDtypes))])
+    
+    if tableName is not None:
+        tableAttr=" name=%s" % (quoteattr(tableName))
+    else:
+        tableAttr=""
+    header='<?xml version="1.0" encoding="utf-8"?>\n'
+    header=header+'<VOTABLE version="1.4" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">\n'
+    header=header+'<RESOURCE type="results">\n<TABLE%s>\n' % (tableAttr)
+    header=header+"\n".join(fieldLines)+"\n"
+    header=header+'<DATA><BINARY2><STREAM encoding="base64">\n'
+    yield header.encode('utf-8')
+    
+    # base64 works in groups of 3 bytes, so carry over any remainder to the next chunk
+    remainder=b""
+    for chunk in chunks:
+        records=np.zeros(len(chunk), dtype = recordDtype)
+        for i in range(len(columnSpecs)):
+            values=np.asarray(chunk[columnSpecs[i]['name']])
+            if fieldDtypes[i].kind == 'S' and values.dtype.kind == 'U':
+                records['f%d' % (i)]=encodeStringColumn(values, fieldDtypes[i].itemsize, columnSpecs[i]['name'])
+            elif fieldDtypes[i].kind == 'S' and values.dtype.kind == 'b':
+                records['f%d' % (i)]=np.where(values, b'T', b'F')
+            else:
+                records['f%d' % (i)]=values
+        data=remainder+records.tobytes()
+        splitIndex=len(data)-(len(data) % 3)
+        remainder=data[splitIndex:]
+        if splitIndex > 0:
+            yield base64.b64encode(data[:splitIndex])+b"\n"
+    if len(remainder) > 0:
+        yield base64.b64encode(remainder)+b"\n"
+    
+    yield '</STREAM></BINARY2></DATA>\n</TABLE>\n</RESOURCE>\n</VOTABLE>\n'.encode('utf-8')
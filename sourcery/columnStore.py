@@ -0,0 +1,257 @@
+"""
+
+    Copyright 2014-2024 Matt Hilton (matt.hilton@mykolab.com)
+
+    This file is part of Sourcery.
+
+    Sourcery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    sourcery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Sourcery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import glob
+import time
+import shutil
+import yaml
+import numpy as np
+import astropy.table as atpy
+
+#-------------------------------------------------------------------------------------------------------------
+# A column store is a directory holding one .npy file per column, plus a small schema file that lists the
+# column names, files and types in order. Columns are memory-mapped when read, so selecting a few columns
+# and/or rows only touches the bytes that are needed. Unlike FITS, there is no limit on the number of columns.
+#
+# Each version of a store is written to its own directory (<storeDir>.v<version>), and storeDir itself is a
+# symbolic link to the current version. Replacing the link is atomic, so readers always see a complete 
+# store. Readers resolve the link once per call (see resolveStoreDir), and the previous version is kept
+# when a new one is written, so reads that are in progress during a swap still complete. Readers that make
+# many calls (e.g., a download read in chunks) should read the schema once and pass it to each call, after
+# mapping the files they need (see mapColumnStore) - mapped files stay readable even if that version of
+# the store is later deleted.
+SCHEMA_FILE_NAME="schema.yml"
+
+#-------------------------------------------------------------------------------------------------------------
+def resolveStoreDir(storeDir):
+    """Returns the path to the directory holding the current version of the column store at storeDir. 
+    Readers should use this once, and then read everything they need from the returned directory, so 
+    that they don't mix up files from different versions if the store is replaced while they read.
+
+    """
+
+    return os.path.realpath(storeDir.rstrip(os.path.sep))
+
+#-------------------------------------------------------------------------------------------------------------
+def writeColumnStore(tab, storeDir, indexColumns = []):
+    """Writes the astropy table tab as a column store at storeDir, replacing any existing store there. 
+    The new version is written to its own directory, and then the storeDir link is atomically switched 
+    to point at it (see the notes at the top of this module). The previous version is kept (for readers 
+    that are part way through reading it); any older versions are deleted.
+
+    For each column named in indexColumns, a lookup index (the column values in sorted order, plus the 
+    corresponding row numbers) is also written, for use by lookupRows.
+
+    """
+
+    storeDir=storeDir.rstrip(os.path.sep)
+    versionDir=storeDir+".v%d.%d" % (time.time_ns(), os.getpid())
+    os.makedirs(versionDir)
+
+    columnsList=[]
+    for i in range(len(tab.columns)):
+        key=tab.columns[i].name
+        col=tab.columns[i]
+        if hasattr(col, 'filled'):
+            col=col.filled()
+        arr=np.asarray(col)
+        if arr.dtype.kind == 'O':
+            arr=np.array(arr, dtype = 'U')
+        fileName="col%05d.npy" % (i)
+        np.save(versionDir+os.path.sep+fileName, arr)
+        columnDict={'name': str(key), 'fileName': fileName, 'dtype': arr.dtype.str, 'shape': list(arr.shape[1:])}
+        if arr.dtype.kind == 'U':
+            # Longest value in bytes when UTF-8 encoded (for writing fixed width byte strings, e.g., FITS)
+            columnDict['byteWidth']=int(np.char.encode(arr, 'utf-8').dtype.itemsize)
+        columnsList.append(columnDict)
+    indexesList=[]
+    for key in indexColumns:
+        values=np.asarray(tab[key])
+        order=np.argsort(values, kind = 'stable')
+        indexFileName="index_%05d.npy" % (tab.colnames.index(key))
+        orderFileName="order_%05d.npy" % (tab.colnames.index(key))
+        np.save(versionDir+os.path.sep+indexFileName, values[order])
+        np.save(versionDir+os.path.sep+orderFileName, np.array(order, dtype = np.int64))
+        indexesList.append({'name': str(key), 'indexFileName': indexFileName, 'orderFileName': orderFileName})
+    schema={'numRows': len(tab), 'columns': columnsList, 'indexes': indexesList}
+    with open(versionDir+os.path.sep+SCHEMA_FILE_NAME, "w") as outFile:
+        yaml.safe_dump(schema, outFile)
+
+    # Stores written before versioning was added are plain directories, which can't be atomically
+    # replaced by a link - these are moved aside first (so, only this first swap leaves a gap)
+    if os.path.isdir(storeDir) == True and os.path.islink(storeDir) == False:
+        os.rename(storeDir, storeDir+".v0.0")
+        previousDir=resolveStoreDir(storeDir+".v0.0")
+    elif os.path.lexists(storeDir) == True:
+        previousDir=resolveStoreDir(storeDir)
+    else:
+        previousDir=None
+    linkPath=storeDir+".link.%d.tmp" % (os.getpid())
+    if os.path.lexists(linkPath) == True:
+        os.remove(linkPath)
+    os.symlink(os.path.basename(versionDir), linkPath)
+    os.replace(linkPath, storeDir)
+
+    for d in glob.glob(glob.escape(storeDir)+".v*"):
+        if os.path.realpath(d) not in [resolveStoreDir(storeDir), previousDir]:
+            shutil.rmtree(d, ignore_errors = True)
+
+#-------------------------------------------------------------------------------------------------------------
+def readSchema(storeDir):
+    """Returns the schema (a dictionary with keys numRows, columns, indexes) of the column store in storeDir.
+    Each entry in columns gives the name, fileName, dtype and (per-row) shape of the column, and for
+    unicode columns, byteWidth (the length of the longest value in bytes, when UTF-8 encoded). The schema 
+    also records the directory of the version it was read from (versionDir; see resolveStoreDir), which
+    readColumn, readColumnStore and lookupRows use when given the schema.
+
+    """
+
+    versionDir=resolveStoreDir(storeDir)
+    schemaPath=versionDir+os.path.sep+SCHEMA_FILE_NAME
+    if os.path.exists(schemaPath) == False:
+        raise Exception("no column store found at %s - you probably need to rebuild the database" % (storeDir))
+    with open(schemaPath, "r") as stream:
+        schema=yaml.safe_load(stream)
+    schema['versionDir']=versionDir
+
+    return schema
+
+#-------------------------------------------------------------------------------------------------------------
+def mapArray(schema, fileName):
+    """Returns the array saved as fileName in the version of the column store described by schema (see 
+    readSchema), as a read-only memory-mapped array. Arrays are kept in the schema once mapped, so later
+    reads using the same schema don't re-open the file.
+
+    """
+
+    if 'arrays' not in schema.keys():
+        schema['arrays']={}
+    if fileName not in schema['arrays'].keys():
+        schema['arrays'][fileName]=np.load(schema['versionDir']+os.path.sep+fileName, mmap_mode = 'r')
+
+    return schema['arrays'][fileName]
+
+#-------------------------------------------------------------------------------------------------------------
+def mapColumnStore(schema, columns = None, indexColumns = []):
+    """Memory-maps the given columns (all columns if None) and the lookup indexes for the columns named in
+    indexColumns, from the version of the column store described by schema (see readSchema). After this,
+    reads that are given the schema keep working even if that version of the store is deleted (when the 
+    store is replaced twice while they are in progress).
+
+    Returns the schema.
+
+    """
+
+    for c in schema['columns']:
+        if columns is None or c['name'] in columns:
+            mapArray(schema, c['fileName'])
+    for i in schema.get('indexes', []):
+        if i['name'] in indexColumns:
+            mapArray(schema, i['indexFileName'])
+            mapArray(schema, i['orderFileName'])
+
+    return schema
+
+#-------------------------------------------------------------------------------------------------------------
+def getColumnNames(storeDir):
+    """Returns the list of column names in the column store in storeDir, in their original order.
+
+    """
+
+    return [c['name'] for c in readSchema(storeDir)['columns']]
+
+#-------------------------------------------------------------------------------------------------------------
+def readColumn(storeDir, name, schema = None):
+    """Returns the named column from the column store in storeDir as a read-only memory-mapped array.
+
+    """
+
+    if schema is None:
+        schema=readSchema(storeDir)
+    for c in schema['columns']:
+        if c['name'] == name:
+            return mapArray(schema, c['fileName'])
+    raise Exception("column '%s' not found in column store %s" % (name, storeDir))
+
+#-------------------------------------------------------------------------------------------------------------
+def readColumnStore(storeDir, columns = None, rows = None, schema = None):
+    """Reads the column store in storeDir, returning an astropy table.
+
+    Args:
+        storeDir (str): Path to the column store directory.
+        columns (list, optional): Names of columns to read (column projection). If None, all columns are
+            read. Columns are returned in store order, not the order given here.
+        rows (:obj:`np.ndarray`, optional): Array of row indices (or a boolean mask) to read. If None, all
+            rows are read.
+        schema (dict, optional): Schema returned by readSchema. If given, columns are read from the 
+            version of the store it describes, rather than the current one.
+
+    Returns:
+        An astropy table.
+
+    """
+
+    if schema is None:
+        schema=readSchema(storeDir)
+    tab=atpy.Table()
+    for c in schema['columns']:
+        if columns is not None and c['name'] not in columns:
+            continue
+        arr=mapArray(schema, c['fileName'])
+        if rows is not None:
+            arr=arr[rows]
+        tab.add_column(atpy.Column(np.array(arr), c['name']))
+
+    return tab
+
+#-------------------------------------------------------------------------------------------------------------
+def lookupRows(storeDir, name, values, schema = None):
+    """Finds the row numbers in the column store in storeDir where column name matches each of the given
+    values, using the lookup index written at build time (see writeColumnStore). This is a vectorized 
+    binary search, so looking up N values in a store of M rows costs O(N log M). If schema (returned by 
+    readSchema) is given, the row numbers are for the version of the store it describes.
+
+    Returns an array of row numbers, with -1 where a value was not found.
+
+    """
+
+    if schema is None:
+        schema=readSchema(storeDir)
+    indexDict=None
+    if 'indexes' in schema.keys():
+        for i in schema['indexes']:
+            if i['name'] == name:
+                indexDict=i
+    if indexDict is None:
+        raise Exception("no lookup index for column '%s' in column store %s - you probably need to rebuild the database" % (name, storeDir))
+    sortedValues=mapArray(schema, indexDict['indexFileName'])
+    order=mapArray(schema, indexDict['orderFileName'])
+    values=np.asarray(values)
+    rows=np.zeros(len(values), dtype = np.int64)-1
+    if len(values) == 0 or len(sortedValues) == 0:
+        return rows
+    positions=np.searchsorted(sortedValues, values)
+    positions[positions == len(sortedValues)]=0
+    found=np.equal(sortedValues[positions], values)
+    rows[found]=order[positions[found]]
+
+    return rows
@@ -0,0 +1,642 @@
+"""
+
+    Copyright 2014-2024 Matt Hilton (matt.hilton@mykolab.com)
+
+    This file is part of Sourcery.
+
+    Sourcery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    sourcery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Sourcery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import re
+import copy
+import base64
+import collections
+import threading
+from bson import json_util
+
+#-------------------------------------------------------------------------------------------------------------
+# Table pages are fetched using keyset (a.k.a. cursor) pagination: rather than skipping N rows (which costs
+# O(N) in MongoDB), we remember the sort key and _id of the last (or first) row shown, and ask for the rows
+# after (or before) that. Every page then costs the same, however deep into the table we are.
+#
+# Page tokens are opaque strings handed to the web page / session. They hold a small dictionary, with one of:
+#   {'after': [sortValue, _id]}     - rows after the given row
+#   {'before': [sortValue, _id]}    - rows before the given row
+#   {'offset': n}                   - rows starting at n (for materialized results, where offsets are cheap)
+# plus the sortKey, so that tokens from a table sorted on a different column can be rejected.
+
+#-------------------------------------------------------------------------------------------------------------
+def encodePageToken(tokenDict):
+    """Encodes the given page token dictionary as an opaque, URL-safe string.
+
+    """
+
+    return base64.urlsafe_b64encode(json_util.dumps(tokenDict).encode('utf-8')).decode('ascii')
+
+#-------------------------------------------------------------------------------------------------------------
+def decodePageToken(token):
+    """Decodes a page token made by encodePageToken. Returns None if the token is None or blank, and raises
+    an exception if the token is not valid.
+
+    """
+
+    if token is None or token == "":
+        return None
+    try:
+        tokenDict=json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except:
+        raise Exception("invalid page token")
+    if type(tokenDict) != dict or len(set(['after', 'before', 'offset']).intersection(tokenDict.keys())) != 1:
+        raise Exception("invalid page token")
+
+    return tokenDict
+
+#-------------------------------------------------------------------------------------------------------------
+def makeRowPageToken(post, sortKey, position, sortDirection = 1):
+    """Returns a page token (see encodePageToken) for the rows after (position = 'after') or before
+    (position = 'before') the given post, in a table sorted on sortKey (in sortDirection) then _id.
+
+    """
+
+    return encodePageToken({position: [post.get(sortKey), post['_id']], 'sortKey': sortKey, 
+                            'sortDirection': sortDirection})
+
+#-------------------------------------------------------------------------------------------------------------
+def makeKeysetQuery(queryDict, sortKey, sortDirection, tokenDict):
+    """Adds a keyset constraint to the MongoDB query queryDict, so that it returns only rows after (or
+    before) the row given in tokenDict, for a table sorted on (sortKey, _id).
+
+    Args:
+        queryDict (dict): MongoDB query.
+        sortKey (str): Name of the field the table is sorted on.
+        sortDirection (int): pymongo.ASCENDING (1) or pymongo.DESCENDING (-1).
+        tokenDict (dict): Decoded page token (see decodePageToken), with key 'after' or 'before'.
+
+    Returns:
+        MongoDB query (dict), and the sort specification (list) to use with it. For 'before' tokens, the sort
+        is reversed (so that limit() picks the rows nearest the token) - the caller should reverse the rows
+        that come back.
+
+    Rows where sortKey is missing (or null) sort before all others, as in MongoDB. Comparisons in MongoDB
+    only match values of the same type, so these need handling separately.
+
+    """
+
+    if 'after' in tokenDict.keys():
+        sortValue, lastID=tokenDict['after']
+        direction=sortDirection
+    elif 'before' in tokenDict.keys():
+        sortValue, lastID=tokenDict['before']
+        direction=-sortDirection
+    else:
+        raise Exception("page token must contain 'after' or 'before' for keyset queries")
+    if direction == 1:
+        op="$gt"
+    else:
+        op="$lt"
+    if sortValue is None:
+        if direction == 1:
+            keysetDict={'$or': [{sortKey: {'$ne': None}}, {sortKey: None, '_id': {op: lastID}}]}
+        else:
+            keysetDict={sortKey: None, '_id': {op: lastID}}
+    else:
+        keysetList=[{sortKey: {op: sortValue}}, {sortKey: sortValue, '_id': {op: lastID}}]
+        if direction == -1:
+            keysetList.append({sortKey: None})
+        keysetDict={'$or': keysetList}
+    if len(queryDict) == 0:
+        keysetQuery=keysetDict
+    else:
+        keysetQuery={'$and': [queryDict, keysetDict]}
+
+    return keysetQuery, [(sortKey, direction), ('_id', direction)]
+
+#-------------------------------------------------------------------------------------------------------------
+# Constraints language - e.g., "z > 0.5 and (classification = 'cluster' or SNR >= 5)"
+# Comparison operators are <, >, <=, >=, =, !=; logical operators are 'and', 'or' ('and' binds more tightly),
+# and parentheses can be used for grouping. Strings can be quoted with ' or ", and '*' is a wildcard in text
+# comparisons using = or !=.
+#
+# Within each group of constraints joined by 'and', several '=' (or '!=') constraints on the same column are
+# merged into one $in (or $nin) - i.e., 'and' acts like a delimiter there (this is documented on the
+# constraints help page, and people's saved queries rely on it).
+
+COMPARISON_OPS={'<': '$lt', '>': '$gt', '<=': '$lte', '>=': '$gte', '=': '$in', '!=': '$nin'}
+LOGICAL_OPS=['and', 'or']
+COMPILED_CACHE_SIZE=1024   # most compiled constraints kept (see compileConstraints)
+TOKEN_REGEX=re.compile(r"""\s*(?:(?P<string>'[^']*'|"[^"]*")|(?P<op><=|>=|!=|<|>|=)|(?P<paren>[()])|(?P<word>[^\s()<>=!'"]+))""")
+
+#-------------------------------------------------------------------------------------------------------------
+def tokenizeConstraints(constraints):
+    """Splits a constraints string into a list of (kind, text) tokens, where kind is one of 'string',
+    'op', 'paren', 'word'. Raises an exception if there is anything that can't be understood.
+
+    """
+
+    tokens=[]
+    pos=0
+    constraints=constraints.rstrip()
+    while pos < len(constraints):
+        match=TOKEN_REGEX.match(constraints, pos)
+        if match is None:
+            raise Exception("could not understand constraints near '%s'" % (constraints[pos:].strip()[:20]))
+        kind=match.lastgroup
+        text=match.group(kind)
+        if kind == 'string':
+            text=text[1:-1]
+        tokens.append((kind, text))
+        pos=match.end()
+
+    return tokens
+
+#-------------------------------------------------------------------------------------------------------------
+class ConstraintsParser(object):
+    """Recursive descent parser for the constraints language. Turns a list of tokens (from
+    tokenizeConstraints) into a tree of tuples:
+
+        ('or', [children]), ('and', [children]), ('cmp', columnName, operator, value)
+
+    """
+
+    def __init__(self, tokens):
+        self.tokens=tokens
+        self.pos=0
+
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+
+    def isKeyword(self, token, keyword):
+        return token[0] == 'word' and token[1] == keyword
+
+
+    def parse(self):
+        if len(self.tokens) == 0:
+            return None
+        tree=self.parseOr()
+        if self.pos != len(self.tokens):
+            raise Exception("unexpected '%s' in constraints" % (self.peek()[1]))
+        return tree
+
+
+    def parseOr(self):
+        children=[self.parseAnd()]
+        while self.isKeyword(self.peek(), 'or'):
+            self.pos=self.pos+1
+            children.append(self.parseAnd())
+        if len(children) == 1:
+            return children[0]
+        return ('or', children)
+
+
+    def parseAnd(self):
+        children=[self.parseAtom()]
+        while self.isKeyword(self.peek(), 'and'):
+            self.pos=self.pos+1
+            children.append(self.parseAtom())
+        if len(children) == 1:
+            return children[0]
+        return ('and', children)
+
+
+    def parseAtom(self):
+        kind, text=self.peek()
+        if kind == 'paren' and text == '(':
+            self.pos=self.pos+1
+            tree=self.parseOr()
+            if self.peek() != ('paren', ')'):
+                raise Exception("missing ')' in constraints")
+            self.pos=self.pos+1
+            return tree
+        if kind != 'word' or text in LOGICAL_OPS:
+            if kind is None:
+                raise Exception("constraints end unexpectedly")
+            raise Exception("expected a column name in constraints, found '%s'" % (text))
+        columnName=text
+        self.pos=self.pos+1
+        kind, op=self.peek()
+        if kind != 'op':
+            raise Exception("expected one of %s after '%s' in constraints" % (", ".join(COMPARISON_OPS.keys()), columnName))
+        self.pos=self.pos+1
+        # Values are either quoted, or run up to the next and/or/parenthesis (so can contain spaces)
+        kind, text=self.peek()
+        if kind == 'string':
+            self.pos=self.pos+1
+            return ('cmp', columnName, op, text)
+        words=[]
+        while kind == 'word' and text not in LOGICAL_OPS:
+            words.append(text)
+            self.pos=self.pos+1
+            kind, text=self.peek()
+        if len(words) == 0:
+            raise Exception("missing value after '%s %s' in constraints" % (columnName, op))
+        return ('cmp', columnName, op, " ".join(words))
+
+#-------------------------------------------------------------------------------------------------------------
+def makeWildcardRegex(value):
+    """Converts a text value containing '*' wildcards into a compiled regular expression. Values with a
+    single trailing wildcard (e.g., 'ACT-CL J01*') become anchored, case-sensitive prefix matches, which
+    MongoDB can answer using an index. Anything else (e.g., '*high-z*') is case insensitive, as before.
+
+    """
+
+    if value.rstrip('*').find('*') == -1:
+        return re.compile("^"+re.escape(value.rstrip('*')))
+    regexStr=".*".join([re.escape(bit) for bit in value.split('*')])
+    if value[0] != '*':
+        regexStr="^"+regexStr
+
+    return re.compile(regexStr, re.IGNORECASE)
+
+#-------------------------------------------------------------------------------------------------------------
+def convertConstraintValue(columnName, op, value, fieldTypes):
+    """Converts a value from the constraints string into the type needed for the query on the given
+    column (float for 'number' columns, str - or a regular expression, for wildcards - for 'text' columns).
+
+    """
+
+    if fieldTypes[columnName] == 'number':
+        try:
+            return float(value)
+        except:
+            raise Exception("value '%s' for column '%s' should be a number" % (value, columnName))
+    if op in ['=', '!='] and '*' in value:
+        return makeWildcardRegex(value)
+
+    return value
+
+#-------------------------------------------------------------------------------------------------------------
+def simplifyOperators(opDict):
+    """Returns the smallest MongoDB expression equivalent to the operator dictionary opDict (e.g., a single
+    $in becomes a plain equality, so that it can use an index).
+
+    """
+
+    opDict=dict(opDict)
+    if '$in' in opDict.keys() and len(opDict['$in']) == 1:
+        value=opDict['$in'][0]
+        if len(opDict) == 1:
+            return value
+        if type(value) != re.Pattern:
+            del opDict['$in']
+            opDict['$eq']=value
+    if '$nin' in opDict.keys() and len(opDict['$nin']) == 1:
+        value=opDict['$nin'][0]
+        del opDict['$nin']
+        if type(value) == re.Pattern:
+            opDict['$not']=value
+        else:
+            opDict['$ne']=value
+
+    return opDict
+
+#-------------------------------------------------------------------------------------------------------------
+def combineQueries(queryList):
+    """Combines a list of MongoDB queries, so that all of them must be satisfied. Queries on different
+    fields are merged into a single document (best for index selection), otherwise $and is used.
+
+    """
+
+    queryList=[q for q in queryList if q is not None and len(q) > 0]
+    if len(queryList) == 0:
+        return {}
+    if len(queryList) == 1:
+        return queryList[0]
+    mergedDict={}
+    for q in queryList:
+        if len(set(q.keys()).intersection(mergedDict.keys())) > 0:
+            return {'$and': queryList}
+        mergedDict.update(q)
+
+    return mergedDict
+
+#-------------------------------------------------------------------------------------------------------------
+def compileConstraintsTree(tree, fieldTypes):
+    """Compiles a tree from ConstraintsParser into a MongoDB query.
+
+    """
+
+    if tree[0] == 'cmp':
+        tree=('and', [tree])
+    if tree[0] == 'or':
+        children=[]
+        for child in tree[1]:
+            compiled=compileConstraintsTree(child, fieldTypes)
+            if list(compiled.keys()) == ['$or']:
+                children=children+compiled['$or']
+            else:
+                children.append(compiled)
+        return {'$or': children}
+
+    # 'and': comparisons are merged per column (see note above), anything else is added with $and
+    opDictsList=[{}]
+    subQueries=[]
+    for child in tree[1]:
+        if child[0] != 'cmp':
+            subQueries.append(compileConstraintsTree(child, fieldTypes))
+            continue
+        cmpType, columnName, op, value=child
+        if columnName not in fieldTypes.keys():
+            raise Exception("unknown column '%s' in constraints - see the constraints help page for the list of columns" % (columnName))
+        value=convertConstraintValue(columnName, op, value, fieldTypes)
+        mongoOp=COMPARISON_OPS[op]
+        for opDicts in opDictsList:
+            if columnName not in opDicts.keys():
+                opDicts[columnName]={}
+            if mongoOp in ['$in', '$nin']:
+                if mongoOp not in opDicts[columnName].keys():
+                    opDicts[columnName][mongoOp]=[]
+                opDicts[columnName][mongoOp].append(value)
+                break
+            elif mongoOp not in opDicts[columnName].keys():
+                opDicts[columnName][mongoOp]=value
+                break
+        else:
+            # e.g., 'z > 0.1 and z > 0.2' - keep both
+            opDictsList.append({columnName: {mongoOp: value}})
+    queryList=[]
+    for opDicts in opDictsList:
+        queryDict={}
+        for columnName in opDicts.keys():
+            queryDict[columnName]=simplifyOperators(opDicts[columnName])
+        queryList.append(queryDict)
+
+    return combineQueries(queryList+subQueries)
+
+#-------------------------------------------------------------------------------------------------------------
+compiledCache=collections.OrderedDict()
+compiledCacheLock=threading.Lock()
+
+def compileConstraints(constraints, fieldTypes, fieldTypesKey = None):
+    """Compiles a constraints string (see the note on the constraints language above) into a MongoDB query.
+    Column names are checked against fieldTypes (a dictionary mapping column names to 'number' or 'text'),
+    and values are converted to the matching type, so that bad queries fail here rather than running.
+
+    Compiled queries are cached, so repeated queries (e.g., paging through a table) are not re-parsed. The
+    cache is keyed on the constraints and fieldTypesKey, which should be a hashable value that changes 
+    whenever fieldTypes does (e.g., the schema generation). If fieldTypesKey is not given, one is made from
+    fieldTypes, which costs time proportional to the number of columns.
+
+    Raises an exception (with a message that can be shown to the user) if the constraints are not valid.
+
+    """
+
+    constraints=constraints.replace("\n", " ").strip()
+    if fieldTypesKey is None:
+        fieldTypesKey=tuple(sorted(fieldTypes.items()))
+    cacheKey=(constraints, fieldTypesKey)
+    with compiledCacheLock:
+        compiled=compiledCache.get(cacheKey)
+        if compiled is not None:
+            compiledCache.move_to_end(cacheKey)
+    if compiled is None:
+        tree=ConstraintsParser(tokenizeConstraints(constraints)).parse()
+        if tree is None:
+            compiled={}
+        else:
+            compiled=compileConstraintsTree(tree, fieldTypes)
+        with compiledCacheLock:
+            compiledCache[cacheKey]=compiled
+            while len(compiledCache) > COMPILED_CACHE_SIZE:
+                compiledCache.popitem(last = False)
+
+    # Callers may modify the query, and the cached copy is shared
+    return copy.deepcopy(compiled)
+
+#-------------------------------------------------------------------------------------------------------------
+def getConstraintsColumns(constraints):
+    """Returns the list of column names used in a constraints string, in the order they appear. Returns an
+    empty list if the constraints can't be parsed.
+
+    """
+
+    try:
+        tree=ConstraintsParser(tokenizeConstraints(constraints.replace("\n", " "))).parse()
+    except:
+        return []
+    columnsList=[]
+    toVisit=[tree]
+    while len(toVisit) > 0:
+        node=toVisit.pop(0)
+        if node is None:
+            continue
+        if node[0] == 'cmp':
+            if node[1] not in columnsList:
+                columnsList.append(node[1])
+        else:
+            toVisit=node[1]+toVisit
+
+    return columnsList
+
+#-------------------------------------------------------------------------------------------------------------
+def estimateSelectivity(condition, stats):
+    """Estimates the fraction of rows that match a MongoDB condition on a single column (e.g., 
+    {'$gte': 0.3, '$lt': 1}, or a plain value for equality), using the column statistics made when the
+    database was built (see catalogTools.computeColumnStats). Returns None if no estimate can be made
+    (e.g., for regular expressions).
+
+    """
+
+    count=stats.get('count', 0)
+    if count == 0:
+        return None
+    if type(condition) != dict:
+        condition={'$eq': condition}
+    numSentinel=stats.get('numSentinel', 0)
+
+    if 'numDistinct' in stats.keys():
+        fraction=None
+        for op, value in condition.items():
+            if op == '$eq' and type(value) == str:
+                opFraction=1.0/max(stats['numDistinct'], 1)
+            elif op == '$in' and type(value) == list:
+                opFraction=min(len(value)/max(stats['numDistinct'], 1), 1.0)
+            else:
+                continue
+            if fraction is None or opFraction < fraction:
+                fraction=opFraction
+        if fraction is None:
+            return None
+        return fraction*(count-numSentinel)/count
+
+    if 'histogram' not in stats.keys():
+        return None
+    if '$in' in condition.keys():
+        if type(condition['$in']) != list or len(condition) != 1:
+            return None
+        fractions=[estimateSelectivity(v, stats) for v in condition['$in']]
+        if None in fractions:
+            return None
+        return min(sum(fractions), 1.0)
+    conditionLow=float('-inf')
+    conditionHigh=float('inf')
+    for op, value in condition.items():
+        if type(value) not in [int, float]:
+            return None
+        if op in ['$gt', '$gte']:
+            conditionLow=max(conditionLow, value)
+        elif op in ['$lt', '$lte']:
+            conditionHigh=min(conditionHigh, value)
+        elif op == '$eq':
+            conditionLow=max(conditionLow, value)
+            conditionHigh=min(conditionHigh, value)
+        else:
+            return None
+    low=max(stats['min'], conditionLow)
+    high=min(stats['max'], conditionHigh)
+    matched=0.0
+    if low <= high:
+        edges=stats['histogram']['edges']
+        counts=stats['histogram']['counts']
+        for i in range(len(counts)):
+            binLow, binHigh=edges[i], edges[i+1]
+            if binHigh < low or binLow > high:
+                continue
+            if binHigh > binLow:
+                overlap=(min(binHigh, high)-max(binLow, low))/(binHigh-binLow)
+            else:
+                overlap=1.0
+            if conditionLow == conditionHigh:
+                overlap=1.0/max(counts[i], 1) # equality: assume one object
+            matched=matched+counts[i]*overlap
+    # Sentinels are stored as -99 (or NaN, which never matches)
+    if numSentinel > 0 and conditionLow <= -99 <= conditionHigh:
+        matched=matched+numSentinel
+
+    return min(matched/count, 1.0)
+
+#-------------------------------------------------------------------------------------------------------------
+# Databases can optionally be built with sparse storage of cross match columns (sparseCrossMatchStorage in
+# the config file), where sentinel values (-99, or blank strings) are left out of the MongoDB documents.
+# Queries are rewritten (see restoreSparseSentinels), so that they give the same results as if the
+# sentinels were stored: e.g., 'RM_z < 0' also matches documents without RM_z.
+
+#-------------------------------------------------------------------------------------------------------------
+def valueMatchesCondition(value, condition):
+    """Returns True if the value (None for a missing field) satisfies the given single-column MongoDB 
+    condition (as made by compileConstraints), following MongoDB's rules. Returns None if the condition
+    uses an operator that isn't handled here.
+
+    """
+
+    if type(condition) != dict:
+        condition={'$eq': condition}
+    for op, target in condition.items():
+        if op == '$eq':
+            matches=matchesValue(value, target)
+        elif op == '$ne':
+            matches=not matchesValue(value, target)
+        elif op == '$in':
+            matches=any([matchesValue(value, t) for t in target])
+        elif op == '$nin':
+            matches=not any([matchesValue(value, t) for t in target])
+        elif op == '$not':
+            notMatches=valueMatchesCondition(value, target)
+            if notMatches is None:
+                return None
+            matches=not notMatches
+        elif op in ['$gt', '$gte', '$lt', '$lte']:
+            if value is None or type(value) == str or type(target) == str:
+                if type(value) != type(target):
+                    return False
+            if op == '$gt':
+                matches=value > target
+            elif op == '$gte':
+                matches=value >= target
+            elif op == '$lt':
+                matches=value < target
+            else:
+                matches=value <= target
+        elif op == '$exists':
+            matches=(value is not None) == bool(target)
+        else:
+            return None
+        if matches == False:
+            return False
+
+    return True
+
+#-------------------------------------------------------------------------------------------------------------
+def matchesValue(value, target):
+    """Returns True if value equals target (which may be a compiled regular expression).
+
+    """
+
+    if type(target) == re.Pattern:
+        return type(value) == str and target.search(value) is not None
+
+    return value == target
+
+#-------------------------------------------------------------------------------------------------------------
+def restoreSparseSentinels(queryDict, sentinels):
+    """Rewrites a MongoDB query for a database where sentinel values are not stored (sentinels is a 
+    dictionary mapping column names to their sentinel values), so that documents without a column are 
+    treated as if they held the sentinel value.
+
+    """
+
+    outDict={}
+    extraQueries=[]
+    for key, condition in queryDict.items():
+        if key in ['$and', '$or', '$nor']:
+            outDict[key]=[restoreSparseSentinels(q, sentinels) for q in condition]
+            continue
+        if key not in sentinels.keys():
+            outDict[key]=condition
+            continue
+        sentinelMatches=valueMatchesCondition(sentinels[key], condition)
+        missingMatches=valueMatchesCondition(None, condition)
+        if sentinelMatches is None or missingMatches is None or sentinelMatches == missingMatches:
+            outDict[key]=condition
+        elif sentinelMatches == True:
+            extraQueries.append({'$or': [{key: condition}, {key: {'$exists': False}}]})
+        else:
+            if type(condition) == dict and '$exists' not in condition.keys():
+                condition=dict(condition)
+                condition['$exists']=True
+                outDict[key]=condition
+            else:
+                extraQueries.append({'$and': [{key: condition}, {key: {'$exists': True}}]})
+
+    return combineQueries([outDict]+extraQueries)
+
+#-------------------------------------------------------------------------------------------------------------
+def getPlanScans(explainDict):
+    """Returns a list of the scans in the winning plan of the output of a MongoDB explain command (run with
+    verbosity 'queryPlanner'), as (stage, keyPattern) tuples, where stage is 'COLLSCAN' or 'IXSCAN' and
+    keyPattern is the index key pattern (a dictionary) for index scans, or None for collection scans.
+
+    """
+
+    plan=explainDict['queryPlanner']['winningPlan']
+    if 'queryPlan' in plan.keys():
+        plan=plan['queryPlan'] # Slot-based execution engine (MongoDB 5.1+)
+    scans=[]
+    stagesToCheck=[plan]
+    while len(stagesToCheck) > 0:
+        stage=stagesToCheck.pop()
+        if stage.get('stage') == 'COLLSCAN':
+            scans.append(('COLLSCAN', None))
+        elif stage.get('stage') == 'IXSCAN':
+            scans.append(('IXSCAN', stage.get('keyPattern', {})))
+        if 'inputStage' in stage.keys():
+            stagesToCheck.append(stage['inputStage'])
+        if 'inputStages' in stage.keys():
+            stagesToCheck=stagesToCheck+list(stage['inputStages'])
+
+    return scans
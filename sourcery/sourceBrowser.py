@@ -42,6 +42,8 @@ import matplotlib.patches as patches
 from scipy import ndimage
 import sourcery
 from sourcery import catalogTools
+from sourcery import columnStore
+from sourcery import queryTools
 #from sourcery import specFeatures
 #import ConfigParser
 import yaml
@@ -49,24 +51,26 @@ import requests
 import sys
 import time
 import datetime
-import string
 import re
 import base64
 from PIL import Image
 import io
 Image.MAX_IMAGE_PIXELS=100000001 
 import copy
+import functools
+import threading
+from html import escape as html_escape
+import collections
 from io import BytesIO
-from tempfile import TemporaryDirectory
 import tempfile
 import pymongo
 from bson.son import SON
+from bson import json_util
 import pyximport; pyximport.install()
 #import sourceryCython
 import cherrypy
 import pickle
 #import pyvips
-import IPython
 from sourcery import sourceryAuth
 from sourcery import tileDir
 from passlib.hash import pbkdf2_sha256
@@ -75,6 +79,38 @@ import logging
 # Logging
 logger=logging.getLogger('sourcery')
 
+# Catalog download formats: fileFormat -> description (shown on the index page) and HTTP Content-Type
+DOWNLOAD_FORMATS={'cat': {'description': "plain text", 'contentType': 'text/plain'},
+                  'csv.gz': {'description': "gzip-compressed CSV", 'contentType': 'application/gzip'},
+                  'fits': {'description': "FITS table format; all columns", 'contentType': 'application/fits'},
+                  'vot': {'description': "VOTable, BINARY2 serialization", 'contentType': 'application/x-votable+xml'},
+                  'arrow': {'description': "Apache Arrow IPC stream", 'contentType': 'application/vnd.apache.arrow.stream'},
+                  'parquet': {'description': "Apache Parquet", 'contentType': 'application/vnd.apache.parquet'},
+                  'reg': {'description': "DS9 region file", 'contentType': 'text/plain'}}
+
+# Least width allowed for non-string values in text fields in downloads (see getTextFieldWidths) - enough for
+# str() of any number or date
+NON_STRING_TEXT_WIDTH=32
+
+#-------------------------------------------------------------------------------------------------------------
+def queryTimeLimit(budget):
+    """A decorator for request handlers that run database queries. Sets the time budget (one of the keys 
+    of SourceBrowser.queryTimeLimitsMS) for queries made while handling the request (see 
+    getQueryTimeLimitMS), and turns queries that run over it into a clear error (HTTP 503), rather than an
+    internal server error. This should go below cherrypy.expose etc. (i.e., be applied first).
+    
+    """
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            cherrypy.request.queryTimeBudget=budget
+            try:
+                return f(self, *args, **kwargs)
+            except pymongo.errors.ExecutionTimeout:
+                raise cherrypy.HTTPError(503, self.getQueryTimeoutMessage())
+        return wrapper
+    return decorate
+
 #-------------------------------------------------------------------------------------------------------------
 def makeDegreesDistanceMap(degreesMap, wcs, RADeg, decDeg, maxDistDegrees):
     """Fills (in place) the 2d array degreesMap with distance in degrees from the given position,
@@ -154,6 +190,10 @@ class SourceBrowser(object):
                     raise Exception("unknown user role - check user list file %s" % (self.configDict['userListFile']))
         else:
             self.usersDict={}
+        self.userPolicies={}
+        for userName in self.usersDict.keys():
+            self.userPolicies[userName]=self.makeUserPolicy(self.usersDict[userName])
+        self.defaultUserPolicy=self.makeUserPolicy({})
         
         # Displayed when failed login
         if 'contactInfo' in self.configDict.keys():
@@ -234,6 +274,9 @@ class SourceBrowser(object):
         else:
             self.specRedshiftsTab=None
         
+        # Column store holding the cross-matched catalog (written by buildDatabase, read by downloadCatalog)
+        self.xMatchedTabDir=self.cacheDir+os.path.sep+"%s_xMatchedTable" % (self.configDict['catalogDownloadFileName'])
+
         # So we can display a status message on the index page in other processes if the database or cache is being rebuilt
         self.dbLockFileName=self.cacheDir+os.path.sep+"db.lock"
         self.cacheLockFileName=self.cacheDir+os.path.sep+"cache.lock"
@@ -241,6 +284,93 @@ class SourceBrowser(object):
         # Add descriptions of field (displayed on help page only)
         self.descriptionsDict=self.parseColumnDescriptionsFile()
 
+        # Table view sort order (ties are broken using _id, for keyset pagination - see fetchTablePage)
+        # Users can sort on any of the sortableColumns instead - these all get indexes (see getDeclaredIndexes)
+        self.tableSortKey='RADeg'
+        self.tableSortDirection=pymongo.ASCENDING
+        self.sortableColumns=['RADeg', 'decDeg', 'name']
+        if 'sortableColumns' in self.configDict.keys():
+            for key in self.configDict['sortableColumns']:
+                if key not in self.sortableColumns:
+                    self.sortableColumns.append(key)
+
+        # Downloads are streamed in chunks of this many rows
+        if 'downloadChunkRows' in self.configDict.keys():
+            self.downloadChunkRows=self.configDict['downloadChunkRows']
+        else:
+            self.downloadChunkRows=5000
+        
+        # Batch position searches (see batchSearch) - sky index is made when first needed
+        if 'batchSearchMaxPositions' in self.configDict.keys():
+            self.batchSearchMaxPositions=self.configDict['batchSearchMaxPositions']
+        else:
+            self.batchSearchMaxPositions=10000
+        if 'crossMatchUploadMaxRows' in self.configDict.keys():
+            self.crossMatchUploadMaxRows=self.configDict['crossMatchUploadMaxRows']
+        else:
+            self.crossMatchUploadMaxRows=100000
+        self.skyIndex=None
+        self.skyIndexLock=threading.Lock()
+        
+        # Sky density maps (see skyDensityMap): HEALPix resolution of the healpixPixel field (needs healpy)
+        if 'skyMapNside' in self.configDict.keys():
+            self.skyMapNside=self.configDict['skyMapNside']
+        else:
+            self.skyMapNside=64
+        
+        # Fuzzy name searches (see findNameMatches): the number of (rarest) trigrams used to find candidates,
+        # and the minimum fraction of the query name's trigrams that a match must share
+        if 'nameSearchMaxTrigrams' in self.configDict.keys():
+            self.nameSearchMaxTrigrams=self.configDict['nameSearchMaxTrigrams']
+        else:
+            self.nameSearchMaxTrigrams=6
+        if 'nameSearchMinSimilarity' in self.configDict.keys():
+            self.nameSearchMinSimilarity=self.configDict['nameSearchMinSimilarity']
+        else:
+            self.nameSearchMinSimilarity=0.3
+        self.nameTrigramCounts=None
+        
+        # Queries matching less than this fraction of the catalog get an index hint (see chooseIndexHint)
+        self.indexHintMaxFraction=0.05
+        
+        # Time limits (maxTimeMS) for database queries made by request handlers, by kind of request (see
+        # queryTimeLimit), and the most rows a query with constraints that can't use an index is allowed 
+        # to scan (see checkQueryCost; None for no limit)
+        self.queryTimeLimitsMS={'interactive': 15000, 'api': 60000, 'download': 600000}
+        if 'queryTimeLimitsMS' in self.configDict.keys():
+            self.queryTimeLimitsMS.update(self.configDict['queryTimeLimitsMS'])
+        if 'maxScanRows' in self.configDict.keys():
+            self.maxScanRows=self.configDict['maxScanRows']
+        else:
+            self.maxScanRows=1000000
+        self.queryPlanCache=collections.OrderedDict()
+        self.queryPlanCacheLock=threading.Lock()
+
+        # This sets size of table view - view is controlled with session variables
+        self.tableViewRows=40
+        
+        # Per-process cache of query result counts (see countQuery)
+        self.countCache=collections.OrderedDict()
+        self.countCacheSize=1000
+        self.countCacheLock=threading.Lock()
+        self.totalCount=None
+        
+        # Data generation numbers are re-read from MongoDB at most every generationCheckSeconds (see getGeneration)
+        self.generationCache={}
+        self.generationCheckSeconds=1.0
+        
+        # Per-process cache of query summaries: column statistics, histograms, plots (see getCachedSummary)
+        self.summaryCache=collections.OrderedDict()
+        if 'summaryCacheSize' in self.configDict.keys():
+            self.summaryCacheSize=self.configDict['summaryCacheSize']
+        else:
+            self.summaryCacheSize=200
+        self.summaryCacheLock=threading.Lock()
+        
+        # QuickLinks being re-materialized in the background by this process (see refreshQuickLinkInBackground)
+        self.quickLinksRefreshing=set()
+        self.quickLinksRefreshLock=threading.Lock()
+        
         # MongoDB set up
         self.dbName=self.configDict['MongoDBName']
         if 'TagsDBName' not in self.configDict.keys():
@@ -251,13 +381,23 @@ class SourceBrowser(object):
         self.mongoSess=self.client.start_session()
         self.db=self.client[self.dbName]
         self.sourceCollection=self.db['sourceCollection']
-        self.sourceCollection.create_index([('loc', pymongo.GEOSPHERE)])
         self.fieldTypesCollection=self.db['fieldTypes']
         self.tagsDB=self.client[self.tagsDBName]
         self.tagsCollection=self.tagsDB['tagsCollection']
-        self.tagsCollection.create_index([('loc', pymongo.GEOSPHERE)])
+        # Book-keeping: the data generation counter, and materialized quickLinks results
+        self.metaCollection=self.db['metaCollection']
+        self.quickLinksCollection=self.db['quickLinksCollection']
+        self.quickLinksDir=self.cacheDir+os.path.sep+"quickLinks"
+        os.makedirs(self.quickLinksDir, exist_ok = True)
+        # Schema (field names, types etc.) is kept in memory, and reloaded if the schema generation changes
+        # (checked at most every schemaCheckSeconds)
+        self.schema=None
+        self.schemaLock=threading.Lock()
+        self.schemaCheckSeconds=1.0
         if buildDatabase == True:
             self.buildDatabase()
+        else:
+            self.ensureIndexes()
 
         # Column to display info
         # Table pages
@@ -301,6 +441,11 @@ class SourceBrowser(object):
             dispDict={'name': "lastUpdated", 'label': "lastUpdated", 'fmt': "%s"}
             dispDict={'name': "user", 'label': "user", 'fmt': "%s"}
             self.tableDisplayColumns.append(dispDict)
+        
+        # Cell renderers for the table on the index page (see makeCellRenderer)
+        self.cellRenderers={}
+        for colDict in self.tableDisplayColumns:
+            self.getCellRenderer(colDict)
                                        
         # Full list of image directories - for adding image_ tags in buildCacheForObject
         # NOTE: handling of surveys (e.g., SDSS) is clunfky and getting unwieldy...
@@ -342,10 +487,362 @@ class SourceBrowser(object):
         if preprocess == True:
             self.preprocess()
 
-        # This sets size of table view - view is controlled with session variables
-        self.tableViewRows=40
+        # Materialize the results of the quickLinks queries, if the database or cache was just (re)built
+        if buildDatabase == True or preprocess == True:
+            self.refreshQuickLinks()
 
 
+    def getDeclaredIndexes(self):
+        """Returns a dictionary (keys: 'source', 'tags') listing the indexes we want on sourceCollection and
+        tagsCollection. Each entry is a dictionary with keys name, keys (in the form used by create_index),
+        and unique. As well as the standard indexes (position, sourceryID, name), indexes on single columns 
+        that are commonly used in constraints can be added using indexedColumns in the config file, and
+        columns that the table view can be sorted on using sortableColumns.
+        
+        """
+        
+        sourceIndexes=[{'name': 'loc_2dsphere', 'keys': [('loc', pymongo.GEOSPHERE)], 'unique': False},
+                       {'name': 'skyLoc_2dsphere', 'keys': [('skyLoc', pymongo.GEOSPHERE)], 'unique': False},
+                       {'name': 'RADeg_1', 'keys': [('RADeg', pymongo.ASCENDING)], 'unique': False},
+                       {'name': 'decDeg_1_RADeg_1', 'keys': [('decDeg', pymongo.ASCENDING), ('RADeg', pymongo.ASCENDING)], 'unique': False},
+                       {'name': 'sourceryID_1', 'keys': [('sourceryID', pymongo.ASCENDING)], 'unique': True},
+                       {'name': 'name_1', 'keys': [('name', pymongo.ASCENDING)], 'unique': False},
+                       {'name': 'nameNorm_1', 'keys': [('nameNorm', pymongo.ASCENDING)], 'unique': False},
+                       {'name': 'nameTrigrams_1', 'keys': [('nameTrigrams', pymongo.ASCENDING)], 'unique': False},
+                       {'name': 'healpixPixel_1', 'keys': [('healpixPixel', pymongo.ASCENDING)], 'unique': False}]
+        if 'indexedColumns' in self.configDict.keys():
+            for key in self.configDict['indexedColumns']:
+                indexName='%s_1' % (key)
+                if indexName not in [i['name'] for i in sourceIndexes]:
+                    sourceIndexes.append({'name': indexName, 'keys': [(key, pymongo.ASCENDING)], 'unique': False})
+        # For sorting the table view (these can be walked in either direction)
+        for key in self.sortableColumns:
+            indexName='%s_1__id_1' % (key)
+            if indexName not in [i['name'] for i in sourceIndexes]:
+                sourceIndexes.append({'name': indexName, 'keys': [(key, pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], 'unique': False})
+        tagsIndexes=[{'name': 'loc_2dsphere', 'keys': [('loc', pymongo.GEOSPHERE)], 'unique': False},
+                     {'name': 'RADeg_1', 'keys': [('RADeg', pymongo.ASCENDING)], 'unique': False}]
+        
+        return {'source': sourceIndexes, 'tags': tagsIndexes}
+    
+    
+    def getQueryTimeLimitMS(self):
+        """Returns the time limit in milliseconds for database queries made while handling the current 
+        request, as set by the queryTimeLimit decorator (handlers without it get the 'interactive' budget).
+        Returns None (no limit) outside of requests (e.g., when building the database).
+        
+        """
+        
+        if cherrypy.request.app is None:
+            return None
+        
+        return self.queryTimeLimitsMS[getattr(cherrypy.request, 'queryTimeBudget', 'interactive')]
+    
+    
+    def getQueryTimeOptions(self):
+        """Returns keyword arguments that apply the time limit for the current request (see 
+        getQueryTimeLimitMS) to count_documents and aggregate.
+        
+        """
+        
+        maxTimeMS=self.getQueryTimeLimitMS()
+        if maxTimeMS is None:
+            return {}
+        
+        return {'maxTimeMS': maxTimeMS}
+    
+    
+    def getQueryTimeoutMessage(self):
+        """Returns the error message shown when a query runs over its time limit.
+        
+        """
+        
+        maxTimeMS=self.getQueryTimeLimitMS()
+        if maxTimeMS is None:
+            maxTimeMS=self.queryTimeLimitsMS['interactive']
+        
+        return "The query took longer than the time limit (%.0f seconds). Try adding constraints on indexed columns (%s), or a narrower position range." \
+                % (maxTimeMS/1000.0, ", ".join(self.getIndexedColumns()))
+    
+    
+    def getIndexedColumns(self):
+        """Returns the list of catalog columns that have (single column) indexes, and so can be used to 
+        narrow down queries quickly.
+        
+        """
+        
+        constraintFieldTypes=self.getConstraintFieldTypes()
+        indexedColumns=[]
+        for indexDict in self.getDeclaredIndexes()['source']:
+            key=indexDict['keys'][0][0]
+            if key in constraintFieldTypes.keys() and key not in indexedColumns:
+                indexedColumns.append(key)
+        
+        return indexedColumns
+    
+    
+    def checkQueryCost(self, queryDict, queryOtherConstraints):
+        """Pre-flight check for queries with constraints on columns that don't have indexes: these are 
+        checked against every object that MongoDB scans, so if the plan that MongoDB picks (from explain, 
+        which doesn't run the query) would scan more than self.maxScanRows objects, an exception is raised
+        (with a message suggesting what to do instead), so that one such query can't tie up the database.
+        
+        The number of objects scanned is estimated from the column statistics (see 
+        queryTools.estimateSelectivity) for index scans, or is the whole catalog for collection scans. 
+        Plans are cached until the database is rebuilt.
+        
+        """
+        
+        if self.maxScanRows is None:
+            return None
+        indexedColumns=self.getIndexedColumns()
+        unindexedColumns=[]
+        for key in queryTools.getConstraintsColumns(queryOtherConstraints):
+            if key not in indexedColumns and key not in unindexedColumns:
+                unindexedColumns.append(key)
+        if len(unindexedColumns) == 0 or self.chooseIndexHint(queryDict) is not None:
+            return None
+        
+        schema=self.getSchema()
+        cacheKey=json_util.dumps(queryDict, sort_keys = True)
+        with self.queryPlanCacheLock:
+            if cacheKey in self.queryPlanCache.keys() and self.queryPlanCache[cacheKey][0] is schema:
+                self.queryPlanCache.move_to_end(cacheKey)
+                scans=self.queryPlanCache[cacheKey][1]
+            else:
+                scans=None
+        if scans is None:
+            explainDict=self.db.command('explain', SON([('find', self.sourceCollection.name), ('filter', queryDict),
+                                                        ('sort', SON([(self.tableSortKey, self.tableSortDirection), 
+                                                                      ('_id', self.tableSortDirection)]))]),
+                                        verbosity = 'queryPlanner')
+            scans=queryTools.getPlanScans(explainDict)
+            with self.queryPlanCacheLock:
+                self.queryPlanCache[cacheKey]=(schema, scans)
+                self.queryPlanCache.move_to_end(cacheKey)
+                while len(self.queryPlanCache) > self.countCacheSize:
+                    self.queryPlanCache.popitem(last = False)
+        
+        conditions=list(queryDict.items())
+        if '$and' in queryDict.keys():
+            for q in queryDict['$and']:
+                conditions=conditions+list(q.items())
+        columnStats=schema['columnStats']
+        scanFraction=0.0
+        for stage, keyPattern in scans:
+            fraction=None
+            if stage == 'COLLSCAN':
+                fraction=1.0
+            elif len(keyPattern) > 0:
+                indexKey=list(keyPattern.keys())[0]
+                if indexKey in columnStats.keys():
+                    fraction=1.0
+                    for key, condition in conditions:
+                        if key == indexKey:
+                            estimate=queryTools.estimateSelectivity(condition, columnStats[key])
+                            if estimate is not None:
+                                fraction=min(fraction, estimate)
+            if fraction is not None:
+                scanFraction=max(scanFraction, fraction)
+        numScanRows=scanFraction*self.getTotalCount()
+        if numScanRows > self.maxScanRows:
+            raise Exception("this query would need to check about %d objects for constraints on columns without indexes (%s), which is over the limit (%d). Add constraints on indexed columns (%s), or a narrower position range" 
+                            % (numScanRows, ", ".join(unindexedColumns), self.maxScanRows, ", ".join(indexedColumns)))
+    
+    
+    def chooseIndexHint(self, queryDict):
+        """Returns the name of the index to hint for the given query on sourceCollection, or None to leave
+        it to MongoDB. Uses the column statistics made when the database was built to estimate how many rows 
+        each indexed constraint matches (see queryTools.estimateSelectivity), and picks the index for the
+        most selective one, if that matches less than self.indexHintMaxFraction of the rows. This stops 
+        MongoDB walking the whole RADeg index (to avoid a sort) when a selective index is available.
+        
+        """
+        
+        indexNames={}
+        for indexDict in self.getDeclaredIndexes()['source']:
+            if len(indexDict['keys']) == 1 and indexDict['keys'][0][1] == pymongo.ASCENDING:
+                indexNames[indexDict['keys'][0][0]]=indexDict['name']
+        conditions=list(queryDict.items())
+        if '$and' in queryDict.keys():
+            for q in queryDict['$and']:
+                conditions=conditions+list(q.items())
+        columnStats=self.getSchema()['columnStats']
+        bestFraction=None
+        bestIndex=None
+        for key, condition in conditions:
+            if key not in indexNames.keys() or key not in columnStats.keys():
+                continue
+            fraction=queryTools.estimateSelectivity(condition, columnStats[key])
+            if fraction is not None and (bestFraction is None or fraction < bestFraction):
+                bestFraction=fraction
+                bestIndex=indexNames[key]
+        if bestFraction is not None and bestFraction < self.indexHintMaxFraction:
+            return bestIndex
+        
+        return None
+    
+    
+    def updateNameSearchFields(self):
+        """Adds the fields used by nameSearch to any objects that don't have them (databases built before 
+        these were added): nameNorm (the normalized name - see catalogTools.normalizeName) and nameTrigrams
+        (see catalogTools.makeTrigrams). Also stores the number of objects with each trigram in 
+        metaCollection, if these aren't there already, so that fuzzy searches can use the rarest ones.
+        
+        """
+        
+        if self.sourceCollection.find_one({'nameNorm': {'$exists': False}}, {'_id': 1}) is not None:
+            print("... adding name search fields ...")
+            updates=[]
+            for post in self.sourceCollection.find({'nameNorm': {'$exists': False}}, {'_id': 1, 'name': 1}):
+                normName=catalogTools.normalizeName(post['name'])
+                updates.append(pymongo.UpdateOne({'_id': post['_id']}, {'$set': {'nameNorm': normName, 
+                                                  'nameTrigrams': catalogTools.makeTrigrams(normName)}}))
+                if len(updates) == 5000:
+                    self.sourceCollection.bulk_write(updates, ordered = False)
+                    updates=[]
+            if len(updates) > 0:
+                self.sourceCollection.bulk_write(updates, ordered = False)
+            self.metaCollection.delete_one({'_id': 'nameTrigramCounts'})
+        if self.metaCollection.find_one({'_id': 'nameTrigramCounts'}, {'_id': 1}) is None:
+            trigramCounts={}
+            for post in self.sourceCollection.find({}, {'_id': 0, 'nameTrigrams': 1}):
+                for trigram in post['nameTrigrams']:
+                    trigramCounts[trigram]=trigramCounts.get(trigram, 0)+1
+            # Stored as a list, as trigrams may contain characters that MongoDB doesn't allow in keys
+            self.metaCollection.replace_one({'_id': 'nameTrigramCounts'}, {'counts': list(trigramCounts.items())}, upsert = True)
+            self.nameTrigramCounts=None
+    
+    
+    def updateSkyMapPixels(self):
+        """Adds (or recomputes) the healpixPixel field (see catalogTools.RADecToHEALPixels), used for making 
+        sky density maps, for any objects that don't have it (databases built before this was added, or 
+        without healpy installed), or for all objects if skyMapNside has been changed. Does nothing if healpy 
+        isn't installed.
+        
+        """
+        
+        if catalogTools.hp is None:
+            return None
+        skyMapDoc=self.metaCollection.find_one({'_id': 'skyMap'})
+        if skyMapDoc is not None and skyMapDoc['nside'] == self.skyMapNside:
+            queryDict={'healpixPixel': {'$exists': False}}
+        else:
+            queryDict={}
+        if self.sourceCollection.find_one(queryDict, {'_id': 1}) is not None:
+            print("... adding healpixPixel field (nside = %d) ..." % (self.skyMapNside))
+            updates=[]
+            posts=list(self.sourceCollection.find(queryDict, {'_id': 1, 'RADeg': 1, 'decDeg': 1}))
+            pixels=catalogTools.RADecToHEALPixels([p['RADeg'] for p in posts], [p['decDeg'] for p in posts], self.skyMapNside)
+            for post, pixel in zip(posts, pixels):
+                updates.append(pymongo.UpdateOne({'_id': post['_id']}, {'$set': {'healpixPixel': int(pixel)}}))
+                if len(updates) == 5000:
+                    self.sourceCollection.bulk_write(updates, ordered = False)
+                    updates=[]
+            if len(updates) > 0:
+                self.sourceCollection.bulk_write(updates, ordered = False)
+        if skyMapDoc is None or skyMapDoc['nside'] != self.skyMapNside:
+            self.metaCollection.replace_one({'_id': 'skyMap'}, {'nside': self.skyMapNside}, upsert = True)
+            self.bumpGeneration(key = 'schemaGeneration')
+    
+    
+    def getNameTrigramCounts(self):
+        """Returns a dictionary of the number of objects with each name trigram (see updateNameSearchFields),
+        which is read once, and again only when the schema generation changes.
+        
+        """
+        
+        schema=self.getSchema()
+        if self.nameTrigramCounts is None or self.nameTrigramCounts[0] is not schema:
+            doc=self.metaCollection.find_one({'_id': 'nameTrigramCounts'})
+            counts={}
+            if doc is not None:
+                for trigram, count in doc['counts']:
+                    counts[trigram]=count
+            self.nameTrigramCounts=(schema, counts)
+        
+        return self.nameTrigramCounts[1]
+    
+    
+    def ensureIndexes(self):
+        """Creates any of the indexes listed by getDeclaredIndexes that don't already exist. This is run at
+        start up and after the database is built, so that nothing needs to call create_index when handling
+        requests. A report on missing and unused indexes is printed at the end (see reportIndexes).
+        
+        """
+        
+        print(">>> Checking database indexes ...")
+        
+        # Databases built before skyLoc was added: fill it in from RADeg, decDeg (see RADecToGeoJSON)
+        if self.sourceCollection.find_one({'skyLoc': {'$exists': False}}, {'_id': 1}) is not None:
+            print("... adding skyLoc field ...")
+            lon={'$cond': [{'$gt': ['$RADeg', 180]}, {'$subtract': ['$RADeg', 360]}, '$RADeg']}
+            self.sourceCollection.update_many({'skyLoc': {'$exists': False}}, 
+                                              [{'$set': {'skyLoc': {'type': 'Point', 'coordinates': [lon, '$decDeg']}}}])
+        
+        # Name search fields (see nameSearch)
+        self.updateNameSearchFields()
+        
+        # Sky map pixels (see skyDensityMap)
+        self.updateSkyMapPixels()
+        
+        for collectionLabel, collection in zip(['source', 'tags'], [self.sourceCollection, self.tagsCollection]):
+            self.createDeclaredIndexes(collectionLabel, collection)
+        self.reportIndexes()
+    
+    
+    def createDeclaredIndexes(self, collectionLabel, collection):
+        """Creates any of the indexes listed by getDeclaredIndexes for collectionLabel ('source' or 'tags')
+        that don't already exist on the given collection.
+        
+        """
+        
+        existingNames=collection.index_information().keys()
+        for indexDict in self.getDeclaredIndexes()[collectionLabel]:
+            if indexDict['name'] in existingNames:
+                continue
+            print("... creating index %s on %s ..." % (indexDict['name'], collection.name))
+            try:
+                collection.create_index(indexDict['keys'], name = indexDict['name'], unique = indexDict['unique'])
+            except pymongo.errors.OperationFailure as e:
+                if indexDict['unique'] == False:
+                    raise e
+                print("WARNING: could not create unique index %s on %s (%s) - creating a non-unique index instead" 
+                      % (indexDict['name'], collection.name, str(e)))
+                collection.create_index(indexDict['keys'], name = indexDict['name'])
+    
+    
+    def reportIndexes(self):
+        """Prints a report listing any declared indexes (see getDeclaredIndexes) that are missing, and any
+        indexes that have not been used since the MongoDB server started (from $indexStats). Unused indexes
+        still cost time and memory on every update, so candidates for removal from indexedColumns.
+        
+        Returns a dictionary with keys missing, unused (each a list of 'collection.indexName' strings).
+        
+        """
+        
+        declaredDict=self.getDeclaredIndexes()
+        reportDict={'missing': [], 'unused': []}
+        for collectionLabel, collection in zip(['source', 'tags'], [self.sourceCollection, self.tagsCollection]):
+            existingNames=collection.index_information().keys()
+            for indexDict in declaredDict[collectionLabel]:
+                if indexDict['name'] not in existingNames:
+                    reportDict['missing'].append("%s.%s" % (collection.name, indexDict['name']))
+            try:
+                indexStats=list(collection.aggregate([{'$indexStats': {}}]))
+            except pymongo.errors.OperationFailure:
+                indexStats=[]   # e.g., not permitted for this MongoDB user
+            for statsDict in indexStats:
+                if statsDict['name'] != '_id_' and statsDict['accesses']['ops'] == 0:
+                    reportDict['unused'].append("%s.%s" % (collection.name, statsDict['name']))
+        if len(reportDict['missing']) > 0:
+            print("WARNING: missing indexes: %s" % (", ".join(reportDict['missing'])))
+        if len(reportDict['unused']) > 0:
+            print("... indexes unused since MongoDB server start: %s ..." % (", ".join(reportDict['unused'])))
+        
+        return reportDict
+    
+    
     def matchTags(self, obj):
         """Find match in MongoDB to obj row from tab. If we don't find one, return a dictionary with blank
         values where fields would be. We now allow "overloading" - i.e., user can specify as editable fields
@@ -416,29 +913,32 @@ class SourceBrowser(object):
     def addFootprintColumns(self, tab):
         """Adds footprint_ columns to the table, for finding overlap with e.g. DES Y3.
         
+        Each entry in the footprints list in the config file can give any combination of maskList (.fits
+        mask images, memory-mapped where possible), healpixMaskList (HEALPix maps, optionally with 
+        healpixNest: True) and mocList (MOC files). A source is flagged if it lies in any of these.
+        
         """
         
+        RADeg=np.array(tab['RADeg'].data, dtype = float)
+        decDeg=np.array(tab['decDeg'].data, dtype = float)
         for footprintDict in self.configDict['footprints']:
             colLabel='footprint_%s' % (footprintDict['label'])
             print("... adding %s ..." % (colLabel))
-            tab.add_column(atpy.Column(np.zeros(len(tab), dtype = bool), colLabel))
-            for maskPath in footprintDict['maskList']:
-                with pyfits.open(maskPath) as img:
-                    for extName in range(0, 2):
-                        mask=img[extName].data
-                        if mask is not None:
-                            break
-                    wcs=astWCS.WCS(img[extName].header, mode = 'pyfits')
-                xy=np.array(wcs.wcs2pix(tab['RADeg'].data, tab['decDeg'].data))
-                xs=np.array(xy[:, 0], dtype = int)
-                ys=np.array(xy[:, 1], dtype = int)
-                for i in range(len(tab)):
-                    x=xs[i]
-                    y=ys[i]
-                    if x >= 0 and x < mask.shape[1] and y >= 0 and y < mask.shape[0]:
-                        if mask[y, x] > 0:
-                            tab[colLabel][i]=1
-            del mask, wcs
+            flags=np.zeros(len(tab), dtype = bool)
+            if 'maskList' in footprintDict.keys():
+                for maskPath in footprintDict['maskList']:
+                    flags=np.logical_or(flags, catalogTools.flagInMask(RADeg, decDeg, maskPath))
+            if 'healpixMaskList' in footprintDict.keys():
+                if 'healpixNest' in footprintDict.keys():
+                    nest=footprintDict['healpixNest']
+                else:
+                    nest=False
+                for mapPath in footprintDict['healpixMaskList']:
+                    flags=np.logical_or(flags, catalogTools.flagInHEALPixMap(RADeg, decDeg, mapPath, nest = nest))
+            if 'mocList' in footprintDict.keys():
+                for mocPath in footprintDict['mocList']:
+                    flags=np.logical_or(flags, catalogTools.flagInMOC(RADeg, decDeg, mocPath))
+            tab.add_column(atpy.Column(flags, colLabel))
         
         return tab
         
@@ -465,6 +965,9 @@ class SourceBrowser(object):
         self.db.drop_collection('sourceCollection')
         self.db.drop_collection('fieldTypes')
         
+        # matchTags needs the 2dsphere index on tagsCollection while we build (a fresh tags database has none)
+        self.createDeclaredIndexes('tags', self.tagsCollection)
+        
         # Table set up
         tab=atpy.Table().read(self.configDict['catalogFileName'])
         origLen=len(tab)
@@ -585,12 +1088,29 @@ class SourceBrowser(object):
         
         # Cache the result of the cross matches: we need this for speed later on when downloading catalogs
         # Otherwise, for large catalogs, we're hitting memory issues
-        cachedTabFileName=self.cacheDir+os.path.sep+"%s_xMatchedTable.fits" % (self.configDict['catalogDownloadFileName'])
-        #cachedTabFileName=self.cacheDir+os.path.sep+"%s_xMatchedTable.csv" % (self.configDict['catalogDownloadFileName'])
-        if len(tab.columns) > 999:
-            raise Exception("FITS format is limited to a maximum 1000 columns - so prune your cross-match tables.")
-        tab.write(cachedTabFileName, overwrite = True)
-        print("... written %s ..." % (cachedTabFileName))
+        # This is a column store (one memory-mapped array per column), so no limit on number of columns
+        columnStore.writeColumnStore(tab, self.xMatchedTabDir, indexColumns = ['sourceryID'])
+        print("... written %s ..." % (self.xMatchedTabDir))
+        
+        # Optional: leave sentinel values of cross match columns out of MongoDB documents (most objects
+        # don't have matches in most catalogs) - these are restored when reading (see getSparseSentinels)
+        sparseKeys=[]
+        if 'sparseCrossMatchStorage' in self.configDict.keys() and self.configDict['sparseCrossMatchStorage'] == True \
+            and 'crossMatchCatalogs' in self.configDict.keys():
+            for xMatchDict in self.configDict['crossMatchCatalogs']:
+                prefix='%s_' % (xMatchDict['label'])
+                for key in tab.keys():
+                    if key[:len(prefix)] == prefix and key != '%s_match' % (xMatchDict['label']) and key not in sparseKeys:
+                        sparseKeys.append(key)
+        self.metaCollection.update_one({'_id': 'storage'}, {'$set': {'sparseKeys': sparseKeys}}, upsert = True)
+        
+        # HEALPix pixels for sky density maps (see skyDensityMap)
+        if catalogTools.hp is not None:
+            healpixPixels=catalogTools.RADecToHEALPixels(tab['RADeg'], tab['decDeg'], self.skyMapNside)
+            self.metaCollection.replace_one({'_id': 'skyMap'}, {'nside': self.skyMapNside}, upsert = True)
+        else:
+            healpixPixels=None
+            self.metaCollection.delete_one({'_id': 'skyMap'})
         
         # Import each object into MongoDB - now doing this in bulk (slightly quicker)
         idCount=0
@@ -603,14 +1123,21 @@ class SourceBrowser(object):
             idCount=idCount+1
             newPost={'index': idCount}
             newPost['name']=row['name']
+            newPost['nameNorm']=catalogTools.normalizeName(row['name'])
+            newPost['nameTrigrams']=catalogTools.makeTrigrams(newPost['nameNorm'])
             newPost['RADeg']=row['RADeg']
             newPost['decDeg']=row['decDeg']
+            if healpixPixels is not None:
+                newPost['healpixPixel']=int(healpixPixels[idCount-1])
             # MongoDB coords for spherical geometry
             if row['RADeg'] > 180:
                 lon=360.0-row['RADeg']
             else:
                 lon=row['RADeg']
             newPost['loc']={'type': 'Point', 'coordinates': [lon, row['decDeg']]}
+            # loc (above) folds RA > 180 onto 360 - RA, so isn't a true sky position - it's kept for matching 
+            # to tagsCollection, which uses the same convention. Position searches use skyLoc.
+            newPost['skyLoc']=catalogTools.RADecToGeoJSON(row['RADeg'], row['decDeg'])
             
             # Properties in the table
             for key in tab.keys():
@@ -660,6 +1187,9 @@ class SourceBrowser(object):
             #     sys.exit()
             for key in tagsDict:
                 newPost[key]=tagsDict[key]
+            for key in sparseKeys:
+                if key in newPost.keys() and (newPost[key] == -99 or newPost[key] == ""):
+                    del newPost[key]
             if self.configDict['insertMode'] == 'single':
                 print("... adding %s to database (%d/%d) ..." % (row['name'], idCount, len(tab)))
                 self.sourceCollection.insert_one(newPost)
@@ -682,9 +1212,18 @@ class SourceBrowser(object):
                 fieldDict['description']=self.descriptionsDict[key]
             else:
                 fieldDict['description']="-"
+            if key in tab.colnames:
+                fieldDict['stats']=catalogTools.computeColumnStats(tab[key])
             self.fieldTypesCollection.insert_one(fieldDict)
             index=index+1
 
+        # Indexes are built after the bulk insert (quicker than maintaining them while inserting)
+        # NOTE: this also counts the name trigrams, for name searches
+        self.metaCollection.delete_one({'_id': 'nameTrigramCounts'})
+        self.ensureIndexes()
+        self.bumpGeneration()
+        self.bumpGeneration(key = 'schemaGeneration')
+        self.schema=None
         t1=time.time()
         if os.path.exists(self.dbLockFileName) ==True:
             os.remove(self.dbLockFileName)
@@ -1432,8 +1971,9 @@ class SourceBrowser(object):
                     
         
     @cherrypy.expose
+    @queryTimeLimit('interactive')
     def updateQueryParams(self, queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints, 
-                          queryApply = None, queryReset = None):
+                          queryApply = None, queryReset = None, querySortByDistance = "false"):
         """Updates query params in session, and then calls index again (which runs the query).
         
         """
@@ -1444,15 +1984,32 @@ class SourceBrowser(object):
             cherrypy.session['queryRADeg']="0:360"
             cherrypy.session['queryDecDeg']="-90:90"
             cherrypy.session['querySearchBoxArcmin']=""
-            cherrypy.session['viewTopRow']=0
+            cherrypy.session['pageToken']=None
             cherrypy.session['queryOtherConstraints']=""
+            cherrypy.session['querySortByDistance']=False
+            cherrypy.session['querySortKey']=self.tableSortKey
+            cherrypy.session['querySortDirection']=self.tableSortDirection
         
+        cherrypy.session['queryError']=None
         if queryApply:
+            # Check the query first - if it's not valid, keep the old one and tell the user why
+            try:
+                queryDict=self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+                if self.findQuickLink(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints) is None:
+                    self.countQuery(queryDict) # so that queries that run over the time limit aren't kept
+            except Exception as e:
+                if type(e) == pymongo.errors.ExecutionTimeout:
+                    e=self.getQueryTimeoutMessage()
+                cherrypy.session['queryError']={'message': str(e), 'queryRADeg': queryRADeg, 'queryDecDeg': queryDecDeg,
+                                                'querySearchBoxArcmin': querySearchBoxArcmin,
+                                                'queryOtherConstraints': queryOtherConstraints}
+                raise cherrypy.HTTPRedirect(cherrypy.request.script_name)
             cherrypy.session['queryRADeg']=queryRADeg
             cherrypy.session['queryDecDeg']=queryDecDeg
             cherrypy.session['querySearchBoxArcmin']=querySearchBoxArcmin
-            cherrypy.session['viewTopRow']=0
+            cherrypy.session['pageToken']=None
             cherrypy.session['queryOtherConstraints']=queryOtherConstraints
+            cherrypy.session['querySortByDistance']=(querySortByDistance == "true")
         
         raise cherrypy.HTTPRedirect(cherrypy.request.script_name)
 
@@ -1548,6 +2105,7 @@ class SourceBrowser(object):
 
     @cherrypy.expose
     @sourceryAuth.require()
+    @queryTimeLimit('interactive')
     def index(self):
         """Shows the table page.
         
@@ -1558,8 +2116,8 @@ class SourceBrowser(object):
         
         # Session variables: where in the table are we looking, query constraints
         if not cherrypy.session.loaded: cherrypy.session.load()
-        if 'viewTopRow' not in cherrypy.session:
-            cherrypy.session['viewTopRow']=0
+        if 'pageToken' not in cherrypy.session:
+            cherrypy.session['pageToken']=None
         if 'queryRADeg' not in cherrypy.session:
             cherrypy.session['queryRADeg']="0:360"
         if 'queryDecDeg' not in cherrypy.session:
@@ -1572,6 +2130,12 @@ class SourceBrowser(object):
         queryDecDeg=cherrypy.session.get('queryDecDeg')
         querySearchBoxArcmin=cherrypy.session.get('querySearchBoxArcmin')
         queryOtherConstraints=cherrypy.session.get('queryOtherConstraints')
+        querySortByDistance=cherrypy.session.get('querySortByDistance', False)
+        querySortKey=cherrypy.session.get('querySortKey', self.tableSortKey)
+        querySortDirection=cherrypy.session.get('querySortDirection', self.tableSortDirection)
+        if querySortKey not in self.sortableColumns:
+            querySortKey=self.tableSortKey
+            querySortDirection=self.tableSortDirection
         
         templatePage="""<html>
         <head>
@@ -1660,18 +2224,21 @@ class SourceBrowser(object):
         <fieldset>
         $QUICK_QUERY_LINKS
         <legend><span style='border: black 1px solid; color: gray; padding: 2px'>hide</span><b>Constraints</b></legend>
-        <p>Enter coordinate ranges (e.g., 120:220) or set the search box length. Use negative RA values to wrap around 0 degrees (e.g., -60:60).</p>
+        <p>Enter coordinate ranges (e.g., 120:220), or a position and search radius. Use negative RA values to wrap around 0 degrees (e.g., -60:60).</p>
         <p>
         <label for="queryRADeg">RA (degrees)</label>
         <input type="text" value="$QUERY_RADEG" name="queryRADeg"/>
         <label for="queryDecDeg">Dec. (degrees)</label>
         <input type="text" value="$QUERY_DECDEG" name="queryDecDeg"/>
-        <label for="querySearchBoxArcmin">Search box length (arcmin)</label>
+        <label for="querySearchBoxArcmin">Search radius (arcmin)</label>
         <input type="text" value="$QUERY_SEARCHBOXARCMIN" name="querySearchBoxArcmin"/>
+        <input type="checkbox" value="true" name="querySortByDistance" $QUERY_SORTBYDISTANCE/>
+        <label for="querySortByDistance">Sort by distance</label>
         </p>
         </p>
         <label for="queryOtherConstraints">Other constraints <a href=$CONSTRAINTS_HELP_LINK target=new>(help)</a></label>
         <textarea style="width:100%" name="queryOtherConstraints">$QUERY_OTHERCONSTRAINTS</textarea>
+        $QUERY_ERROR
         <input type="submit" class="f" style="font-size: 1.05em;" name="queryApply" value="Apply">
         <input type="submit" class="f" style="font-size: 1.05em;" name="queryReset" value="Reset"><br>
         <div style="display: table-cell; vertical-align: middle;"><i>$SHARE_QUERY_LINK</i></div>
@@ -1687,7 +2254,7 @@ class SourceBrowser(object):
         </div>
                 
         <table frame=border cellspacing=0 cols=$TABLE_COLS rules=all border=2 width=100% align=center class=tablefont>
-        <tbody>
+        <tbody id="tableBody">
             <tr style="background-color: rgb(0, 0, 0); font-family: monospace; color: rgb(255, 255, 255); 
                     text-align: center; vertical-align: middle; font-size: 125%;">
             $TABLE_COL_NAMES
@@ -1704,8 +2271,71 @@ class SourceBrowser(object):
             <div style="clear:both"></div><!-- Need this to have the buttons actually inside div#buttons -->
         </div>
         </form>
+        $SCROLLING_TABLE
         
         $DOWNLOAD_LINKS
+        
+        $SKY_MAP
+        
+        <form method="get" action="queryStatsPlot" target="new">
+        <fieldset>
+        <legend><span style='border: black 1px solid; color: gray; padding: 2px'>expand</span><b>Column Statistics</b></legend>
+        <p>Plot the distribution of a column (or fetch summary statistics as JSON) for objects that match the current constraints.</p>
+        <select name="columns">
+        $STATS_COLUMN_OPTIONS</select>
+        <label for="numBins">Number of bins</label>
+        <input type="text" value="20" name="numBins"/>
+        <input type="hidden" value="$QUERY_RADEG" name="queryRADeg"/>
+        <input type="hidden" value="$QUERY_DECDEG" name="queryDecDeg"/>
+        <input type="hidden" value="$QUERY_SEARCHBOXARCMIN" name="querySearchBoxArcmin"/>
+        <input type="hidden" value="$QUERY_OTHERCONSTRAINTS_ATTR" name="queryOtherConstraints"/>
+        <input type="submit" class="f" style="font-size: 1.05em;" formaction="queryStats" value="JSON">
+        <input type="submit" class="f" style="font-size: 1.05em;" value="Plot">
+        </fieldset>
+        </form><br>
+        
+        <form method="get" action="nameSearch">
+        <fieldset>
+        <legend><b>Name Search</b></legend>
+        <label for="name">Name</label>
+        <input type="text" value="" name="name"/>
+        <input type="submit" class="f" style="font-size: 1.05em;" value="Search">
+        <p>Finds objects by name (not case sensitive; the start of a name is enough). If there are no exact matches, the closest names are listed.</p>
+        </fieldset>
+        </form><br>
+        
+        <form method="post" action="batchSearch" enctype="multipart/form-data">
+        <fieldset>
+        <legend><span style='border: black 1px solid; color: gray; padding: 2px'>expand</span><b>Batch Position Search</b></legend>
+        <p>Upload a table of positions (CSV or FITS, with columns RADeg, decDeg in decimal degrees, and optionally id and radiusArcmin) 
+        to find all objects within the search radius of each position. Current constraints are applied to the matches.</p>
+        <input type="file" name="positionsFile"/>
+        <label for="radiusArcmin">Search radius (arcmin)</label>
+        <input type="text" value="1.0" name="radiusArcmin"/>
+        <input type="hidden" value="$QUERY_OTHERCONSTRAINTS_ATTR" name="queryOtherConstraints"/>
+        <input type="submit" class="f" style="font-size: 1.05em;" value="Search">
+        </fieldset>
+        </form><br>
+        
+        <form method="post" action="crossMatchUpload" enctype="multipart/form-data">
+        <fieldset>
+        <legend><span style='border: black 1px solid; color: gray; padding: 2px'>expand</span><b>Cross Match Uploaded Catalog</b></legend>
+        <p>Upload a catalog (CSV or FITS, with columns RADeg, decDeg in decimal degrees) to cross match against this catalog. 
+        The joined table is downloaded in the chosen format. Current constraints are applied to the matches.</p>
+        <input type="file" name="catalogFile"/>
+        <label for="radiusArcmin">Match radius (arcmin)</label>
+        <input type="text" value="1.0" name="radiusArcmin"/>
+        <select name="matchMode">
+        <option value="nearest">nearest match only</option>
+        <option value="all">nearest match, keep unmatched rows</option>
+        <option value="radius">all matches within radius</option>
+        </select>
+        <select name="fileFormat">
+        $XMATCH_FORMAT_OPTIONS</select>
+        <input type="hidden" value="$QUERY_OTHERCONSTRAINTS_ATTR" name="queryOtherConstraints"/>
+        <input type="submit" class="f" style="font-size: 1.05em;" value="Cross Match">
+        </fieldset>
+        </form><br>
 
         </tbody>
         </table>
@@ -1725,13 +2355,48 @@ class SourceBrowser(object):
         else:
             html=html.replace("$TITLE", "Sourcery Database")
                 
-        # First need to apply query parameters here
-        queryPosts, numPosts=self.runQuery(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
-        if 'numPosts' not in cherrypy.session:
-            cherrypy.session['numPosts']=numPosts
+        # If the last query entered wasn't valid, we show the error, but run the previous query
+        queryError=cherrypy.session.get('queryError')
+        cherrypy.session['queryError']=None
+        try:
+            queryDict=self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+            if self.findQuickLink(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints) is None:
+                self.countQuery(queryDict) # cached, so this isn't repeated below
+        except Exception as e:
+            # e.g., the query in the session uses a column that is no longer in the database, or is too slow
+            if type(e) == pymongo.errors.ExecutionTimeout:
+                e=self.getQueryTimeoutMessage()
+            queryError={'message': str(e), 'queryRADeg': queryRADeg, 'queryDecDeg': queryDecDeg, 
+                        'querySearchBoxArcmin': querySearchBoxArcmin, 'queryOtherConstraints': queryOtherConstraints}
+            queryRADeg="0:360"
+            queryDecDeg="-90:90"
+            querySearchBoxArcmin=""
+            queryOtherConstraints=""
+            for key, value in [('queryRADeg', queryRADeg), ('queryDecDeg', queryDecDeg), ('querySearchBoxArcmin', querySearchBoxArcmin),
+                               ('queryOtherConstraints', queryOtherConstraints), ('pageToken', None)]:
+                cherrypy.session[key]=value
+        
+        # First need to apply query parameters here - quickLinks queries are served from materialized results
+        quickLinkResult=self.getQuickLinkResult(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+        if quickLinkResult is not None:
+            numPosts=quickLinkResult['count']
+        else:
+            numPosts=self.countQuery(self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints))
         
-        # Then cut to number of rows to view as below
-        viewPosts=queryPosts[cherrypy.session['viewTopRow']:cherrypy.session['viewTopRow']+self.tableViewRows]
+        # Table columns - as well as defaults, add ones we query on
+        coneSearch=self.getConeSearchParams(queryRADeg, queryDecDeg, querySearchBoxArcmin) is not None
+        displayColumns=self.getDisplayColumns(queryOtherConstraints, coneSearch = coneSearch)
+        
+        # Then fetch the rows to view (only the columns we show) - the tokens for the next/prev pages are 
+        # kept for changeTablePage
+        viewPosts, prevPageToken, nextPageToken=self.fetchTablePage(queryRADeg, queryDecDeg, querySearchBoxArcmin, 
+                                                                    queryOtherConstraints, 
+                                                                    pageToken = cherrypy.session['pageToken'],
+                                                                    projection = self.makeTableProjection(displayColumns),
+                                                                    sortByDistance = querySortByDistance,
+                                                                    sortKey = querySortKey, sortDirection = querySortDirection)
+        cherrypy.session['prevPageToken']=prevPageToken
+        cherrypy.session['nextPageToken']=nextPageToken
         
         # Quick query link(s) - at top of 'constraints' box
         if 'quickLinks' in self.configDict.keys():            
@@ -1748,10 +2413,23 @@ class SourceBrowser(object):
         html=html.replace("$QUICK_QUERY_LINKS", quickLinkStr)
             
         # Fill in query params
+        if queryError is not None:
+            html=html.replace("$QUERY_ERROR", "<p style='color: red;'>Query not applied: %s</p>" % (html_escape(queryError['message'])))
+            html=html.replace("$QUERY_RADEG", queryError['queryRADeg'])
+            html=html.replace("$QUERY_DECDEG", queryError['queryDecDeg'])
+            html=html.replace("$QUERY_SEARCHBOXARCMIN", queryError['querySearchBoxArcmin'])
+            html=html.replace("$QUERY_OTHERCONSTRAINTS", queryError['queryOtherConstraints'])
+        else:
+            html=html.replace("$QUERY_ERROR", "")
         html=html.replace("$QUERY_RADEG", queryRADeg)
         html=html.replace("$QUERY_DECDEG", queryDecDeg)
         html=html.replace("$QUERY_SEARCHBOXARCMIN", querySearchBoxArcmin)
+        html=html.replace("$QUERY_OTHERCONSTRAINTS_ATTR", html_escape(queryOtherConstraints))
         html=html.replace("$QUERY_OTHERCONSTRAINTS", queryOtherConstraints)
+        if querySortByDistance == True:
+            html=html.replace("$QUERY_SORTBYDISTANCE", "checked")
+        else:
+            html=html.replace("$QUERY_SORTBYDISTANCE", "")
         html=html.replace("$OBJECT_TYPE_STRING", self.configDict['objectTypeString'])
         html=html.replace("$NUMBER_SOURCES", str(numPosts))#str(len(queryPosts)))
         if 'hostedBy' in self.configDict.keys():
@@ -1780,44 +2458,22 @@ class SourceBrowser(object):
                         #if key.find(prefix) != -1 and key[:len(prefix)] == prefix:
                             #columnsHiddenList.append(key)
         # This is a crude way of breaking queries on censored columns by users who don't have permission to see them...
-        user=cherrypy.session['_sourcery_username']
-        for userNameKey in self.usersDict.keys():
-            userDict=self.usersDict[userNameKey]
-            if userNameKey == user and 'hiddenXMatchTables' in userDict.keys():
-                for prefix in userDict['hiddenXMatchTables']:
-                    if queryOtherConstraints.find(prefix) != -1:
-                        numPosts=0
-                        viewPosts=[]
-      
-        # Table columns - as well as defaults, add ones we query on
-        columnsShownList=[]
-        for colDict in self.tableDisplayColumns:
-            if colDict['name'] not in columnsShownList:
-                columnsShownList.append(colDict['name'])
-        displayColumns=[]+self.tableDisplayColumns
-        operators=["<", ">", "=", "!"]
-        logicalOps=[' and ', ' or ']
-        for logOp in logicalOps:
-            constraints=queryOtherConstraints.split(logOp)
-            for c in constraints:
-                for o in operators:
-                    colName=c.split(o)[0].lstrip().rstrip()
-                    if numPosts > 0 and colName in viewPosts[0].keys() and colName not in columnsShownList:# and colName not in columnsHiddenList:
-                        fieldTypeDict=self.fieldTypesCollection.find_one({'name': colName})                            
-                        dispDict={'name': colName, 'label': colName}
-                        if fieldTypeDict is None:
-                            dispDict['fmt']='%s'
-                        elif fieldTypeDict['type'] == 'number':
-                            dispDict['fmt']='%.3f'
-                        elif fieldTypeDict['type'] == 'text':
-                            dispDict['fmt']='%s'
-                        else:
-                            raise Exception("unknown type for field '%s'" % (colName))
-                        displayColumns.append(dispDict)
+        for prefix in self.getUserPolicy()['hiddenPrefixes']:
+            if queryOtherConstraints.find(prefix) != -1:
+                numPosts=0
+                viewPosts=[]
+                displayColumns=[]+self.tableDisplayColumns
                         
         columnHeadings=""
         for colDict in displayColumns:
-            columnHeadings=columnHeadings+"\n           <td><b>%s</b></td>" % (colDict['label'])
+            if colDict['name'] in self.sortableColumns and querySortByDistance == False:
+                arrowStr=""
+                if colDict['name'] == querySortKey:
+                    arrowStr=" &#9650;" if querySortDirection == pymongo.ASCENDING else " &#9660;"
+                columnHeadings=columnHeadings+"\n           <td><b><a href=\"changeTableSort?sortKey=%s\" title=\"Sort on this column\">%s</a>%s</b></td>" \
+                                % (quote_plus(colDict['name']), colDict['label'], arrowStr)
+            else:
+                columnHeadings=columnHeadings+"\n           <td><b>%s</b></td>" % (colDict['label'])
         html=html.replace("$TABLE_COL_NAMES", columnHeadings)
         html=html.replace("$TABLE_COLS", str(len(displayColumns)))
         
@@ -1844,18 +2500,15 @@ class SourceBrowser(object):
         
         # For users with hiddenConstraints set
         hiddenConstraintsMessage=""
-        user=cherrypy.session['_sourcery_username']
-        for userNameKey in self.usersDict.keys():
-            userDict=self.usersDict[userNameKey]
-            if userNameKey == user and 'hiddenConstraintsMessage' in userDict.keys():
-                hiddenConstraintsMessage="; %s" % (userDict['hiddenConstraintsMessage'])
+        if self.getUserPolicy()['hiddenConstraintsMessage'] != "":
+            hiddenConstraintsMessage="; %s" % (self.getUserPolicy()['hiddenConstraintsMessage'])
         
         metaData="""<br><fieldset>
         <legend><span style='border: black 1px solid; color: gray; padding: 2px'>hide</span><b>Source List Information</b></legend>
         Total number of %s: %d (original source list: %d%s) %s %s
         <p>%s</p>
         $NEWS
-        </fieldset>""" % (self.configDict['objectTypeString'], numPosts, self.sourceCollection.estimated_document_count(), hiddenConstraintsMessage, latestNewsStr,
+        </fieldset>""" % (self.configDict['objectTypeString'], numPosts, self.getTotalCount(), hiddenConstraintsMessage, latestNewsStr,
                           cacheRebuildStr, commentsString)
         if 'newsItems' in self.configDict.keys():
             newsStr="<p>News:<ul>\n"
@@ -1870,25 +2523,52 @@ class SourceBrowser(object):
         
         # Catalog download links
         #http://localhost:8080/downloadCatalog?queryRADeg=0%3A360&queryDecDeg=-90%3A90&querySearchBoxArcmin=&queryOtherConstraints=softCts+%3E+300
-        shortCatalogName=self.configDict['catalogDownloadFileName']+".cat"
-        shortFITSName=shortCatalogName.replace(".cat", ".fits")
-        minimalFITSName=shortCatalogName.replace(".cat", "-minimal.fits")
-        shortRegName=shortCatalogName.replace(".cat", ".reg")
+        minimalFITSName=self.configDict['catalogDownloadFileName']+"-minimal.fits"
         downloadLinkStr="downloadCatalog?queryRADeg=%s&queryDecDeg=%s&querySearchBoxArcmin=%s&queryOtherConstraints=%s&" % (queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
         minimalDownloadLinkStr=downloadLinkStr+"minimalColumnSet=true&"
         downloadLinkStr=quote_plus(downloadLinkStr, safe='&?=')
         minimalDownloadLinkStr=quote_plus(minimalDownloadLinkStr, safe='&?=')
+        formatLinks=""
+        formatOptions=""
+        for fileFormat in DOWNLOAD_FORMATS.keys():
+            if fileFormat in ['arrow', 'parquet'] and catalogTools.pa is None:
+                continue
+            formatOptions=formatOptions+'<option value="%s">%s (%s)</option>\n' % (fileFormat, fileFormat, DOWNLOAD_FORMATS[fileFormat]['description'])
+            formatLinks=formatLinks+"<li><a href=%sfileFormat=%s>%s.%s</a>   (%s)</li>\n" % (downloadLinkStr, quote_plus(fileFormat), 
+                                    self.configDict['catalogDownloadFileName'], fileFormat, DOWNLOAD_FORMATS[fileFormat]['description'])
+            if fileFormat == 'fits':
+                formatLinks=formatLinks+"$MINIMAL_STR\n"
+        for apiName, description in [['queryJSON', 'JSON, paged'], ['queryNDJSON', 'newline-delimited JSON']]:
+            formatLinks=formatLinks+"<li><a href=%s>%s</a>   (%s)</li>\n" % (downloadLinkStr.replace("downloadCatalog", apiName, 1), 
+                                    apiName, description)
         downloadLinks="""<fieldset>
         <legend><span style='border: black 1px solid; color: gray; padding: 2px'>hide</span><b>Download Catalog</b></legend>
         <ul>
-        <li><a href=%sfileFormat=cat>%s</a>   (plain text)</li>
-        <li><a href=%sfileFormat=fits>%s</a>   (FITS table format; all columns)</li>
-        $MINIMAL_STR
-        <li><a href=%sfileFormat=reg>%s</a>   (DS9 region file)</li></ul>
+        %s</ul>
         <p>Note that current constraints are applied to downloaded catalogs.</p>
         </fieldset><br>
-        """ % (downloadLinkStr, shortCatalogName, downloadLinkStr, shortFITSName, downloadLinkStr, shortRegName)
+        """ % (formatLinks)
         html=html.replace("$DOWNLOAD_LINKS", downloadLinks)
+        html=html.replace("$XMATCH_FORMAT_OPTIONS", formatOptions)
+        statsOptions=""
+        for key, fieldType in self.getConstraintFieldTypes().items():
+            if self.isHiddenColumn(key) == False:
+                statsOptions=statsOptions+'<option value="%s">%s (%s)</option>\n' % (key, key, fieldType)
+        html=html.replace("$STATS_COLUMN_OPTIONS", statsOptions)
+        
+        # Sky density map (loaded by the browser separately, so doesn't slow down the table page)
+        if catalogTools.hp is not None and self.getSchema()['skyMapNside'] is not None:
+            skyMapLinkStr=quote_plus("skyDensityMap?queryRADeg=%s&queryDecDeg=%s&querySearchBoxArcmin=%s&queryOtherConstraints=%s" 
+                                     % (queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints), safe='&?=')
+            skyMap="""<fieldset>
+        <legend><span style='border: black 1px solid; color: gray; padding: 2px'>hide</span><b>Sky Distribution</b></legend>
+        <p>Number of objects matching the current constraints per HEALPix pixel (<a href=%s&fileFormat=json>JSON</a>).</p>
+        <img src="%s" loading="lazy" alt="Sky density map" style="display: block; margin: 0 auto;"/>
+        </fieldset><br>
+        """ % (skyMapLinkStr, skyMapLinkStr)
+        else:
+            skyMap=""
+        html=html.replace("$SKY_MAP", skyMap)
         
         if 'catalogDownloadMinimalColumns' in self.configDict.keys():
             minimalStr="<li><a href=%sfileFormat=fits>%s</a>   (FITS table format; minimal column set)</li>" % (minimalDownloadLinkStr, minimalFITSName)
@@ -1896,92 +2576,36 @@ class SourceBrowser(object):
         else:
             html=html.replace("$MINIMAL_STR", "")
 
-        tableData=""
         usedBckColors=[]
         usedBckKeys=[]
-
-        for obj in viewPosts:
-            
-            bckColor="white"
-                
-            # Row for each object in table
-            rowString="<tr>\n"
-            for colDict in displayColumns:
-                # Python 2/3 thing
-                try:
-                    htmlKey="$"+string.upper(colDict['name'])+"_KEY"
-                except:
-                    htmlKey="$"+colDict['name'].upper()+"_KEY"                    
-                if 'tableAlign' in colDict.keys():
-                    alignStr=colDict['tableAlign']
-                else:
-                    alignStr="center"
-                if 'displaySize' in colDict.keys():
-                    widthStr='width: %dem;' % (colDict['displaySize'])
-                    useDiv=True
-                else:
-                    useDiv=False
-                    if colDict['fmt'] == '%s':
-                        if colDict['name'] in obj.keys() and type(obj[colDict['name']]) == str:
-                            widthStr='width: %dem;' % (len(obj[colDict['name']]))
-                        else:
-                            widthStr=""
-                    else:
-                        widthStr='width: %dem;' % (len(colDict['fmt'] % (1)))
-                rowString=rowString+"   <td style='background-color: "+bckColor+"; "+widthStr+"' align="+alignStr+">"
-                if useDiv == True:
-                    rowString=rowString+'<div style="text-overflow: ellipsis; white-space: nowrap; overflow: hidden; '+widthStr+'">'
-                rowString=rowString+htmlKey
-                if useDiv == True:
-                    rowString=rowString+"</div>\n"
-                rowString=rowString+"</td>\n"
-            rowString=rowString+"</tr>\n"
-            
-            # Insert values - note name is special
-            for colDict in displayColumns:
-                key=colDict['name']
-                if key in obj.keys():
-                    try:
-                        value=obj[key]
-                    except:
-                        raise Exception("missing key %s" % (key))
-                else:
-                    # No entry in MongoDB tags yet
-                    if colDict['fmt'] != "%s":
-                        value=0.0
-                    else:
-                        value=""
-                # Python 2/3 thing
-                try:
-                    htmlKey="$"+string.upper(key)+"_KEY"
-                except:
-                    htmlKey="$"+key.upper()+"_KEY"
-                if key == "name":
-                    #linksDir="dummy"
-                    linkURL="displaySourcePage?sourceryID=%s&clipSizeArcmin=%.2f" % (self.sourceNameToURL(obj['sourceryID']), self.configDict['defaultViewSizeArcmin'])
-                    if 'defaultImageType' in self.configDict.keys():
-                        linkURL=linkURL+"&imageType=%s" % (self.configDict['defaultImageType'])
-                    nameLink="<a href=\"%s\" target=new>%s</a>" % \
-                        (linkURL, obj['name'])
-                    rowString=rowString.replace(htmlKey, "%s" % (nameLink))
-                elif key == "NED_name" and obj['NED_name'] != "None":
-                    nedName=obj[key]
-                    nedLinkURL="http://ned.ipac.caltech.edu/cgi-bin/objsearch?objname=%s&extend=no&hconst=73&omegam=0.27&omegav=0.73&corr_z=1&out_csys=Equatorial&out_equinox=J2000.0&obj_sort=RA+or+Longitude&of=pre_text&zv_breaker=30000.0&list_limit=5&img_stamp=YES" % (nedName.replace("+", "%2B").replace(" ", "+"))
-                    rowString=rowString.replace(htmlKey, "<a href=%s>%s</a>" % (nedLinkURL, nedName))
-                elif key == "NED_z" and obj['NED_z'] == "nan":
-                    rowString=rowString.replace(htmlKey, "-")
-                else:
-                    try:
-                        rowString=rowString.replace(htmlKey, colDict['fmt'] % (value))
-                    except:
-                        IPython.embed()
-                        sys.exit()
-                        raise Exception("""IndexError: check .config file tableDisplayColumns are actually in the .fits table, or for mixed '' "" inside [] """ )
-                           
-            tableData=tableData+rowString
-            
+        tableData=self.renderTableRows(viewPosts, displayColumns)
         html=html.replace("$TABLE_DATA", tableData)
         
+        # Optional: fetch further pages as the user scrolls, instead of using the next/prev buttons
+        if 'scrollingTable' in self.configDict.keys() and self.configDict['scrollingTable'] == True:
+            scrollingTable="""<script type="text/javascript">
+            var nextPageToken = $NEXT_PAGE_TOKEN;
+            var loadingPage = false;
+            $("#buttons input").hide();
+            $(window).scroll(function() {
+                if (nextPageToken === null || loadingPage) return;
+                if ($(window).scrollTop() + $(window).height() > $(document).height() - 400) {
+                    loadingPage = true;
+                    $.getJSON("$SCRIPT_NAME/tablePage", {pageToken: nextPageToken}, function(data) {
+                        $("#tableBody").append(data.rows);
+                        nextPageToken = data.nextPageToken;
+                        loadingPage = false;
+                    });
+                }
+            });
+            </script>
+            """
+            scrollingTable=scrollingTable.replace("$NEXT_PAGE_TOKEN", json_util.dumps(nextPageToken))
+            scrollingTable=scrollingTable.replace("$SCRIPT_NAME", cherrypy.request.script_name)
+        else:
+            scrollingTable=""
+        html=html.replace("$SCROLLING_TABLE", scrollingTable)
+        
         # Colour coding table key
         if len(usedBckColors) > 0:
             colorCoding="""<table frame=border cellspacing=0 cols=2 rules=all border=2 width=60% align=center>
@@ -2010,146 +2634,1539 @@ class SourceBrowser(object):
         return html    
 
 
-    @cherrypy.expose
-    @sourceryAuth.require()
-    def downloadCatalog(self, queryRADeg = "0:360", queryDecDeg = "-90:90", querySearchBoxArcmin = "",
-                        queryOtherConstraints = "", fileFormat = "cat", minimalColumnSet = "false"):
-        """Provide user with the current table view as a downloadable catalog.
+    def getDisplayColumns(self, queryOtherConstraints, coneSearch = False):
+        """Returns the list of columns to show in the table on the index page: the defaults (from 
+        tableDisplayColumns in the config file), plus any columns used in the constraints. For cone searches,
+        the distance from the search position is also shown.
         
         """
-
-        # Fetch the cached table and update that with any changed classifications info
-        cachedTabFileName=self.cacheDir+os.path.sep+"%s_xMatchedTable.fits" % (self.configDict['catalogDownloadFileName'])
-        xTab=atpy.Table().read(cachedTabFileName)
-
-        # Need this and change below for overloading with e.g. editable BCG coords
-        editableFieldsList=[]
-        for f in self.configDict['fields']:
-            editableFieldsList.append(f['name'])
-        for key in xTab.keys():
-            if key in editableFieldsList:
-                xTab.remove_column(key)
-        
-        # If minimal set of columns requested, delete all that aren't included
-        minimalCols=xTab.keys()
-        if minimalColumnSet == 'true':
-            if 'catalogDownloadMinimalColumns' in self.configDict.keys():
-                minimalCols=['sourceryID']
-                for keyStr in self.configDict['catalogDownloadMinimalColumns']:
-                    if keyStr[-1] != '_':
-                        minimalCols.append(keyStr)
-                    else:
-                        for col in xTab.keys():
-                            if col[:len(keyStr)] == keyStr:
-                                minimalCols.append(col)
-                for col in xTab.keys():
-                    if col not in minimalCols:
-                        xTab.remove_column(col)
-
-        # NOTE: there may be fun unicode-related stuff here: e.g., u'BCG_RADeg' versus 'BCG_RADeg'
-        keysList, typeNamesList, descriptionsList=self.getFieldNamesAndTypes(excludeKeys = [])
-        keysToAdd=['sourceryID', 'RADeg', 'decDeg', 'classification']
-        typeNamesToAdd=['text', 'number', 'number', 'text']
-        for k, t in zip(keysList, typeNamesList):
-            if k not in xTab.keys() and k not in keysToAdd and k in minimalCols:
-                keysToAdd.append(k)
-                typeNamesToAdd.append(t)
-            if k not in keysToAdd and k in editableFieldsList:
-                keysToAdd.append(k)
-                typeNamesToAdd.append(t)
-
-        # This part takes ~1 min for a catalog with 43k sources on laptop so is the only bit that needs speeding up
-        # The query part is 0.05 sec - it's the big for loop that is slow [i.e., converting from posts -> astropy table]
-        count=0
-        keepIndices=[]
-        posts, tabLength=self.runQuery(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
-        tab=atpy.Table()
-        tab.table_name=self.configDict['catalogDownloadFileName']
-        for key, typeName in zip(keysToAdd, typeNamesToAdd):
-            if typeName == 'number':
-                tab.add_column(atpy.Column(np.zeros(tabLength, dtype = np.float64), str(key)))
-            else:
-                tab.add_column(atpy.Column(np.zeros(tabLength, dtype = 'S1000'), str(key)))
-        for post in posts:
-            # Trim xTab to match posts based on sourceryID
-            if post['sourceryID'] in xTab['sourceryID']:
-                keepIndices.append(np.where(xTab['sourceryID'] == post['sourceryID'])[0][0])
-            for key in keysToAdd:
-                if key in post.keys():           # NOTE: this handles image_ tags, which are 1 if present, and absent otherwise
-                    tab[key][count]=post[key]
-            count=count+1
-        xTab=xTab[keepIndices]
-        tab.rename_column('RADeg', 'tag_RADeg')
-        tab.rename_column('decDeg', 'tag_decDeg')
-
-        tab=atpy.join(xTab, tab, keys = ['sourceryID'])
-        zapCols=['tag_RADeg', 'tag_decDeg', 'sourceryID', 'cacheBuilt']
-        for z in zapCols:
-            if z in tab.keys():
-                tab.remove_column(z)
-
-        # Zap any columns that this user shouldn't see
-        user=cherrypy.session['_sourcery_username']
-        for userNameKey in self.usersDict.keys():
-            userDict=self.usersDict[userNameKey]
-            if userNameKey == user and 'hiddenXMatchTables' in userDict.keys():
-                for prefix in userDict['hiddenXMatchTables']:
-                    colsToDelete=[]
-                    for key in tab.keys():
-                        if key.find(prefix) != -1 and key[:len(prefix)] == prefix:
-                            colsToDelete.append(key)
-                    tab.remove_columns(colsToDelete)
-
-        # Zap any columns that contain only sentinels
-        for key in tab.keys():
-            try:
-                if np.all(tab[key]) == -99:
-                    tab.remove_column(key)
-            except:
-                pass
-
-        tmpFile, tmpFileName=tempfile.mkstemp()
-        if fileFormat == 'cat':
-            tab.write(tmpFileName+".cat", format = 'ascii')
-        elif fileFormat == 'fits':
-            if len(tab.keys()) > 999:
-                raise Exception("FITS table format does not support 1000+ columns")
-            tab.write(tmpFileName+".fits", format = 'fits')
-        elif fileFormat == 'reg':
-            catalogTools.tab2DS9(tab, tmpFileName+".reg")
         
-        cherrypy.response.headers['Content-Disposition']='attachment; filename="%s.%s"' % (self.configDict['catalogDownloadFileName'], fileFormat)
-        
-        # This may not be the nicest thing to do... but seems to work
-        f=open(tmpFileName+"."+fileFormat, 'rb')
+        columnsShownList=[]
+        for colDict in self.tableDisplayColumns:
+            if colDict['name'] not in columnsShownList:
+                columnsShownList.append(colDict['name'])
+        displayColumns=[]+self.tableDisplayColumns
+        if coneSearch == True:
+            displayColumns.append({'name': 'distanceArcmin', 'label': 'Distance (arcmin)', 'fmt': '%.2f'})
+        keysList, typeNamesList, descList=self.getFieldNamesAndTypes()
+        for colName in queryTools.getConstraintsColumns(queryOtherConstraints):
+            if colName in keysList and colName not in columnsShownList:# and colName not in columnsHiddenList:
+                typeName=typeNamesList[keysList.index(colName)]
+                dispDict={'name': colName, 'label': colName}
+                if typeName == 'number':
+                    dispDict['fmt']='%.3f'
+                elif typeName == 'text':
+                    dispDict['fmt']='%s'
+                else:
+                    raise Exception("unknown type for field '%s'" % (colName))
+                displayColumns.append(dispDict)
+                columnsShownList.append(colName)
         
-        return f
+        return displayColumns
     
     
-    @cherrypy.expose
-    @sourceryAuth.require()
-    def downloadThumbnailFITS(self, sourceryID):
-        """Returns .fits image for download by the user.
+    def makeTableProjection(self, displayColumns):
+        """Returns the MongoDB projection for fetching the posts shown in the table on the index page - i.e., 
+        only the given columns (see getDisplayColumns), plus the fields needed for links and paging. 
         
         """
-        obj=self.sourceCollection.find_one({'sourceryID': sourceryID})
-        RADeg=obj['RADeg']
-        decDeg=obj['decDeg']
-        subDir=str(RADeg).split(".")[0]
-        imgPath=self.cacheDir+os.path.sep+self.configDict['downloadableFITS']+os.path.sep+subDir+os.path.sep+catalogTools.makeRADecString(RADeg, decDeg)+".fits"
-        #imgPath=self.cacheDir+os.path.sep+self.configDict['downloadableFITS']+os.path.sep+catalogTools.makeRADecString(obj['RADeg'], obj['decDeg'])+".fits"
-        cherrypy.response.headers['Content-Disposition']='attachment; filename="%s.%s"' % (obj['name'].replace(" ", "_"), 'fits')
-        f=open(imgPath, 'rb')
-        
-        return f
         
+        projection={'_id': 1, 'sourceryID': 1, 'name': 1, self.tableSortKey: 1}
+        for colDict in displayColumns:
+            projection[colDict['name']]=1
         
-    def sourceNameToURL(self, name):
-        """Replaces + and spaces in source names so that they will be valid URLs.
+        return projection
+    
+    
+    def makeCellRenderer(self, colDict):
+        """Returns a function that, given a post, returns the HTML for its cell in the given column of the 
+        table on the index page (colDict is an entry in the list from getDisplayColumns). Everything that 
+        doesn't depend on the post (alignment, widths, links, the cell template) is worked out here, once.
         
         """
-        return name.replace("+", "%2B").replace(" ", "%20").replace(":", "%3A")
-
+        
+        key=colDict['name']
+        fmt=colDict['fmt']
+        if 'tableAlign' in colDict.keys():
+            alignStr=colDict['tableAlign']
+        else:
+            alignStr="center"
+        if 'displaySize' in colDict.keys():
+            widthStr='width: %dem;' % (colDict['displaySize'])
+            cellTemplate="   <td style='background-color: white; "+widthStr+"' align="+alignStr+">" \
+                         +'<div style="text-overflow: ellipsis; white-space: nowrap; overflow: hidden; '+widthStr+'">' \
+                         +"%s</div>\n</td>\n"
+        elif fmt == '%s':
+            cellTemplate=None # width depends on the value
+        else:
+            cellTemplate="   <td style='background-color: white; width: %dem;' align=%s>" % (len(fmt % (1)), alignStr)+"%s</td>\n"
+        if fmt != '%s':
+            missingValue=0.0 # No entry in MongoDB tags yet
+        else:
+            missingValue=""
+        linkSuffix="&clipSizeArcmin=%.2f" % (self.configDict['defaultViewSizeArcmin'])
+        if 'defaultImageType' in self.configDict.keys():
+            linkSuffix=linkSuffix+"&imageType=%s" % (self.configDict['defaultImageType'])
+        nedLinkTemplate="http://ned.ipac.caltech.edu/cgi-bin/objsearch?objname=%s&extend=no&hconst=73&omegam=0.27&omegav=0.73&corr_z=1&out_csys=Equatorial&out_equinox=J2000.0&obj_sort=RA+or+Longitude&of=pre_text&zv_breaker=30000.0&list_limit=5&img_stamp=YES"
+        
+        def formatValue(obj):
+            value=obj.get(key, missingValue)
+            if key == "name":
+                linkURL="displaySourcePage?sourceryID=%s" % (self.sourceNameToURL(obj['sourceryID']))+linkSuffix
+                return "<a href=\"%s\" target=new>%s</a>" % (linkURL, value)
+            elif key == "NED_name" and value != "None":
+                return "<a href=%s>%s</a>" % (nedLinkTemplate % (value.replace("+", "%2B").replace(" ", "+")), value)
+            elif key == "NED_z" and value == "nan":
+                return "-"
+            try:
+                return fmt % (value)
+            except:
+                raise Exception("could not format value '%s' of column '%s' with '%s' - check tableDisplayColumns in the config file" % (str(value), key, fmt))
+        
+        if cellTemplate is not None:
+            def renderCell(obj):
+                return cellTemplate % (formatValue(obj))
+        else:
+            def renderCell(obj):
+                value=obj.get(key, None)
+                if type(value) == str:
+                    widthStr='width: %dem;' % (len(value))
+                else:
+                    widthStr=""
+                return "   <td style='background-color: white; %s' align=%s>%s</td>\n" % (widthStr, alignStr, formatValue(obj))
+        
+        return renderCell
+    
+    
+    def getCellRenderer(self, colDict):
+        """Returns the cell renderer (see makeCellRenderer) for the given column. Renderers are made once and 
+        kept (those for the default columns are made at start up).
+        
+        """
+        
+        rendererKey=repr(sorted(colDict.items()))
+        if rendererKey not in self.cellRenderers.keys():
+            self.cellRenderers[rendererKey]=self.makeCellRenderer(colDict)
+        
+        return self.cellRenderers[rendererKey]
+    
+    
+    def renderTableRows(self, viewPosts, displayColumns):
+        """Returns the HTML for the rows of the table on the index page, for the given posts and columns
+        (see getDisplayColumns). Each cell is rendered by a pre-built renderer for its column (see 
+        makeCellRenderer), so the cost is linear in the number of rows and columns.
+        
+        """
+        
+        cellRenderers=[self.getCellRenderer(colDict) for colDict in displayColumns]
+        rows=[]
+        for obj in viewPosts:
+            rows.append("<tr>\n"+"".join([renderCell(obj) for renderCell in cellRenderers])+"</tr>\n")
+        
+        return "".join(rows)
+
+
+    def countQuery(self, queryDict):
+        """Returns the number of objects in sourceCollection matching the given MongoDB query. Counts are
+        cached (per process), keyed on the canonicalized query (which includes any hidden constraints for
+        the user) and the data generation (see getGeneration), so paging through a result never recounts it
+        (and, as the generation is cached too, usually doesn't go to MongoDB at all).
+        
+        """
+        
+        cacheKey=json_util.dumps(queryDict, sort_keys = True)
+        generation=self.getGeneration()
+        with self.countCacheLock:
+            if cacheKey in self.countCache.keys() and self.countCache[cacheKey][0] == generation:
+                self.countCache.move_to_end(cacheKey)
+                return self.countCache[cacheKey][1]
+        numPosts=self.sourceCollection.count_documents(queryDict, **self.getQueryTimeOptions())
+        with self.countCacheLock:
+            self.countCache[cacheKey]=(generation, numPosts)
+            self.countCache.move_to_end(cacheKey)
+            while len(self.countCache) > self.countCacheSize:
+                self.countCache.popitem(last = False)
+        
+        return numPosts
+    
+    
+    def getTotalCount(self):
+        """Returns the total number of objects in sourceCollection (cached until the data generation 
+        changes).
+        
+        """
+        
+        generation=self.getGeneration()
+        with self.countCacheLock:
+            if self.totalCount is not None and self.totalCount[0] == generation:
+                return self.totalCount[1]
+        numPosts=self.sourceCollection.estimated_document_count()
+        with self.countCacheLock:
+            self.totalCount=(generation, numPosts)
+        
+        return numPosts
+
+
+    def fetchTablePage(self, queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints, 
+                       pageToken = None, numRows = None, projection = None, sortByDistance = False,
+                       sortKey = None, sortDirection = None):
+        """Fetches a page of rows for the table on the index page, using keyset pagination (see queryTools),
+        so that every page costs the same however deep into the table it is. quickLinks queries are paged
+        using offsets into the materialized results instead (which is also cheap).
+        
+        Args:
+            queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints: Query parameters.
+            pageToken (str, optional): Opaque page token (from a previous call), or None for the first page.
+            numRows (int, optional): Number of rows per page. Defaults to self.tableViewRows.
+            projection (dict, optional): MongoDB projection (e.g., from makeTableProjection), for fetching 
+                only the fields needed. If None, whole posts are returned.
+            sortByDistance (bool, optional): For cone searches, if True, sort by distance from the search
+                position (using $geoNear) rather than by RA.
+            sortKey (str, optional): Column to sort on (one of self.sortableColumns). Defaults to 
+                self.tableSortKey.
+            sortDirection (int, optional): pymongo.ASCENDING or pymongo.DESCENDING. Defaults to
+                self.tableSortDirection.
+        
+        For cone searches, distanceArcmin is added to each post.
+        
+        Returns:
+            List of posts, page token for the previous page, page token for the next page (these are None
+            if there is no previous/next page).
+        
+        """
+        
+        if numRows is None:
+            numRows=self.tableViewRows
+        if sortKey is None:
+            sortKey=self.tableSortKey
+        if sortDirection is None:
+            sortDirection=self.tableSortDirection
+        if sortKey not in self.sortableColumns:
+            raise Exception("can't sort on column '%s' - sortable columns are: %s" % (sortKey, ", ".join(self.sortableColumns)))
+        if sortDirection not in [pymongo.ASCENDING, pymongo.DESCENDING]:
+            raise Exception("sortDirection should be 1 or -1")
+        if projection is not None:
+            projection=dict(projection)
+            projection['_id']=1
+            projection[sortKey]=1
+            projection['RADeg']=1
+            projection['decDeg']=1
+        coneSearch=self.getConeSearchParams(queryRADeg, queryDecDeg, querySearchBoxArcmin)
+        if coneSearch is not None and sortByDistance == True:
+            sortKey='distanceArcmin'
+        tokenDict=queryTools.decodePageToken(pageToken)
+        if tokenDict is not None and (tokenDict.get('sortKey') != sortKey or tokenDict.get('sortDirection', self.tableSortDirection) != sortDirection):
+            tokenDict=None
+        
+        # Cone search sorted by distance - $geoNear gives us the distances, and pages are offsets (cone 
+        # search results are small, so that's cheap enough)
+        if sortKey == 'distanceArcmin':
+            offset=0
+            if tokenDict is not None and 'offset' in tokenDict.keys():
+                offset=max(int(tokenDict['offset']), 0)
+            RADeg, decDeg, radiusArcmin=coneSearch
+            arcminPerMetre=np.degrees(1.0/catalogTools.MONGODB_SPHERE_RADIUS_M)*60.0
+            pipeline=[{'$geoNear': {'near': catalogTools.RADecToGeoJSON(RADeg, decDeg), 'key': 'skyLoc', 
+                                    'distanceField': 'distanceArcmin', 'distanceMultiplier': arcminPerMetre,
+                                    'maxDistance': np.radians(radiusArcmin/60.0)*catalogTools.MONGODB_SPHERE_RADIUS_M,
+                                    'spherical': True, 
+                                    'query': self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, 
+                                                                queryOtherConstraints, applyPosition = False)}},
+                      {'$skip': offset}, {'$limit': numRows+1}]
+            if projection is not None:
+                projection['distanceArcmin']=1
+                pipeline.append({'$project': projection})
+            viewPosts=list(self.sourceCollection.aggregate(pipeline, **self.getQueryTimeOptions()))
+            prevPageToken=None
+            nextPageToken=None
+            if offset > 0:
+                prevPageToken=queryTools.encodePageToken({'offset': max(offset-numRows, 0), 'sortKey': sortKey, 'sortDirection': sortDirection})
+            if len(viewPosts) > numRows:
+                nextPageToken=queryTools.encodePageToken({'offset': offset+numRows, 'sortKey': sortKey, 'sortDirection': sortDirection})
+            viewPosts=viewPosts[:numRows]
+            self.restoreSentinels(viewPosts, projection)
+            return viewPosts, prevPageToken, nextPageToken
+        
+        # Materialized results (in the default sort order) - just slice the list of IDs
+        quickLinkResult=None
+        if sortKey == self.tableSortKey and sortDirection == self.tableSortDirection:
+            quickLinkResult=self.getQuickLinkResult(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+        if quickLinkResult is not None:
+            offset=0
+            if tokenDict is not None and 'offset' in tokenDict.keys():
+                offset=min(max(int(tokenDict['offset']), 0), max(quickLinkResult['count']-numRows, 0))
+            viewPosts=self.fetchPostsByIDs(quickLinkResult['sourceryIDs'][offset:offset+numRows], projection = projection)
+            prevPageToken=None
+            nextPageToken=None
+            if offset > 0:
+                prevPageToken=queryTools.encodePageToken({'offset': max(offset-numRows, 0), 'sortKey': sortKey, 'sortDirection': sortDirection})
+            if offset+numRows < quickLinkResult['count']:
+                nextPageToken=queryTools.encodePageToken({'offset': offset+numRows, 'sortKey': sortKey, 'sortDirection': sortDirection})
+            self.restoreSentinels(viewPosts, projection)
+            return viewPosts, prevPageToken, nextPageToken
+        
+        # Keyset pagination
+        queryDict=self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+        reverse=False
+        if tokenDict is None or 'offset' in tokenDict.keys():
+            tokenDict=None
+            sortSpec=[(sortKey, sortDirection), ('_id', sortDirection)]
+        else:
+            queryDict, sortSpec=queryTools.makeKeysetQuery(queryDict, sortKey, sortDirection, tokenDict)
+            reverse='before' in tokenDict.keys()
+        viewPosts=list(self.sourceCollection.find(queryDict, projection).sort(sortSpec).limit(numRows+1).max_time_ms(self.getQueryTimeLimitMS()))
+        hasMore=len(viewPosts) > numRows
+        viewPosts=viewPosts[:numRows]
+        if tokenDict is not None and (len(viewPosts) == 0 or (reverse == True and hasMore == False)):
+            # Ran off either end (e.g., the data changed under us) - go back to the first page
+            return self.fetchTablePage(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints, 
+                                       numRows = numRows, projection = projection, sortByDistance = sortByDistance,
+                                       sortKey = sortKey, sortDirection = sortDirection)
+        if reverse == True:
+            viewPosts.reverse()
+        if coneSearch is not None:
+            self.addDistanceColumn(viewPosts, coneSearch[0], coneSearch[1])
+        prevPageToken=None
+        nextPageToken=None
+        if len(viewPosts) > 0:
+            if tokenDict is not None:
+                prevPageToken=queryTools.makeRowPageToken(viewPosts[0], sortKey, 'before', sortDirection = sortDirection)
+            if hasMore == True or reverse == True:
+                nextPageToken=queryTools.makeRowPageToken(viewPosts[-1], sortKey, 'after', sortDirection = sortDirection)
+        self.restoreSentinels(viewPosts, projection)
+        
+        return viewPosts, prevPageToken, nextPageToken
+    
+    
+    @cherrypy.expose
+    @sourceryAuth.require()
+    @cherrypy.tools.json_out()
+    @queryTimeLimit('interactive')
+    def tablePage(self, pageToken = None):
+        """Returns a page of the table on the index page (for the current query) as JSON, for the optional
+        scrolling table. The result has keys rows (HTML), prevPageToken, nextPageToken.
+        
+        """
+        
+        if not cherrypy.session.loaded: cherrypy.session.load()
+        queryRADeg=cherrypy.session.get('queryRADeg', "0:360")
+        queryDecDeg=cherrypy.session.get('queryDecDeg', "-90:90")
+        querySearchBoxArcmin=cherrypy.session.get('querySearchBoxArcmin', "")
+        queryOtherConstraints=cherrypy.session.get('queryOtherConstraints', "")
+        try:
+            queryTools.decodePageToken(pageToken)
+        except Exception as e:
+            raise cherrypy.HTTPError(400, str(e))
+        querySortByDistance=cherrypy.session.get('querySortByDistance', False)
+        querySortKey=cherrypy.session.get('querySortKey', None)
+        querySortDirection=cherrypy.session.get('querySortDirection', None)
+        if querySortKey not in self.sortableColumns:
+            querySortKey=None
+            querySortDirection=None
+        coneSearch=self.getConeSearchParams(queryRADeg, queryDecDeg, querySearchBoxArcmin) is not None
+        displayColumns=self.getDisplayColumns(queryOtherConstraints, coneSearch = coneSearch)
+        viewPosts, prevPageToken, nextPageToken=self.fetchTablePage(queryRADeg, queryDecDeg, querySearchBoxArcmin, 
+                                                                    queryOtherConstraints, pageToken = pageToken,
+                                                                    projection = self.makeTableProjection(displayColumns),
+                                                                    sortByDistance = querySortByDistance,
+                                                                    sortKey = querySortKey, sortDirection = querySortDirection)
+        
+        return {'rows': self.renderTableRows(viewPosts, displayColumns), 'prevPageToken': prevPageToken,
+                'nextPageToken': nextPageToken}
+
+
+    def getAPIFields(self, fields, queryOtherConstraints = ""):
+        """Returns the list of fields returned by the JSON query API (see queryJSON), for the given 
+        comma-separated list of field names (fields). If fields is blank, the columns shown in the table 
+        view are used; if it is '*', all fields are returned. Columns hidden from the current user are 
+        never returned. Raises cherrypy.HTTPError for unknown fields.
+        
+        """
+        
+        keysList, typeNamesList, descList=self.getFieldNamesAndTypes()
+        allFields=['sourceryID', 'name', 'RADeg', 'decDeg']
+        for key in keysList:
+            if key not in allFields:
+                allFields.append(key)
+        if fields.strip() == "":
+            fieldsList=['sourceryID']+[c['name'] for c in self.getDisplayColumns(queryOtherConstraints)]
+        elif fields.strip() == "*":
+            fieldsList=allFields
+        else:
+            fieldsList=[f.strip() for f in fields.split(",") if f.strip() != ""]
+        outFields=[]
+        for key in fieldsList:
+            if key not in allFields or self.isHiddenColumn(key) == True:
+                raise cherrypy.HTTPError(400, "Unknown field '%s'" % (key))
+            if key not in outFields:
+                outFields.append(key)
+        
+        return outFields
+    
+    
+    def postToJSONDict(self, post, fieldsList):
+        """Returns a dictionary of the given fields of a MongoDB post, ready for converting to JSON. Missing
+        fields (e.g., tags that haven't been set) and NaNs become None.
+        
+        """
+        
+        row={}
+        for key in fieldsList:
+            value=post.get(key, None)
+            if type(value) == float and np.isnan(value):
+                value=None
+            row[key]=value
+        
+        return row
+    
+    
+    @cherrypy.expose
+    @sourceryAuth.require()
+    @queryTimeLimit('api')
+    def queryJSON(self, queryRADeg = "0:360", queryDecDeg = "-90:90", querySearchBoxArcmin = "", 
+                  queryOtherConstraints = "", fields = "", numRows = "100", pageToken = None, sortByDistance = "false",
+                  sortKey = None, sortDescending = "false"):
+        """Read-only query API: returns a page of query results as JSON. Takes the same query parameters and
+        constraints as the index page (and applies any hidden constraints for the user).
+        
+        Args:
+            fields (str): Comma-separated list of fields to return (see getAPIFields).
+            numRows (str): Number of rows per page (maximum 10000).
+            pageToken (str): Token for fetching the next/previous page (from a previous call).
+            sortByDistance (str): For cone searches, if 'true', sort by distance from the search position.
+            sortKey (str): Column to sort on (one of the sortableColumns; RADeg by default).
+            sortDescending (str): If 'true', sort in descending order.
+        
+        Returns:
+            JSON object with keys count (total number of matches), fields, rows (list of objects), 
+            prevPageToken and nextPageToken (these are null if there is no previous/next page).
+        
+        """
+        
+        try:
+            numRows=min(max(int(numRows), 1), 10000)
+            queryTools.decodePageToken(pageToken)
+            queryDict=self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+        except Exception as e:
+            raise cherrypy.HTTPError(400, "Invalid query: %s" % (str(e)))
+        fieldsList=self.getAPIFields(fields, queryOtherConstraints = queryOtherConstraints)
+        projection={}
+        for key in fieldsList:
+            projection[key]=1
+        if sortKey is not None and sortKey not in self.sortableColumns:
+            raise cherrypy.HTTPError(400, "Can't sort on column '%s' - sortable columns are: %s" % (sortKey, ", ".join(self.sortableColumns)))
+        if sortDescending == "true":
+            sortDirection=pymongo.DESCENDING
+        else:
+            sortDirection=pymongo.ASCENDING
+        posts, prevPageToken, nextPageToken=self.fetchTablePage(queryRADeg, queryDecDeg, querySearchBoxArcmin, 
+                                                                queryOtherConstraints, pageToken = pageToken, 
+                                                                numRows = numRows, projection = projection,
+                                                                sortByDistance = (sortByDistance == "true"),
+                                                                sortKey = sortKey, sortDirection = sortDirection)
+        if self.getConeSearchParams(queryRADeg, queryDecDeg, querySearchBoxArcmin) is not None:
+            fieldsList=fieldsList+['distanceArcmin']
+        result={'count': self.countQuery(queryDict), 'fields': fieldsList, 
+                'rows': [self.postToJSONDict(post, fieldsList) for post in posts],
+                'prevPageToken': prevPageToken, 'nextPageToken': nextPageToken}
+        cherrypy.response.headers['Content-Type']='application/json'
+        
+        return json_util.dumps(result).encode('utf-8')
+    
+    
+    @cherrypy.expose
+    @sourceryAuth.require()
+    @cherrypy.config(**{'response.stream': True})
+    @queryTimeLimit('download')
+    def queryNDJSON(self, queryRADeg = "0:360", queryDecDeg = "-90:90", querySearchBoxArcmin = "", 
+                    queryOtherConstraints = "", fields = ""):
+        """Read-only query API: streams all query results as newline-delimited JSON (one object per line),
+        for large results. Takes the same parameters as queryJSON (apart from those for paging).
+        
+        """
+        
+        try:
+            self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+        except Exception as e:
+            raise cherrypy.HTTPError(400, "Invalid query: %s" % (str(e)))
+        fieldsList=self.getAPIFields(fields, queryOtherConstraints = queryOtherConstraints)
+        projection={'_id': 0}
+        for key in fieldsList:
+            projection[key]=1
+        queryPosts, numPosts=self.runQuery(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints,
+                                           projection = projection)
+        queryPosts=queryPosts.batch_size(self.downloadChunkRows)
+        
+        def iterLines():
+            try:
+                lines=[]
+                for post in queryPosts:
+                    self.restoreSentinels([post], projection)
+                    lines.append(json_util.dumps(self.postToJSONDict(post, fieldsList))+"\n")
+                    if len(lines) == self.downloadChunkRows:
+                        yield "".join(lines).encode('utf-8')
+                        lines=[]
+                if len(lines) > 0:
+                    yield "".join(lines).encode('utf-8')
+            except pymongo.errors.ExecutionTimeout as e:
+                logger.warning("queryNDJSON query ran over time limit: %s" % (str(e)))
+                raise e
+            finally:
+                queryPosts.close()
+        
+        cherrypy.response.headers['Content-Type']='application/x-ndjson'
+        
+        return iterLines()
+    
+    
+    def getCachedSummary(self, cacheKey, makeSummary):
+        """Returns the summary for cacheKey from the summary cache, or calls makeSummary() to make it (and 
+        caches it). As with countQuery, entries are dropped when the data generation changes, and the least 
+        recently used entries are dropped when the cache is full. cacheKey should include the canonicalized
+        query (as made by json_util.dumps(queryDict, sort_keys = True)), so that it includes any hidden 
+        constraints for the user.
+        
+        """
+        
+        generation=self.getGeneration()
+        with self.summaryCacheLock:
+            if cacheKey in self.summaryCache.keys() and self.summaryCache[cacheKey][0] == generation:
+                self.summaryCache.move_to_end(cacheKey)
+                return self.summaryCache[cacheKey][1]
+        summary=makeSummary()
+        with self.summaryCacheLock:
+            self.summaryCache[cacheKey]=(generation, summary)
+            self.summaryCache.move_to_end(cacheKey)
+            while len(self.summaryCache) > self.summaryCacheSize:
+                self.summaryCache.popitem(last = False)
+        
+        return summary
+    
+    
+    def summarizeColumn(self, queryDict, key, numBins = 20, numTopValues = 20):
+        """Computes summary statistics for column key, over the objects matching queryDict, using MongoDB
+        aggregation pipelines (so only the summary comes back from the database). Sentinel values are left 
+        out, as in catalogTools.computeColumnStats.
+        
+        Returns a dictionary with keys name, type and count, plus (for number columns) min, max, mean, std, 
+        and histogram (a dictionary with keys edges and counts), or (for text columns) numDistinct and 
+        topValues (a list of [value, count] pairs, most common first).
+        
+        """
+        
+        fieldType=self.getConstraintFieldTypes()[key]
+        if fieldType == 'number':
+            goodQuery={key: {'$gt': float('-inf'), '$lt': float('inf'), '$ne': -99}}
+        else:
+            goodQuery={key: {'$nin': ["", "None", "-99"], '$exists': True}}
+        matchDict=queryTools.combineQueries([queryDict, goodQuery])
+        summary={'name': key, 'type': fieldType, 'count': 0}
+        aggregateOptions=self.getQueryTimeOptions()
+        indexHint=self.chooseIndexHint(matchDict)
+        if indexHint is not None:
+            aggregateOptions['hint']=indexHint
+        
+        if fieldType == 'number':
+            pipeline=[{'$match': matchDict},
+                      {'$group': {'_id': None, 'count': {'$sum': 1}, 'min': {'$min': '$'+key}, 'max': {'$max': '$'+key},
+                                  'mean': {'$avg': '$'+key}, 'std': {'$stdDevPop': '$'+key}}}]
+            result=list(self.sourceCollection.aggregate(pipeline, **aggregateOptions))
+            if len(result) == 0:
+                return summary
+            for stat in ['count', 'min', 'max', 'mean', 'std']:
+                summary[stat]=result[0][stat]
+            # $bucket boundaries must be increasing, and the upper one is exclusive - values equal to max 
+            # land in the default bucket, which we add to the last bin
+            if summary['max'] > summary['min']:
+                edges=np.linspace(summary['min'], summary['max'], numBins+1)
+            else:
+                edges=np.array([summary['min'], summary['min']+1])
+            pipeline=[{'$match': matchDict},
+                      {'$bucket': {'groupBy': '$'+key, 'boundaries': [float(e) for e in edges],
+                                   'default': 'upper', 'output': {'count': {'$sum': 1}}}}]
+            counts=np.zeros(len(edges)-1, dtype = int)
+            for bucket in self.sourceCollection.aggregate(pipeline, **aggregateOptions):
+                if bucket['_id'] == 'upper':
+                    counts[-1]=counts[-1]+bucket['count']
+                else:
+                    counts[min(np.searchsorted(edges, bucket['_id'], side = 'right')-1, len(counts)-1)]=bucket['count']
+            summary['histogram']={'edges': [float(e) for e in edges], 'counts': [int(c) for c in counts]}
+        else:
+            pipeline=[{'$match': matchDict},
+                      {'$group': {'_id': '$'+key, 'count': {'$sum': 1}}},
+                      {'$facet': {'topValues': [{'$sort': SON([('count', pymongo.DESCENDING), ('_id', pymongo.ASCENDING)])}, 
+                                                {'$limit': numTopValues}],
+                                  'totals': [{'$group': {'_id': None, 'count': {'$sum': '$count'}, 'numDistinct': {'$sum': 1}}}]}}]
+            result=list(self.sourceCollection.aggregate(pipeline, **aggregateOptions))[0]
+            if len(result['totals']) == 0:
+                return summary
+            summary['count']=result['totals'][0]['count']
+            summary['numDistinct']=result['totals'][0]['numDistinct']
+            summary['topValues']=[[str(v['_id']), v['count']] for v in result['topValues']]
+        
+        return summary
+    
+    
+    def getQuerySummary(self, queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints, columns, numBins):
+        """Returns a dictionary of column summaries (see summarizeColumn) for the given query (with hidden 
+        constraints applied), the list of columns, and the query, for queryStats and queryStatsPlot. Raises 
+        cherrypy.HTTPError for invalid queries or columns.
+        
+        """
+        
+        try:
+            numBins=min(max(int(numBins), 1), 200)
+            queryDict=self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+        except Exception as e:
+            raise cherrypy.HTTPError(400, "Invalid query: %s" % (str(e)))
+        columnsList=[c.strip() for c in columns.split(",") if c.strip() != ""]
+        if len(columnsList) == 0:
+            raise cherrypy.HTTPError(400, "No columns given")
+        constraintFieldTypes=self.getConstraintFieldTypes()
+        for key in columnsList:
+            if key not in constraintFieldTypes.keys() or self.isHiddenColumn(key) == True:
+                raise cherrypy.HTTPError(400, "Unknown column '%s'" % (key))
+        
+        queryKey=json_util.dumps(queryDict, sort_keys = True)
+        summaries={}
+        for key in columnsList:
+            summaries[key]=self.getCachedSummary(('stats', queryKey, key, numBins), 
+                                                 lambda: self.summarizeColumn(queryDict, key, numBins = numBins))
+        
+        return summaries, columnsList, queryDict
+    
+    
+    @cherrypy.expose
+    @sourceryAuth.require()
+    @queryTimeLimit('api')
+    def queryStats(self, queryRADeg = "0:360", queryDecDeg = "-90:90", querySearchBoxArcmin = "", 
+                   queryOtherConstraints = "", columns = "", numBins = "20"):
+        """Read-only query API: returns summary statistics and histograms (for number columns) or the most
+        common values (for text columns) for the given comma-separated list of columns, over the objects
+        matching the query, as JSON. Takes the same query parameters and constraints as the index page (and 
+        applies any hidden constraints for the user). See summarizeColumn for what is returned for each 
+        column.
+        
+        Returns:
+            JSON object with keys count (total number of matches) and columns (list of column summaries).
+        
+        """
+        
+        summaries, columnsList, queryDict=self.getQuerySummary(queryRADeg, queryDecDeg, querySearchBoxArcmin, 
+                                                               queryOtherConstraints, columns, numBins)
+        result={'count': self.countQuery(queryDict), 'columns': [summaries[key] for key in columnsList]}
+        cherrypy.response.headers['Content-Type']='application/json'
+        
+        return json_util.dumps(result).encode('utf-8')
+    
+    
+    @cherrypy.expose
+    @sourceryAuth.require()
+    @queryTimeLimit('api')
+    def queryStatsPlot(self, queryRADeg = "0:360", queryDecDeg = "-90:90", querySearchBoxArcmin = "", 
+                       queryOtherConstraints = "", columns = "", numBins = "20"):
+        """Returns a small PNG plot of the histogram (number columns) or most common values (text columns) 
+        of the given column (columns should name just one), over the objects matching the query (see 
+        queryStats). Plots are cached.
+        
+        """
+        
+        summaries, columnsList, queryDict=self.getQuerySummary(queryRADeg, queryDecDeg, querySearchBoxArcmin, 
+                                                               queryOtherConstraints, columns, numBins)
+        if len(columnsList) != 1:
+            raise cherrypy.HTTPError(400, "Give a single column to plot")
+        summary=summaries[columnsList[0]]
+        
+        def makePlot():
+            plt.figure(figsize = (6, 4))
+            if summary['count'] == 0:
+                plt.text(0.5, 0.5, "No values", ha = 'center', va = 'center')
+                plt.axis('off')
+            elif summary['type'] == 'number':
+                edges=np.array(summary['histogram']['edges'])
+                plt.bar(edges[:-1], summary['histogram']['counts'], width = np.diff(edges), align = 'edge',
+                        color = 'gray', edgecolor = 'black')
+                plt.xlabel(summary['name'])
+                plt.ylabel("N")
+            else:
+                labels=[v[0][:20] for v in summary['topValues']][::-1]
+                plt.barh(np.arange(len(labels)), [v[1] for v in summary['topValues']][::-1], color = 'gray',
+                         edgecolor = 'black', tick_label = labels)
+                plt.xlabel("N")
+                plt.title(summary['name'])
+            plt.tight_layout()
+            buf=BytesIO()
+            plt.savefig(buf, dpi = 72, format = 'png')
+            plt.close()
+            return buf.getvalue()
+        
+        png=self.getCachedSummary(('plot', json_util.dumps(queryDict, sort_keys = True), columnsList[0], numBins), makePlot)
+        cherrypy.response.headers['Content-Type']="image/png"
+        
+        return png
+    
+    
+    def countHEALPixels(self, queryDict, nside):
+        """Returns an array of the number of objects matching queryDict in each HEALPix pixel (NESTED 
+        ordering) at resolution nside, which must be a power of 2 no bigger than the resolution of the 
+        healpixPixel field. This is a group-by on the (indexed) healpixPixel field, so only the counts come
+        back from the database.
+        
+        """
+        
+        factor=(self.getSchema()['skyMapNside']//nside)**2
+        if factor == 1:
+            pixelExpr='$healpixPixel'
+        else:
+            pixelExpr={'$floor': {'$divide': ['$healpixPixel', factor]}}
+        pipeline=[{'$match': queryDict}, {'$group': {'_id': pixelExpr, 'count': {'$sum': 1}}}]
+        aggregateOptions=self.getQueryTimeOptions()
+        indexHint=self.chooseIndexHint(queryDict)
+        if indexHint is not None:
+            aggregateOptions['hint']=indexHint
+        counts=np.zeros(12*nside*nside, dtype = np.int64)
+        for pixelDict in self.sourceCollection.aggregate(pipeline, **aggregateOptions):
+            if pixelDict['_id'] is not None:
+                counts[int(pixelDict['_id'])]=pixelDict['count']
+        
+        return counts
+    
+    
+    @cherrypy.expose
+    @sourceryAuth.require()
+    @queryTimeLimit('api')
+    def skyDensityMap(self, queryRADeg = "0:360", queryDecDeg = "-90:90", querySearchBoxArcmin = "", 
+                      queryOtherConstraints = "", nside = "", fileFormat = "png"):
+        """Returns the sky distribution of the objects matching the query (with hidden constraints applied) 
+        as a Mollweide projection PNG (fileFormat = 'png'), or as JSON (fileFormat = 'json'; an object with 
+        keys nside, nest and pixels - a list of [pixel, count] pairs for non-empty pixels). nside is the 
+        HEALPix resolution (a power of 2, no bigger than skyMapNside; defaults to skyMapNside, or 16 for 
+        the PNG, which gives pixels of about 3.7 degrees). Results are cached. Needs healpy.
+        
+        """
+        
+        maxNside=self.getSchema()['skyMapNside']
+        if catalogTools.hp is None or maxNside is None:
+            raise cherrypy.HTTPError(400, "Sky density maps are not available on this server (needs healpy)")
+        if fileFormat not in ['png', 'json']:
+            raise cherrypy.HTTPError(400, "fileFormat should be 'png' or 'json'")
+        try:
+            if nside == "":
+                if fileFormat == 'png':
+                    nside=min(16, maxNside)
+                else:
+                    nside=maxNside
+            nside=int(nside)
+            queryDict=self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+        except Exception as e:
+            raise cherrypy.HTTPError(400, "Invalid query: %s" % (str(e)))
+        if nside < 1 or nside > maxNside or (nside & (nside-1)) != 0:
+            raise cherrypy.HTTPError(400, "nside should be a power of 2, no bigger than %d" % (maxNside))
+        queryKey=json_util.dumps(queryDict, sort_keys = True)
+        
+        if fileFormat == 'json':
+            def makeJSON():
+                counts=self.countHEALPixels(queryDict, nside)
+                pixels=np.flatnonzero(counts)
+                return json_util.dumps({'nside': nside, 'nest': True, 
+                                        'pixels': [[int(p), int(counts[p])] for p in pixels]}).encode('utf-8')
+            cherrypy.response.headers['Content-Type']='application/json'
+            return self.getCachedSummary(('skyMap', queryKey, nside, fileFormat), makeJSON)
+        
+        def makePlot():
+            counts=np.array(self.countHEALPixels(queryDict, nside), dtype = np.float64)
+            counts[counts == 0]=catalogTools.hp.UNSEEN
+            fig=plt.figure(figsize = (8, 5))
+            catalogTools.hp.mollview(counts, nest = True, fig = fig.number, title = "", unit = "N per pixel", 
+                                     cmap = 'viridis', badcolor = 'white', bgcolor = 'white')
+            catalogTools.hp.graticule(dpar = 30, dmer = 60, alpha = 0.3)
+            buf=BytesIO()
+            plt.savefig(buf, dpi = 72, format = 'png')
+            plt.close(fig)
+            return buf.getvalue()
+        
+        cherrypy.response.headers['Content-Type']="image/png"
+        
+        return self.getCachedSummary(('skyMap', queryKey, nside, fileFormat), makePlot)
+    
+    
+    def makeDownloadPlan(self, minimalColumnSet = "false"):
+        """Works out which columns go into a downloaded catalog, and where they come from (the cached
+        cross-matched table, or the MongoDB posts, which hold the up-to-date editable fields and tags).
+        
+        Returns a dictionary with keys xTabCols (columns read from the column store), keysToAdd and 
+        typeNamesToAdd (fields fetched from MongoDB, and their types), outputCols (the columns that 
+        are written out, in order, with columns hidden from the current user removed), and storeSchema 
+        (the column store schema - the whole download is read from this version of the store, even if 
+        the database is rebuilt while it is in progress).
+        
+        """
+
+        # We only read the columns we need from the cached table, and update with any changed classifications info
+        storeSchema=columnStore.readSchema(self.xMatchedTabDir)
+        xTabCols=[c['name'] for c in storeSchema['columns']]
+
+        # Need this and change below for overloading with e.g. editable BCG coords
+        editableFieldsList=[]
+        for f in self.configDict['fields']:
+            editableFieldsList.append(f['name'])
+        for key in list(xTabCols):
+            if key in editableFieldsList:
+                xTabCols.remove(key)
+        
+        # If minimal set of columns requested, skip all that aren't included
+        minimalCols=list(xTabCols)
+        if minimalColumnSet == 'true':
+            if 'catalogDownloadMinimalColumns' in self.configDict.keys():
+                minimalCols=['sourceryID']
+                for keyStr in self.configDict['catalogDownloadMinimalColumns']:
+                    if keyStr[-1] != '_':
+                        minimalCols.append(keyStr)
+                    else:
+                        for col in xTabCols:
+                            if col[:len(keyStr)] == keyStr:
+                                minimalCols.append(col)
+                xTabCols=[col for col in xTabCols if col in minimalCols]
+        if 'sourceryID' not in xTabCols:
+            xTabCols.append('sourceryID')
+        
+        # Columns that are entirely sentinel values (e.g., a cross match catalog with no matches) are left out
+        columnStats=self.getSchema()['columnStats']
+        for key in list(xTabCols):
+            if key in ['sourceryID', 'name', 'RADeg', 'decDeg'] or key not in columnStats.keys():
+                continue
+            if columnStats[key]['count'] > 0 and columnStats[key].get('numSentinel', 0) == columnStats[key]['count']:
+                xTabCols.remove(key)
+
+        # NOTE: there may be fun unicode-related stuff here: e.g., u'BCG_RADeg' versus 'BCG_RADeg'
+        keysList, typeNamesList, descriptionsList=self.getFieldNamesAndTypes(excludeKeys = [])
+        keysToAdd=['sourceryID', 'RADeg', 'decDeg', 'classification']
+        typeNamesToAdd=['text', 'number', 'number', 'text']
+        for k, t in zip(keysList, typeNamesList):
+            if k not in xTabCols and k not in keysToAdd and k in minimalCols:
+                keysToAdd.append(k)
+                typeNamesToAdd.append(t)
+            if k not in keysToAdd and k in editableFieldsList:
+                keysToAdd.append(k)
+                typeNamesToAdd.append(t)
+
+        # Zap internal columns, and any columns that this user shouldn't see
+        zapCols=['sourceryID', 'cacheBuilt']
+        outputCols=[]
+        for key in xTabCols+keysToAdd:
+            if key in zapCols or key in outputCols:
+                continue
+            if self.isHiddenColumn(key) == False:
+                outputCols.append(key)
+        columnStore.mapColumnStore(storeSchema, columns = [key for key in xTabCols if key in outputCols], 
+                                   indexColumns = ['sourceryID'])
+        
+        return {'xTabCols': xTabCols, 'keysToAdd': keysToAdd, 'typeNamesToAdd': typeNamesToAdd, 
+                'outputCols': outputCols, 'storeSchema': storeSchema}
+
+
+    def makeDownloadChunk(self, postsDict, plan, textWidths = {}):
+        """Assembles one chunk of a downloaded catalog, from a dictionary of lists of field values taken 
+        from MongoDB posts (postsDict), matched to rows of the cached cross-matched table using the 
+        sourceryID index made at build time. Columns are filled in one go (scales linearly).
+        
+        Posts not found in the cached table get sentinel values in those columns: -99 for numbers, False 
+        for bools, 0 for unsigned integers (which can't hold -99), and blank strings.
+        textWidths optionally fixes the string widths of text fields fetched from MongoDB.
+        
+        Returns an astropy table with the columns given in plan['outputCols'].
+        
+        """
+        
+        rows=columnStore.lookupRows(self.xMatchedTabDir, 'sourceryID', postsDict['sourceryID'], schema = plan['storeSchema'])
+        missingMask=np.less(rows, 0)
+        xTabCols=[key for key in plan['xTabCols'] if key in plan['outputCols']]
+        tab=columnStore.readColumnStore(self.xMatchedTabDir, columns = xTabCols, rows = np.where(missingMask, 0, rows), 
+                                        schema = plan['storeSchema'])
+        if missingMask.sum() > 0:
+            for key in tab.keys():
+                if tab[key].dtype.kind in ['U', 'S']:
+                    tab[key][missingMask]=""
+                elif tab[key].dtype.kind == 'b':
+                    tab[key][missingMask]=False
+                elif tab[key].dtype.kind == 'u':
+                    tab[key][missingMask]=0
+                else:
+                    tab[key][missingMask]=-99
+        tab.table_name=self.configDict['catalogDownloadFileName']
+        for key, typeName in zip(plan['keysToAdd'], plan['typeNamesToAdd']):
+            if key in tab.keys() or key not in plan['outputCols']:
+                continue
+            if typeName == 'number':
+                values=np.array(postsDict[key], dtype = np.float64)
+            elif key in textWidths.keys():
+                strValues=[str(v) for v in postsDict[key]]
+                if len(strValues) > 0 and max([len(v) for v in strValues]) > textWidths[key]:
+                    logger.warning("download: values in column %s longer than %d characters were truncated" % (key, textWidths[key]))
+                values=np.array(strValues, dtype = 'U%d' % (textWidths[key]))
+            else:
+                values=np.array([str(v) for v in postsDict[key]])
+            tab.add_column(atpy.Column(values, str(key)))
+        
+        return tab[plan['outputCols']]
+    
+    
+    def iterDownloadChunks(self, cursor, plan, textWidths = {}):
+        """Generator that reads posts from the query cursor in batches of self.downloadChunkRows, yielding
+        each batch as an astropy table (see makeDownloadChunk). Always yields at least one (possibly 
+        empty) table. The cursor is closed when done, or if the client goes away mid-download.
+        
+        """
+        
+        try:
+            postsDict={}
+            for key in plan['keysToAdd']:
+                postsDict[key]=[]
+            numChunks=0
+            for post in cursor:
+                for key, typeName in zip(plan['keysToAdd'], plan['typeNamesToAdd']):
+                    if key in post.keys():           # NOTE: this handles image_ tags, which are 1 if present, and absent otherwise
+                        postsDict[key].append(post[key])
+                    elif typeName == 'number':
+                        postsDict[key].append(0.0)
+                    else:
+                        postsDict[key].append("")
+                if len(postsDict['sourceryID']) == self.downloadChunkRows:
+                    yield self.makeDownloadChunk(postsDict, plan, textWidths = textWidths)
+                    numChunks=numChunks+1
+                    for key in postsDict.keys():
+                        postsDict[key]=[]
+            if len(postsDict['sourceryID']) > 0 or numChunks == 0:
+                yield self.makeDownloadChunk(postsDict, plan, textWidths = textWidths)
+        except pymongo.errors.ExecutionTimeout as e:
+            # Too late to send an error page - the download is cut off, rather than looking complete
+            logger.warning("download query ran over time limit: %s" % (str(e)))
+            raise e
+        finally:
+            cursor.close()
+    
+    
+    def getTextFieldWidths(self, queryDict, keys):
+        """Returns a dictionary of the maximum string length (in bytes) of each of the given text fields, over
+        all posts matching queryDict. This is worked out by MongoDB, so we can fix column widths before
+        streaming out formats that need them (e.g., FITS).
+        
+        Values are written out as str(value) (see makeDownloadChunk), so non-string values (e.g., numbers) 
+        are measured as MongoDB converts them to strings, with at least NON_STRING_TEXT_WIDTH characters 
+        allowed for them (as MongoDB and Python don't always format numbers the same way).
+        
+        """
+        
+        textWidths={}
+        if len(keys) == 0:
+            return textWidths
+        group={'_id': None}
+        for i in range(len(keys)):
+            fieldRef='$%s' % (keys[i])
+            group['w%d' % (i)]={'$max': {'$cond': [{'$eq': [{'$type': fieldRef}, 'string']}, {'$strLenBytes': fieldRef}, 0]}}
+            nonStringLength={'$max': [NON_STRING_TEXT_WIDTH, 
+                                      {'$strLenBytes': {'$convert': {'input': fieldRef, 'to': 'string', 'onError': '', 'onNull': ''}}}]}
+            group['n%d' % (i)]={'$max': {'$cond': [{'$in': [{'$type': fieldRef}, ['string', 'null', 'missing']]}, 0, nonStringLength]}}
+        result=list(self.sourceCollection.aggregate([{'$match': queryDict}, {'$group': group}], **self.getQueryTimeOptions()))
+        for i in range(len(keys)):
+            width=0
+            if len(result) > 0:
+                for label in ['w%d' % (i), 'n%d' % (i)]:
+                    if result[0][label] is not None:
+                        width=max(width, result[0][label])
+            textWidths[keys[i]]=max(width, 8) # 8 is enough for e.g. 'None'
+        
+        return textWidths
+        
+        
+    @cherrypy.expose
+    @sourceryAuth.require()
+    @cherrypy.config(**{'response.stream': True})
+    @queryTimeLimit('download')
+    def downloadCatalog(self, queryRADeg = "0:360", queryDecDeg = "-90:90", querySearchBoxArcmin = "",
+                        queryOtherConstraints = "", fileFormat = "cat", minimalColumnSet = "false"):
+        """Provide user with the current table view as a downloadable catalog.
+        
+        The catalog is streamed: rows are read from the query cursor and the cached cross-matched table in
+        batches, and each batch is sent as soon as it is ready. So, memory use does not depend on the size 
+        of the result, and nothing is written to disk.
+        
+        """
+        
+        if fileFormat not in DOWNLOAD_FORMATS.keys():
+            raise cherrypy.HTTPError(400, "Unknown file format '%s'" % (fileFormat))
+        if fileFormat in ['arrow', 'parquet'] and catalogTools.pa is None:
+            raise cherrypy.HTTPError(400, "%s format is not available on this server (needs pyarrow)" % (fileFormat))
+        
+        plan=self.makeDownloadPlan(minimalColumnSet = minimalColumnSet)
+        if fileFormat == 'fits' and len(plan['outputCols']) > 999:
+            raise cherrypy.HTTPError(400, "FITS table format does not support 1000+ columns - try another format")
+
+        # quickLinks queries: serve the saved snapshot if we have one, otherwise make one as we go
+        # (snapshots are shared between users, so not for users who can't see everything)
+        quickLinkResult=None
+        if minimalColumnSet != 'true' and len(self.getUserHiddenXMatchTables()) == 0:
+            quickLinkResult=self.getQuickLinkResult(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+        if quickLinkResult is not None:
+            snapshotPath=self.getQuickLinkSnapshotPath(quickLinkResult, fileFormat)
+            try:
+                snapshotFile=open(snapshotPath, "rb")
+            except FileNotFoundError:
+                snapshotFile=None
+            if snapshotFile is not None:
+                cherrypy.response.headers['Content-Disposition']='attachment; filename="%s.%s"' % (self.configDict['catalogDownloadFileName'], fileFormat)
+                cherrypy.response.headers['Content-Type']=DOWNLOAD_FORMATS[fileFormat]['contentType']
+                return self.streamFile(snapshotFile)
+        
+        try:
+            queryDict=self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+        except Exception as e:
+            raise cherrypy.HTTPError(400, "Invalid query: %s" % (str(e)))
+        projection={'_id': 0}
+        for key in plan['keysToAdd']:
+            projection[key]=1
+        
+        # Formats with fixed column widths (fits, vot) need these up front, and fits needs the row count too
+        textWidths={}
+        numRows=None
+        if fileFormat in ['fits', 'vot']:
+            textKeys=[]
+            for key, typeName in zip(plan['keysToAdd'], plan['typeNamesToAdd']):
+                if typeName == 'text' and key in plan['outputCols']:
+                    textKeys.append(key)
+            textWidths=self.getTextFieldWidths(queryDict, textKeys)
+        if fileFormat == 'fits':
+            numRows=self.countQuery(queryDict)
+        
+        cursor=self.sourceCollection.find(queryDict, projection).sort('RADeg').batch_size(self.downloadChunkRows)
+        cursor=cursor.max_time_ms(self.getQueryTimeLimitMS())
+        indexHint=self.chooseIndexHint(queryDict)
+        if indexHint is not None:
+            cursor=cursor.hint(indexHint)
+        chunks=self.iterDownloadChunks(cursor, plan, textWidths = textWidths)
+        
+        cherrypy.response.headers['Content-Disposition']='attachment; filename="%s.%s"' % (self.configDict['catalogDownloadFileName'], fileFormat)
+        cherrypy.response.headers['Content-Type']=DOWNLOAD_FORMATS[fileFormat]['contentType']
+        
+        byteChunks=self.streamCatalog(chunks, fileFormat, plan, textWidths = textWidths, numRows = numRows)
+        if quickLinkResult is not None:
+            byteChunks=self.streamAndSaveSnapshot(byteChunks, snapshotPath)
+        
+        return byteChunks
+    
+    
+    def streamCatalog(self, chunks, fileFormat, plan, textWidths = {}, numRows = None):
+        """Returns a generator that writes out the given chunks of catalog (astropy tables) in the given 
+        fileFormat (one of the keys of DOWNLOAD_FORMATS). textWidths and numRows are needed for formats
+        with fixed column widths (fits, vot); numRows is only needed for fits.
+        
+        """
+        
+        if fileFormat == 'cat':
+            return catalogTools.streamASCIITable(chunks)
+        elif fileFormat == 'csv.gz':
+            return catalogTools.streamGzip(catalogTools.streamASCIITable(chunks, format = 'ascii.csv'))
+        elif fileFormat == 'reg':
+            return catalogTools.streamDS9Regions(chunks)
+        elif fileFormat == 'fits':
+            columnSpecs=self.getDownloadColumnSpecs(plan, textWidths)
+            return catalogTools.streamFITSTable(chunks, columnSpecs, numRows, 
+                                                tableName = self.configDict['catalogDownloadFileName'])
+        elif fileFormat == 'vot':
+            columnSpecs=self.getDownloadColumnSpecs(plan, textWidths)
+            return catalogTools.streamVOTable(chunks, columnSpecs, tableName = self.configDict['catalogDownloadFileName'])
+        elif fileFormat in ['arrow', 'parquet']:
+            return catalogTools.streamArrowTable(chunks, fileFormat = fileFormat)
+        else:
+            raise Exception("unknown fileFormat '%s'" % (fileFormat))
+    
+    
+    def getDownloadColumnSpecs(self, plan, textWidths):
+        """Returns a list of column specifications (dictionaries with keys name, dtype, shape) for the 
+        columns in a downloaded catalog, for formats that need fixed column types (e.g., FITS).
+        
+        """
+        
+        storeSpecs={}
+        for c in plan['storeSchema']['columns']:
+            storeSpecs[c['name']]={'name': c['name'], 'dtype': c['dtype'], 'shape': c['shape']}
+            if 'byteWidth' in c.keys():
+                storeSpecs[c['name']]['byteWidth']=c['byteWidth']
+        columnSpecs=[]
+        for key in plan['outputCols']:
+            if key in plan['xTabCols']:
+                columnSpecs.append(storeSpecs[key])
+            elif plan['typeNamesToAdd'][plan['keysToAdd'].index(key)] == 'number':
+                columnSpecs.append({'name': key, 'dtype': 'f8', 'shape': []})
+            else:
+                columnSpecs.append({'name': key, 'dtype': 'U%d' % (textWidths[key]), 'shape': [], 'byteWidth': textWidths[key]})
+        
+        return columnSpecs
+    
+    
+    def getSkyIndex(self):
+        """Returns a catalogTools.SkyIndex for the whole catalog, and the matching array of sourceryIDs, 
+        for matching many positions at once. These are made from the cached cross-matched table (so only
+        change when the database is rebuilt), kept in memory, and saved in the cache dir so that other 
+        processes (and restarts) don't need to rebuild them.
+        
+        """
+        
+        # Index and sourceryIDs must come from the same version of the column store
+        versionDir=columnStore.resolveStoreDir(self.xMatchedTabDir)
+        schemaPath=versionDir+os.path.sep+columnStore.SCHEMA_FILE_NAME
+        if os.path.exists(schemaPath) == False:
+            raise Exception("no cross-matched table found - you probably need to rebuild the database")
+        stamp=os.stat(schemaPath).st_mtime_ns
+        with self.skyIndexLock:
+            if self.skyIndex is not None and self.skyIndex['stamp'] == stamp:
+                return self.skyIndex['index'], self.skyIndex['sourceryIDs']
+            schema=columnStore.readSchema(versionDir)
+            skyIndexPath=self.cacheDir+os.path.sep+"skyIndex.pickle"
+            skyIndexDict=None
+            if os.path.exists(skyIndexPath) == True:
+                try:
+                    with open(skyIndexPath, "rb") as inFile:
+                        skyIndexDict=pickle.load(inFile)
+                    if skyIndexDict['stamp'] != stamp:
+                        skyIndexDict=None
+                except:
+                    skyIndexDict=None
+            if skyIndexDict is None:
+                print("... building sky index ...")
+                RADeg=columnStore.readColumn(self.xMatchedTabDir, 'RADeg', schema = schema)
+                decDeg=columnStore.readColumn(self.xMatchedTabDir, 'decDeg', schema = schema)
+                skyIndexDict={'stamp': stamp, 'index': catalogTools.SkyIndex(RADeg, decDeg)}
+                tmpPath=skyIndexPath+".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+                with open(tmpPath, "wb") as outFile:
+                    pickle.dump(skyIndexDict, outFile)
+                os.replace(tmpPath, skyIndexPath)
+            skyIndexDict['sourceryIDs']=columnStore.readColumn(self.xMatchedTabDir, 'sourceryID', schema = schema)
+            self.skyIndex=skyIndexDict
+        
+        return skyIndexDict['index'], skyIndexDict['sourceryIDs']
+    
+    
+    def readPositionsUpload(self, uploadFile, maxRows):
+        """Reads an uploaded table of positions (a cherrypy file upload), returning the astropy table and the
+        names of the RA, dec., ID, and radius columns (the latter two are None if not present). Raises
+        cherrypy.HTTPError if the table can't be read or has no position columns.
+        
+        """
+        
+        try:
+            tab=catalogTools.readUploadedTable(uploadFile.filename, uploadFile.file.read())
+        except Exception as e:
+            raise cherrypy.HTTPError(400, "Could not read uploaded table: %s" % (str(e)))
+        RAKey=catalogTools.findColumn(tab, ['RADeg', 'RA', 'RAJ2000', 'ra_deg'])
+        decKey=catalogTools.findColumn(tab, ['decDeg', 'dec', 'DEJ2000', 'DECJ2000', 'dec_deg'])
+        if RAKey is None or decKey is None:
+            raise cherrypy.HTTPError(400, "Uploaded table should have RA and dec. columns (in decimal degrees) named e.g. RADeg, decDeg")
+        if len(tab) > maxRows:
+            raise cherrypy.HTTPError(400, "Uploaded table has too many rows (%d; the limit is %d)" % (len(tab), maxRows))
+        IDKey=catalogTools.findColumn(tab, ['id', 'name', 'inputID'])
+        radiusKey=catalogTools.findColumn(tab, ['radiusArcmin'])
+        
+        return tab, RAKey, decKey, IDKey, radiusKey
+    
+    
+    def fetchAllowedPosts(self, sourceryIDs, queryOtherConstraints = "", projection = None):
+        """Returns a dictionary of posts (indexed by sourceryID) for the given sourceryIDs, leaving out any
+        that don't pass the given constraints, or the current user's hidden constraints.
+        
+        """
+        
+        queryDict=queryTools.combineQueries([self.makeQueryDict("0:360", "-90:90", "", queryOtherConstraints, checkCost = False), 
+                                             {'sourceryID': {'$in': [str(i) for i in sourceryIDs]}}])
+        postsDict={}
+        for post in self.sourceCollection.find(queryDict, projection):
+            postsDict[post['sourceryID']]=post
+        self.restoreSentinels(postsDict.values(), projection)
+        
+        return postsDict
+    
+    
+    def findNameMatches(self, name, maxResults):
+        """Finds objects matching the given name, applying the current user's hidden constraints. Tries, in 
+        order: an exact match on the normalized name (see catalogTools.normalizeName), a prefix match (both 
+        of which use the index on nameNorm), and then a fuzzy match, which ranks objects by the number of 
+        name trigrams (see catalogTools.makeTrigrams) they share with the given name.
+        
+        Fuzzy matches are found using the index on nameTrigrams, looking only at the rarest of the given 
+        name's trigrams (see getNameTrigramCounts), so that common ones (e.g., 'act') don't make us scan 
+        most of the collection.
+        
+        Returns a list of posts (with keys sourceryID, name, RADeg, decDeg), and the kind of match found 
+        ('exact', 'prefix', 'fuzzy').
+        
+        """
+        
+        normName=catalogTools.normalizeName(name)
+        projection={'_id': 0, 'sourceryID': 1, 'name': 1, 'RADeg': 1, 'decDeg': 1}
+        baseQuery=self.makeQueryDict("0:360", "-90:90", "", "")
+        
+        queryDict=queryTools.combineQueries([baseQuery, {'nameNorm': normName}])
+        posts=list(self.sourceCollection.find(queryDict, projection).limit(maxResults).max_time_ms(self.getQueryTimeLimitMS()))
+        if len(posts) > 0:
+            return posts, 'exact'
+        
+        queryDict=queryTools.combineQueries([baseQuery, {'nameNorm': {'$regex': "^"+re.escape(normName)}}])
+        posts=list(self.sourceCollection.find(queryDict, projection).sort([('nameNorm', pymongo.ASCENDING)]).limit(maxResults).max_time_ms(self.getQueryTimeLimitMS()))
+        if len(posts) > 0:
+            return posts, 'prefix'
+        
+        trigrams=catalogTools.makeTrigrams(normName)
+        trigramCounts=self.getNameTrigramCounts()
+        rareTrigrams=[t for t in trigrams if t in trigramCounts.keys()]
+        rareTrigrams.sort(key = lambda t: trigramCounts[t])
+        rareTrigrams=rareTrigrams[:self.nameSearchMaxTrigrams]
+        if len(rareTrigrams) == 0:
+            return [], 'fuzzy'
+        minShared=max(1, int(np.ceil(len(trigrams)*self.nameSearchMinSimilarity)))
+        pipeline=[{'$match': queryTools.combineQueries([baseQuery, {'nameTrigrams': {'$in': rareTrigrams}}])},
+                  {'$project': {'_id': 0, 'sourceryID': 1, 'name': 1, 'RADeg': 1, 'decDeg': 1,
+                                'numShared': {'$size': {'$setIntersection': ['$nameTrigrams', trigrams]}}}},
+                  {'$match': {'numShared': {'$gte': minShared}}},
+                  {'$sort': SON([('numShared', pymongo.DESCENDING), ('name', pymongo.ASCENDING)])},
+                  {'$limit': maxResults}]
+        posts=list(self.sourceCollection.aggregate(pipeline, **self.getQueryTimeOptions()))
+        
+        return posts, 'fuzzy'
+    
+    
+    @cherrypy.expose
+    @sourceryAuth.require()
+    @queryTimeLimit('interactive')
+    def nameSearch(self, name = "", maxResults = "20"):
+        """Searches for objects by name (see findNameMatches). If there is a single match, redirects to its
+        source page; otherwise, shows a list of matches.
+        
+        """
+        
+        try:
+            maxResults=min(max(int(maxResults), 1), 1000)
+        except:
+            raise cherrypy.HTTPError(400, "maxResults should be an integer")
+        if name.strip() == "":
+            raise cherrypy.HTTPRedirect(cherrypy.request.script_name)
+        
+        posts, matchKind=self.findNameMatches(name, maxResults)
+        linkSuffix="&clipSizeArcmin=%.2f" % (self.configDict['defaultViewSizeArcmin'])
+        if 'defaultImageType' in self.configDict.keys():
+            linkSuffix=linkSuffix+"&imageType=%s" % (self.configDict['defaultImageType'])
+        if len(posts) == 1:
+            raise cherrypy.HTTPRedirect(cherrypy.request.script_name+"/displaySourcePage?sourceryID=%s" % (self.sourceNameToURL(posts[0]['sourceryID']))+linkSuffix)
+        
+        templatePage="""<html>
+        <head>
+            <meta http-equiv="content-type" content="text/html; charset=ISO-8859-1">
+            <title>Name Search</title>
+        </head>
+        <body style="font-family: sans-serif; vertical align: top; justify: full;">
+        <table cellpadding="4" cellspacing="0" border="0" style="text-align: left; width: 100%;">
+            <tbody>
+                <tr>
+                    <td style="background-color: rgb(0, 0, 0); font-family: sans-serif; color: rgb(255, 255, 255); 
+                        text-align: center; vertical-align: middle; font-size: 125%;">
+                        Name Search
+                    </td>
+                </tr>
+            </tbody>
+        </table>
+        
+        <br>
+        <form method="get" action="nameSearch">
+        <label for="name">Name</label>
+        <input type="text" value="$NAME_ATTR" name="name"/>
+        <input type="submit" style="font-size: 1.05em;" value="Search">
+        </form>
+        <p>$RESULTS_SUMMARY</p>
+        <table frame=border cellspacing=0 cols=3 rules=all border=2 width=85% align=center>
+        <tbody>
+            <tr style="background-color: rgb(0, 0, 0); font-family: sans-serif; color: rgb(255, 255, 255); 
+                    text-align: center; vertical-align: middle; font-size: 110%;">
+            <td><b>Name</b></td>
+            <td><b>RA (degrees)</b></td>
+            <td><b>Dec. (degrees)</b></td>
+            </tr>
+            $TABLE_DATA
+        </tbody>
+        </table>
+        
+        <hr>
+        <a href="$SCRIPT_NAME">Back to table</a> - <i>Sourcery</i> - $HOSTED_STR
+        <br>
+        <br>
+        </body>
+        </html>
+        """
+        html=templatePage
+        html=html.replace("$SCRIPT_NAME", cherrypy.request.script_name)
+        html=html.replace("$HOSTED_STR", self.configDict['hostedBy'])
+        html=html.replace("$NAME_ATTR", html_escape(name))
+        if len(posts) == 0:
+            summary="No objects found matching '%s'." % (html_escape(name))
+        elif matchKind == 'fuzzy':
+            summary="No exact matches for '%s' - showing the %d closest names." % (html_escape(name), len(posts))
+        else:
+            summary="%d objects found matching '%s'." % (len(posts), html_escape(name))
+            if len(posts) == maxResults:
+                summary=summary+" Only the first %d are shown." % (maxResults)
+        html=html.replace("$RESULTS_SUMMARY", summary)
+        tableData=""
+        for post in posts:
+            linkURL="displaySourcePage?sourceryID=%s" % (self.sourceNameToURL(post['sourceryID']))+linkSuffix
+            tableData=tableData+"<tr><td align=center><a href=\"%s\">%s</a></td><td align=center>%.6f</td><td align=center>%.6f</td></tr>\n" \
+                      % (linkURL, html_escape(str(post['name'])), post['RADeg'], post['decDeg'])
+        html=html.replace("$TABLE_DATA", tableData)
+        
+        return html
+    
+    
+    @cherrypy.expose
+    @sourceryAuth.require()
+    @cherrypy.config(**{'response.stream': True})
+    @queryTimeLimit('download')
+    def batchSearch(self, positionsFile = None, radiusArcmin = "1.0", queryOtherConstraints = "", fileFormat = "csv"):
+        """Matches an uploaded list of positions (CSV or FITS table, with columns RADeg, decDeg, and 
+        optionally id and radiusArcmin) against the catalog in one go, using the sky index (see getSkyIndex).
+        Any constraints given, and the user's hidden constraints, are applied to the matches.
+        
+        Streams back one row per match, with the input ID and position, the separation, and the columns 
+        shown in the table view, as CSV (fileFormat = 'csv') or gzip-compressed CSV ('csv.gz').
+        
+        """
+        
+        if positionsFile is None or not hasattr(positionsFile, 'file'):
+            raise cherrypy.HTTPError(400, "No positions file uploaded")
+        if fileFormat not in ['csv', 'csv.gz']:
+            raise cherrypy.HTTPError(400, "fileFormat should be 'csv' or 'csv.gz'")
+        try:
+            defaultRadiusArcmin=float(radiusArcmin)
+            self.makeQueryDict("0:360", "-90:90", "", queryOtherConstraints, checkCost = False)
+        except Exception as e:
+            raise cherrypy.HTTPError(400, "Invalid query: %s" % (str(e)))
+        inTab, RAKey, decKey, IDKey, radiusKey=self.readPositionsUpload(positionsFile, self.batchSearchMaxPositions)
+        if radiusKey is not None:
+            radiiArcmin=np.array(inTab[radiusKey], dtype = np.float64)
+        else:
+            radiiArcmin=np.ones(len(inTab))*defaultRadiusArcmin
+        if IDKey is not None:
+            inputIDs=np.array(inTab[IDKey])
+        else:
+            inputIDs=np.arange(len(inTab))
+        inputRADeg=np.array(inTab[RAKey], dtype = np.float64)
+        inputDecDeg=np.array(inTab[decKey], dtype = np.float64)
+        
+        skyIndex, sourceryIDs=self.getSkyIndex()
+        inputIndices, catalogIndices, sepDeg=skyIndex.queryRadius(inputRADeg, inputDecDeg, radiiArcmin/60.0)
+        
+        displayColumns=self.getDisplayColumns("")
+        projection=self.makeTableProjection(displayColumns)
+        del projection['_id']
+        
+        def iterMatchChunks():
+            numChunks=0
+            for start in range(0, max(len(inputIndices), 1), self.downloadChunkRows):
+                chunkInput=inputIndices[start:start+self.downloadChunkRows]
+                chunkIDs=np.array(sourceryIDs[catalogIndices[start:start+self.downloadChunkRows]], dtype = str)
+                chunkSep=sepDeg[start:start+self.downloadChunkRows]*60.0
+                postsDict=self.fetchAllowedPosts(chunkIDs, queryOtherConstraints = queryOtherConstraints, 
+                                                 projection = projection)
+                keep=np.array([i in postsDict.keys() for i in chunkIDs], dtype = bool)
+                posts=[postsDict[i] for i in chunkIDs[keep]]
+                chunk=atpy.Table()
+                chunk.add_column(atpy.Column(inputIDs[chunkInput[keep]], 'inputID'))
+                chunk.add_column(atpy.Column(inputRADeg[chunkInput[keep]], 'inputRADeg'))
+                chunk.add_column(atpy.Column(inputDecDeg[chunkInput[keep]], 'inputDecDeg'))
+                chunk.add_column(atpy.Column(chunkSep[keep], 'separationArcmin'))
+                for colDict in displayColumns:
+                    if colDict['fmt'] == '%s':
+                        values=np.array([str(p.get(colDict['name'], "")) for p in posts], dtype = str)
+                    else:
+                        values=np.array([p.get(colDict['name'], np.nan) for p in posts], dtype = np.float64)
+                    chunk.add_column(atpy.Column(values, colDict['name']))
+                if len(chunk) > 0 or numChunks == 0:
+                    numChunks=numChunks+1
+                    yield chunk
+        
+        cherrypy.response.headers['Content-Disposition']='attachment; filename="%s_batchSearch.%s"' % (self.configDict['catalogDownloadFileName'], fileFormat)
+        if fileFormat == 'csv':
+            cherrypy.response.headers['Content-Type']='text/csv'
+            return catalogTools.streamASCIITable(iterMatchChunks(), format = 'ascii.csv')
+        else:
+            cherrypy.response.headers['Content-Type']=DOWNLOAD_FORMATS['csv.gz']['contentType']
+            return catalogTools.streamGzip(catalogTools.streamASCIITable(iterMatchChunks(), format = 'ascii.csv'))
+        
+        
+    @cherrypy.expose
+    @sourceryAuth.require()
+    @cherrypy.config(**{'response.stream': True})
+    @queryTimeLimit('download')
+    def crossMatchUpload(self, catalogFile = None, radiusArcmin = "1.0", matchMode = "nearest", fileFormat = "cat",
+                         minimalColumnSet = "false", queryOtherConstraints = ""):
+        """Cross matches an uploaded catalog (CSV or FITS table, with RA and dec. columns in decimal degrees)
+        against the catalog, using the sky index (see getSkyIndex), and streams back the joined table in 
+        any of the download formats. The database is not changed. matchMode is one of:
+        
+            - nearest: each uploaded row is joined to its nearest match within radiusArcmin (rows without 
+              a match are left out)
+            - all: as nearest, but all uploaded rows are kept (with sentinel values where there's no match)
+            - radius: each uploaded row is joined to every match within radiusArcmin (so may appear more
+              than once)
+        
+        The catalog columns (including the current tags) are the same as in downloadCatalog. The uploaded 
+        columns come first (prefixed with input_ if the names clash), followed by separationArcmin.
+        Matches that don't pass the given constraints, or the user's hidden constraints, are ignored.
+        
+        """
+        
+        if catalogFile is None or not hasattr(catalogFile, 'file'):
+            raise cherrypy.HTTPError(400, "No catalog file uploaded")
+        if matchMode not in ['nearest', 'all', 'radius']:
+            raise cherrypy.HTTPError(400, "matchMode should be one of 'nearest', 'all', 'radius'")
+        if fileFormat not in DOWNLOAD_FORMATS.keys():
+            raise cherrypy.HTTPError(400, "Unknown file format '%s'" % (fileFormat))
+        if fileFormat in ['arrow', 'parquet'] and catalogTools.pa is None:
+            raise cherrypy.HTTPError(400, "%s format is not available on this server (needs pyarrow)" % (fileFormat))
+        try:
+            radiusDeg=float(radiusArcmin)/60.0
+            queryDict=self.makeQueryDict("0:360", "-90:90", "", queryOtherConstraints, checkCost = False)
+        except Exception as e:
+            raise cherrypy.HTTPError(400, "Invalid query: %s" % (str(e)))
+        inTab, RAKey, decKey, IDKey, radiusKey=self.readPositionsUpload(catalogFile, self.crossMatchUploadMaxRows)
+        plan=self.makeDownloadPlan(minimalColumnSet = minimalColumnSet)
+        
+        # Uploaded columns, renamed where they clash with ours
+        inputColumns=[]
+        for key in inTab.colnames:
+            col=inTab[key]
+            if hasattr(col, 'filled'):
+                col=col.filled()
+            values=np.asarray(col)
+            if values.dtype.kind == 'O':
+                values=np.array(values, dtype = 'U')
+            outKey=key
+            if key in plan['outputCols'] or key == 'separationArcmin':
+                outKey="input_"+key
+            inputColumns.append({'name': outKey, 'values': values})
+        outputCols=[c['name'] for c in inputColumns]+['separationArcmin']+plan['outputCols']
+        if fileFormat == 'fits' and len(outputCols) > 999:
+            raise cherrypy.HTTPError(400, "FITS table format does not support 1000+ columns - try another format")
+
+        # Match, then drop matches this user can't see (or that fail the constraints)
+        skyIndex, sourceryIDs=self.getSkyIndex()
+        inputRADeg=np.array(inTab[RAKey], dtype = np.float64)
+        inputDecDeg=np.array(inTab[decKey], dtype = np.float64)
+        if matchMode == 'radius':
+            inputIndices, catalogIndices, sepDeg=skyIndex.queryRadius(inputRADeg, inputDecDeg, radiusDeg)
+        else:
+            inputIndices, catalogIndices, sepDeg=skyIndex.queryNearest(inputRADeg, inputDecDeg, radiusDeg)
+        matchIDs=np.array(sourceryIDs[catalogIndices], dtype = str)
+        allowedIDs=set()
+        uniqueIDs=np.unique(matchIDs)
+        for start in range(0, len(uniqueIDs), self.downloadChunkRows):
+            allowedIDs.update(self.fetchAllowedPosts(uniqueIDs[start:start+self.downloadChunkRows], 
+                                                     queryOtherConstraints = queryOtherConstraints,
+                                                     projection = {'_id': 0, 'sourceryID': 1}).keys())
+        keep=np.array([i in allowedIDs for i in matchIDs], dtype = bool)
+        inputIndices, matchIDs, sepArcmin=inputIndices[keep], matchIDs[keep], sepDeg[keep]*60.0
+        if matchMode == 'all':
+            allIDs=np.zeros(len(inTab), dtype = matchIDs.dtype)
+            allIDs[inputIndices]=matchIDs
+            allSepArcmin=np.zeros(len(inTab))-99
+            allSepArcmin[inputIndices]=sepArcmin
+            inputIndices, matchIDs, sepArcmin=np.arange(len(inTab)), allIDs, allSepArcmin
+        
+        # Formats with fixed column widths/row counts need these up front
+        textWidths={}
+        if fileFormat in ['fits', 'vot']:
+            textKeys=[]
+            for key, typeName in zip(plan['keysToAdd'], plan['typeNamesToAdd']):
+                if typeName == 'text' and key in plan['outputCols']:
+                    textKeys.append(key)
+            textWidths=self.getTextFieldWidths(queryTools.combineQueries([queryDict, {'sourceryID': {'$in': list(allowedIDs)}}]), textKeys)
+        columnSpecs=[]
+        for c in inputColumns:
+            columnSpecs.append({'name': c['name'], 'dtype': c['values'].dtype.str, 'shape': list(c['values'].shape[1:])})
+            if c['values'].dtype.kind == 'U':
+                columnSpecs[-1]['byteWidth']=np.char.encode(c['values'], 'utf-8').dtype.itemsize
+        columnSpecs.append({'name': 'separationArcmin', 'dtype': 'f8', 'shape': []})
+        columnSpecs=columnSpecs+self.getDownloadColumnSpecs(plan, textWidths)
+        
+        projection={'_id': 0}
+        for key in plan['keysToAdd']:
+            projection[key]=1
+        
+        def iterCrossMatchChunks():
+            numChunks=0
+            for start in range(0, len(inputIndices), self.downloadChunkRows):
+                chunkInput=inputIndices[start:start+self.downloadChunkRows]
+                chunkIDs=matchIDs[start:start+self.downloadChunkRows]
+                posts=self.fetchAllowedPosts(np.unique(chunkIDs[chunkIDs != ""]), projection = projection, 
+                                             queryOtherConstraints = queryOtherConstraints)
+                postsDict={}
+                for key in plan['keysToAdd']:
+                    postsDict[key]=[]
+                for sourceryID in chunkIDs:
+                    post=posts.get(sourceryID, None)
+                    for key, typeName in zip(plan['keysToAdd'], plan['typeNamesToAdd']):
+                        if post is not None and key in post.keys():
+                            postsDict[key].append(post[key])
+                        elif typeName == 'number':
+                            postsDict[key].append(0.0 if post is not None else -99)
+                        else:
+                            postsDict[key].append("")
+                chunk=self.makeDownloadChunk(postsDict, plan, textWidths = textWidths)
+                for i in range(len(inputColumns)):
+                    chunk.add_column(atpy.Column(inputColumns[i]['values'][chunkInput], inputColumns[i]['name']), index = i)
+                chunk.add_column(atpy.Column(sepArcmin[start:start+self.downloadChunkRows], 'separationArcmin'), 
+                                 index = len(inputColumns))
+                numChunks=numChunks+1
+                yield chunk
+            if numChunks == 0:
+                chunk=atpy.Table()
+                for spec in columnSpecs:
+                    chunk.add_column(atpy.Column(np.zeros([0]+spec['shape'], dtype = spec['dtype']), spec['name']))
+                yield chunk
+        
+        cherrypy.response.headers['Content-Disposition']='attachment; filename="%s_xMatch.%s"' % (self.configDict['catalogDownloadFileName'], fileFormat)
+        cherrypy.response.headers['Content-Type']=DOWNLOAD_FORMATS[fileFormat]['contentType']
+        outputPlan={'xTabCols': [], 'keysToAdd': [], 'typeNamesToAdd': [], 'outputCols': outputCols}
+        if fileFormat == 'fits':
+            return catalogTools.streamFITSTable(iterCrossMatchChunks(), columnSpecs, len(inputIndices), 
+                                                tableName = self.configDict['catalogDownloadFileName'])
+        elif fileFormat == 'vot':
+            return catalogTools.streamVOTable(iterCrossMatchChunks(), columnSpecs, 
+                                              tableName = self.configDict['catalogDownloadFileName'])
+        else:
+            return self.streamCatalog(iterCrossMatchChunks(), fileFormat, outputPlan)
+        
+    
+    @cherrypy.expose
+    @sourceryAuth.require()
+    def downloadThumbnailFITS(self, sourceryID):
+        """Returns .fits image for download by the user.
+        
+        """
+        obj=self.sourceCollection.find_one({'sourceryID': sourceryID})
+        RADeg=obj['RADeg']
+        decDeg=obj['decDeg']
+        subDir=str(RADeg).split(".")[0]
+        imgPath=self.cacheDir+os.path.sep+self.configDict['downloadableFITS']+os.path.sep+subDir+os.path.sep+catalogTools.makeRADecString(RADeg, decDeg)+".fits"
+        #imgPath=self.cacheDir+os.path.sep+self.configDict['downloadableFITS']+os.path.sep+catalogTools.makeRADecString(obj['RADeg'], obj['decDeg'])+".fits"
+        cherrypy.response.headers['Content-Disposition']='attachment; filename="%s.%s"' % (obj['name'].replace(" ", "_"), 'fits')
+        f=open(imgPath, 'rb')
+        
+        return f
+        
+        
+    def sourceNameToURL(self, name):
+        """Replaces + and spaces in source names so that they will be valid URLs.
+        
+        """
+        return name.replace("+", "%2B").replace(" ", "%20").replace(":", "%3A")
+
         
     def URLToSourceName(self, url):
         """Replaces %20 and %2b in URLs with spaces and + signs.
@@ -2158,68 +4175,34 @@ class SourceBrowser(object):
         return url.replace("%2b", "+").replace("%20", " ").replace("%3A", ":")
 
 
-    def runQuery(self, queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints, collection = 'source'):           
+    def runQuery(self, queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints, collection = 'source',
+                 projection = None):           
         """Runs a query, returns the posts found.
         
         If collection = 'source', runs on self.sourceCollection (default, whole catalog).
         
         If collection = 'tags', runs on self.tagsCollection
         
+        If projection is given (a MongoDB projection, e.g., {'name': 1, 'RADeg': 1}), only those fields are
+        returned. Posts carry all the cross match columns, so this is much quicker when only a few are needed.
+        
         """
         
-        # Hidden constraints: for access control, e.g., show only DES users regions inside DES footprint
-        user=cherrypy.session['_sourcery_username']
-        hiddenConstraints=""
-        for userNameKey in self.usersDict.keys():
-            userDict=self.usersDict[userNameKey]
-            if userNameKey == user and 'hiddenConstraints' in userDict.keys() and userDict['hiddenConstraints'] != None:
-                hiddenConstraints=userDict['hiddenConstraints']
-                if hiddenConstraints[0] == '"' or hiddenConstraints[0] == "'":
-                    hiddenConstraints=hiddenConstraints[1:]
-                if hiddenConstraints[-1] == '"' or hiddenConstraints[-1] == "'":
-                    hiddenConstraints=hiddenConstraints[:-1]
-        if hiddenConstraints != "":
-            queryOtherConstraints=queryOtherConstraints+" and "+hiddenConstraints
-                    
-        # Build query document piece by piece...
-        queryDict={}
-
-        # Position
-        if ":" not in queryRADeg and ":" not in queryDecDeg:
-            queryRADeg=float(queryRADeg)
-            queryDecDeg=float(queryDecDeg)
-            querySearchBoxArcmin=float(querySearchBoxArcmin)
-            RAMin, RAMax, decMin, decMax=astCoords.calcRADecSearchBox(queryRADeg, queryDecDeg, querySearchBoxArcmin/60.0)
-        else:
-            RAMin, RAMax=queryRADeg.split(":")
-            decMin, decMax=queryDecDeg.split(":")
-            RAMin=float(RAMin)
-            RAMax=float(RAMax)
-            decMin=float(decMin)
-            decMax=float(decMax)
-        queryDict['decDeg']={'$lte': decMax, '$gte': decMin}
-        if RAMin >= 0:
-            queryDict['RADeg']={'$lte': RAMax, '$gte': RAMin}
-        else:
-            queryDict['$or']=[{'RADeg': {'$gte': 0, '$lte': RAMax}}, {'RADeg': {'$gte': 360+RAMin, '$lte': 360}}]
-
-        # Other constraints
-        constraintsDict=self.extractConstraintsDict(queryOtherConstraints)
-        for key in constraintsDict:
-            queryDict[key]=constraintsDict[key]
+        queryDict=self.makeQueryDict(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
 
         # Execute query
         # NOTE: converting to list here is very slow
         if collection == 'source':
-            self.sourceCollection.create_index([("RADeg", pymongo.ASCENDING)])
             #queryPosts=list(self.sourceCollection.find(queryDict).sort('decDeg').sort('RADeg'))
-            numPosts=self.sourceCollection.count_documents(queryDict)
-            queryPosts=self.sourceCollection.find(queryDict).sort('decDeg').sort('RADeg')  
+            numPosts=self.countQuery(queryDict)
+            queryPosts=self.sourceCollection.find(queryDict, projection).sort('decDeg').sort('RADeg').max_time_ms(self.getQueryTimeLimitMS())
+            indexHint=self.chooseIndexHint(queryDict)
+            if indexHint is not None:
+                queryPosts=queryPosts.hint(indexHint)
         elif collection == 'tags':
-            self.tagsCollection.create_index([("RADeg", pymongo.ASCENDING)])
             #queryPosts=list(self.sourceCollection.find(queryDict).sort('decDeg').sort('RADeg')) 
-            numPosts=self.tagsCollection.count_documents(queryDict)
-            queryPosts=self.tagsCollection.find(queryDict).sort('decDeg').sort('RADeg')
+            numPosts=self.tagsCollection.count_documents(queryDict, **self.getQueryTimeOptions())
+            queryPosts=self.tagsCollection.find(queryDict, projection).sort('decDeg').sort('RADeg').max_time_ms(self.getQueryTimeLimitMS())
         else:
             raise Exception("collection should be 'source' or 'tags' only")
                         
@@ -2229,6 +4212,199 @@ class SourceBrowser(object):
         return queryPosts, numPosts
         
 
+    def makeUserPolicy(self, userDict):
+        """Returns the access policy for a user, from their entry in the user list file (userDict). This is a
+        dictionary with keys hiddenConstraints (the constraints string, with any quotes stripped), 
+        hiddenConstraintsMessage, and hiddenPrefixes (a tuple of the hiddenXMatchTables column prefixes). The
+        compiled hiddenConstraints (hiddenQuery) are added when first needed (see getUserHiddenQuery), as
+        they depend on the database schema.
+        
+        """
+        
+        hiddenConstraints=""
+        if 'hiddenConstraints' in userDict.keys() and userDict['hiddenConstraints'] != None:
+            hiddenConstraints=userDict['hiddenConstraints'].strip()
+            if hiddenConstraints[:1] == '"' or hiddenConstraints[:1] == "'":
+                hiddenConstraints=hiddenConstraints[1:]
+            if hiddenConstraints[-1:] == '"' or hiddenConstraints[-1:] == "'":
+                hiddenConstraints=hiddenConstraints[:-1]
+        hiddenConstraintsMessage=""
+        if 'hiddenConstraintsMessage' in userDict.keys():
+            hiddenConstraintsMessage=userDict['hiddenConstraintsMessage']
+        hiddenPrefixes=[]
+        if 'hiddenXMatchTables' in userDict.keys():
+            hiddenPrefixes=userDict['hiddenXMatchTables']
+        
+        return {'hiddenConstraints': hiddenConstraints, 'hiddenConstraintsMessage': hiddenConstraintsMessage,
+                'hiddenPrefixes': tuple(hiddenPrefixes), 'hiddenQuery': None, 'schema': None}
+    
+    
+    def getUserPolicy(self):
+        """Returns the access policy (see makeUserPolicy) for the current user.
+        
+        """
+        
+        user=cherrypy.session.get('_sourcery_username', None)
+        if user in self.userPolicies.keys():
+            return self.userPolicies[user]
+        
+        return self.defaultUserPolicy
+    
+    
+    def getUserHiddenConstraints(self):
+        """Returns the hiddenConstraints string for the current user (or a blank string if there are none).
+        
+        """
+        
+        return self.getUserPolicy()['hiddenConstraints']
+    
+    
+    def getUserHiddenQuery(self):
+        """Returns the MongoDB query for the hiddenConstraints of the current user, or None if there aren't
+        any. This is compiled once (and again only if the database schema changes).
+        
+        """
+        
+        policy=self.getUserPolicy()
+        if policy['hiddenConstraints'] == "":
+            return None
+        schema=self.getSchema()
+        if policy['schema'] is not schema:
+            policy['hiddenQuery']=self.extractConstraintsDict(policy['hiddenConstraints'])
+            policy['schema']=schema
+        
+        return copy.deepcopy(policy['hiddenQuery'])
+    
+    
+    def getUserHiddenXMatchTables(self):
+        """Returns the list of hiddenXMatchTables column prefixes for the current user.
+        
+        """
+        
+        return list(self.getUserPolicy()['hiddenPrefixes'])
+    
+    
+    def isHiddenColumn(self, key):
+        """Returns True if the given column is hidden from the current user (see hiddenXMatchTables).
+        
+        """
+        
+        hiddenPrefixes=self.getUserPolicy()['hiddenPrefixes']
+        
+        return len(hiddenPrefixes) > 0 and key.startswith(hiddenPrefixes)
+    
+    
+    def getConeSearchParams(self, queryRADeg, queryDecDeg, querySearchBoxArcmin):
+        """Returns RADeg, decDeg, radiusArcmin if the query parameters are for a cone search (i.e., a
+        position, rather than RA and dec. ranges), or None otherwise. Raises an exception if the values
+        given can't be understood.
+        
+        """
+        
+        if ":" in queryRADeg or ":" in queryDecDeg:
+            return None
+        try:
+            RADeg=float(queryRADeg)
+            decDeg=float(queryDecDeg)
+            radiusArcmin=float(querySearchBoxArcmin)
+        except:
+            raise Exception("for a cone search, RA, dec. and search radius should all be numbers")
+        if radiusArcmin <= 0:
+            raise Exception("search radius should be greater than zero")
+        
+        return RADeg, decDeg, radiusArcmin
+    
+    
+    def addDistanceColumn(self, posts, RADeg, decDeg):
+        """Adds distanceArcmin (distance from RADeg, decDeg) to each of the given posts (which must include
+        RADeg, decDeg).
+        
+        """
+        
+        for post in posts:
+            post['distanceArcmin']=astCoords.calcAngSepDeg(RADeg, decDeg, post['RADeg'], post['decDeg'])*60.0
+    
+    
+    def restoreSentinels(self, posts, projection = None):
+        """For databases built with sparseCrossMatchStorage, puts back the sentinel values that were left out
+        of the given posts (only for the fields in projection, if given). Does nothing otherwise.
+        
+        """
+        
+        sparseSentinels=self.getSchema()['sparseSentinels']
+        if len(sparseSentinels) == 0:
+            return None
+        if projection is not None:
+            keys=[key for key in projection.keys() if key in sparseSentinels.keys()]
+        else:
+            keys=list(sparseSentinels.keys())
+        for post in posts:
+            for key in keys:
+                if key not in post.keys():
+                    post[key]=sparseSentinels[key]
+    
+    
+    def makeQueryDict(self, queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints, 
+                      applyHiddenConstraints = True, applyPosition = True, checkCost = True):
+        """Builds the MongoDB query document for the given query parameters, including any hidden 
+        constraints set for the current user (unless applyHiddenConstraints is False, which is only 
+        for use when no user is involved, e.g., materializing quickLinks).
+        
+        Unless checkCost is False, queries that would scan too much of the catalog are refused (see 
+        checkQueryCost), which raises an exception.
+        
+        If queryRADeg and queryDecDeg give a position (rather than ranges), this is a cone search, with
+        querySearchBoxArcmin giving the search radius. This uses the 2dsphere index on skyLoc. 
+        If applyPosition is False, the position part of the query is left out (e.g., for $geoNear).
+        
+        """
+        
+        # Build query document piece by piece...
+        queryDict={}
+
+        # Position
+        coneSearch=self.getConeSearchParams(queryRADeg, queryDecDeg, querySearchBoxArcmin)
+        if applyPosition == False:
+            pass
+        elif coneSearch is not None:
+            RADeg, decDeg, radiusArcmin=coneSearch
+            queryDict['skyLoc']={'$geoWithin': {'$centerSphere': [catalogTools.RADecToGeoJSON(RADeg, decDeg)['coordinates'], 
+                                                                  np.radians(radiusArcmin/60.0)]}}
+        else:
+            RAMin, RAMax=queryRADeg.split(":")
+            decMin, decMax=queryDecDeg.split(":")
+            RAMin=float(RAMin)
+            RAMax=float(RAMax)
+            decMin=float(decMin)
+            decMax=float(decMax)
+            queryDict['decDeg']={'$lte': decMax, '$gte': decMin}
+            if RAMin >= 0:
+                queryDict['RADeg']={'$lte': RAMax, '$gte': RAMin}
+            else:
+                queryDict['$or']=[{'RADeg': {'$gte': 0, '$lte': RAMax}}, {'RADeg': {'$gte': 360+RAMin, '$lte': 360}}]
+
+        # Other constraints
+        queryList=[queryDict, self.extractConstraintsDict(queryOtherConstraints)]
+        
+        # Hidden constraints: for access control, e.g., show only DES users regions inside DES footprint
+        # These are compiled separately and and-ed on, so that 'or' in the user's constraints can't undo them
+        if applyHiddenConstraints == True:
+            hiddenQuery=self.getUserHiddenQuery()
+            if hiddenQuery is not None:
+                queryList.append(hiddenQuery)
+        
+        queryDict=queryTools.combineQueries(queryList)
+        sparseSentinels=self.getSchema()['sparseSentinels']
+        if len(sparseSentinels) > 0:
+            queryDict=queryTools.restoreSparseSentinels(queryDict, sparseSentinels)
+        # quickLinks are set by whoever runs the server, and are served from materialized results anyway
+        if checkCost == True and applyPosition == True and applyHiddenConstraints == True \
+            and self.findQuickLink(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints) is None:
+            self.checkQueryCost(queryDict, queryOtherConstraints)
+        
+        return queryDict
+        
+
     def makeSessionCollection(self, queryPosts):
         """Inserts all the posts from a query into a mongodb collection associated with this session. This
         is fairly slow for large databases (e.g., 10000+ objects). 
@@ -2250,81 +4426,272 @@ class SourceBrowser(object):
         self.db.collection[cherrypy.session.id].create_index([('lastModifiedDate', 1)], expireAfterSeconds = 7200)
 
         
+    def getGeneration(self, key = 'generation', maxAgeSeconds = None):
+        """Returns the current data generation number. This is bumped (see bumpGeneration) whenever the
+        database, tags, or image_* flags change, so that anything we cache can tell if it is stale. It is
+        kept in MongoDB, so that it is shared between processes (e.g., the web server and build scripts).
+        
+        A separate counter (key = 'schemaGeneration') is bumped only when the fieldTypes change.
+        
+        The number is cached, and only re-read if it is older than maxAgeSeconds (by default, 
+        self.generationCheckSeconds), so that cache hits (e.g., in countQuery) don't cost a trip to MongoDB. 
+        Bumps made by this process are seen at once, and those made by other processes within maxAgeSeconds.
+        Use maxAgeSeconds = 0 to always read the stored number.
+        
+        """
+        
+        if maxAgeSeconds is None:
+            maxAgeSeconds=self.generationCheckSeconds
+        now=time.time()
+        cached=self.generationCache.get(key)
+        if cached is not None and now-cached[0] < maxAgeSeconds:
+            return cached[1]
+        doc=self.metaCollection.find_one({'_id': key})
+        if doc is None:
+            value=0
+        else:
+            value=doc['value']
+        self.generationCache[key]=(now, value)
+        
+        return value
+    
+    
+    def bumpGeneration(self, key = 'generation'):
+        """Increments the data generation number - call this after anything that changes the database.
+        
+        """
+        
+        self.metaCollection.update_one({'_id': key}, {'$inc': {'value': 1}}, upsert = True)
+        self.generationCache.pop(key, None)
+    
+    
+    def findQuickLink(self, queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints):
+        """Returns the index in the quickLinks list of the config file that matches the given query, or 
+        None if the query is not one of the quickLinks.
+        
+        """
+        
+        if 'quickLinks' not in self.configDict.keys():
+            return None
+        if queryRADeg != "0:360" or queryDecDeg != "-90:90" or querySearchBoxArcmin != "":
+            return None
+        for i in range(len(self.configDict['quickLinks'])):
+            if queryOtherConstraints.strip() == self.configDict['quickLinks'][i]['constraints'].strip():
+                return i
+        
+        return None
+    
+    
+    def materializeQuickLink(self, linkIndex, generation = None, maxTimeMS = None):
+        """Runs the query for the quickLink with the given index (in the quickLinks list in the config file),
+        and stores the result (ordered list of sourceryIDs, and count) for the given data generation. The 
+        sourceryIDs are kept as a .npy file in the cache dir, and the rest in the quickLinksCollection.
+        Any stale results and download snapshots for this quickLink are removed. maxTimeMS limits the time
+        the query may take (the default is the limit for the current request, if any - see 
+        getQueryTimeLimitMS).
+        
+        Returns the quickLinksCollection document.
+        
+        """
+        
+        linkDict=self.configDict['quickLinks'][linkIndex]
+        if generation is None:
+            generation=self.getGeneration(maxAgeSeconds = 0)
+        if maxTimeMS is None:
+            maxTimeMS=self.getQueryTimeLimitMS()
+        queryDict=self.makeQueryDict("0:360", "-90:90", "", linkDict['constraints'], applyHiddenConstraints = False)
+        cursor=self.sourceCollection.find(queryDict, {'_id': 0, 'sourceryID': 1}).sort('RADeg').max_time_ms(maxTimeMS)
+        sourceryIDs=np.array([post['sourceryID'] for post in cursor], dtype = str)
+        fileLabel="quickLink_%d_%d" % (linkIndex, generation)
+        idsFileName=self.quickLinksDir+os.path.sep+fileLabel+".npy"
+        tmpFileName=self.quickLinksDir+os.path.sep+fileLabel+".%d.%d.tmp.npy" % (os.getpid(), threading.get_ident())
+        np.save(tmpFileName, sourceryIDs)
+        os.replace(tmpFileName, idsFileName)
+        doc={'_id': linkIndex, 'label': linkDict['label'], 'constraints': linkDict['constraints'], 
+             'generation': generation, 'count': len(sourceryIDs), 'idsFileName': idsFileName}
+        self.quickLinksCollection.replace_one({'_id': linkIndex}, doc, upsert = True)
+        for f in glob.glob(self.quickLinksDir+os.path.sep+"quickLink_%d_*" % (linkIndex)):
+            if os.path.split(f)[-1].split(".")[0] != fileLabel:
+                try:
+                    os.remove(f)
+                except:
+                    pass
+        
+        return doc
+    
+    
+    def refreshQuickLinks(self):
+        """Materializes the results of all the quickLinks queries in the config file (see 
+        materializeQuickLink).
+        
+        """
+        
+        if 'quickLinks' not in self.configDict.keys():
+            return None
+        print(">>> Materializing quickLinks ...")
+        generation=self.getGeneration(maxAgeSeconds = 0)
+        for i in range(len(self.configDict['quickLinks'])):
+            self.materializeQuickLink(i, generation = generation)
+            
+    
+    def refreshQuickLinkInBackground(self, linkIndex):
+        """Re-materializes the quickLink with the given index (see materializeQuickLink) in a background 
+        thread, unless this process is already doing so. The query gets the 'download' time limit.
+        
+        """
+        
+        with self.quickLinksRefreshLock:
+            if linkIndex in self.quickLinksRefreshing:
+                return None
+            self.quickLinksRefreshing.add(linkIndex)
+        
+        def refresh():
+            try:
+                self.materializeQuickLink(linkIndex, maxTimeMS = self.queryTimeLimitsMS['download'])
+            except Exception as e:
+                logger.warning("quickLinks: failed to refresh quickLink %d (%s)" % (linkIndex, str(e)))
+            finally:
+                with self.quickLinksRefreshLock:
+                    self.quickLinksRefreshing.discard(linkIndex)
+        
+        threading.Thread(target = refresh, daemon = True).start()
+        
+    
+    def getQuickLinkResult(self, queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints):
+        """If the query is one of the quickLinks in the config file, returns the materialized result - a
+        dictionary with keys count, generation, linkIndex, and sourceryIDs (an array, in table order).
+        If the result is stale (the data have changed since it was made), it is returned anyway, and 
+        re-materialized in the background (see refreshQuickLinkInBackground), so requests never wait for
+        the quickLink query to run.
+        
+        Returns None if the query isn't a quickLink, if the current user has hidden constraints (as 
+        materialized results are shared between all users), or if there is no result for the quickLink's
+        current constraints yet - callers then run the query as usual.
+        
+        """
+        
+        linkIndex=self.findQuickLink(queryRADeg, queryDecDeg, querySearchBoxArcmin, queryOtherConstraints)
+        if linkIndex is None or self.getUserHiddenConstraints() != "":
+            return None
+        doc=self.quickLinksCollection.find_one({'_id': linkIndex})
+        if doc is None or doc['constraints'] != self.configDict['quickLinks'][linkIndex]['constraints']:
+            self.refreshQuickLinkInBackground(linkIndex)
+            return None
+        if doc['generation'] != self.getGeneration():
+            self.refreshQuickLinkInBackground(linkIndex)
+        try:
+            doc['sourceryIDs']=np.load(doc['idsFileName'], mmap_mode = 'r')
+        except FileNotFoundError:
+            # Another process re-materialized this since we looked - the next request will pick that up
+            return None
+        doc['linkIndex']=linkIndex
+        
+        return doc
+    
+    
+    def getQuickLinkSnapshotPath(self, quickLinkResult, fileFormat):
+        """Returns the path to the download snapshot for the given quickLink result (from getQuickLinkResult)
+        in the given fileFormat.
+        
+        """
+        
+        return self.quickLinksDir+os.path.sep+"quickLink_%d_%d.%s" % (quickLinkResult['linkIndex'], quickLinkResult['generation'], 
+                                                                       fileFormat)
+    
+    
+    def streamAndSaveSnapshot(self, byteChunks, snapshotPath):
+        """Generator that passes on a stream of bytes (e.g., a catalog download) while also saving it to 
+        snapshotPath. The snapshot is only put in place if the whole stream was sent.
+        
+        """
+        
+        tmpPath=snapshotPath+".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+        completed=False
+        try:
+            with open(tmpPath, "wb") as outFile:
+                for data in byteChunks:
+                    outFile.write(data)
+                    yield data
+            completed=True
+            os.replace(tmpPath, snapshotPath)
+        finally:
+            if completed == False and os.path.exists(tmpPath) == True:
+                os.remove(tmpPath)
+    
+    
+    def streamFile(self, inFile, blockSize = 1048576):
+        """Generator that yields the contents of the given open file in blocks, closing it when done.
+        
+        """
+        
+        try:
+            while True:
+                data=inFile.read(blockSize)
+                if not data:
+                    break
+                yield data
+        finally:
+            inFile.close()
+    
+    
+    def fetchPostsByIDs(self, sourceryIDs, projection = None):
+        """Returns a list of posts from sourceCollection for the given sourceryIDs, in the same order.
+        
+        """
+        
+        sourceryIDs=[str(i) for i in sourceryIDs]
+        if projection is not None:
+            projection=dict(projection)
+            projection['sourceryID']=1
+        postsDict={}
+        for post in self.sourceCollection.find({'sourceryID': {'$in': sourceryIDs}}, projection):
+            postsDict[post['sourceryID']]=post
+        
+        return [postsDict[i] for i in sourceryIDs if i in postsDict.keys()]
+    
+    
     def extractConstraintsDict(self, constraints):
-        """Returns a dictionary of constraints extracted from string constraints, parsing all the operators
-        >, <, =, ! etc.
-        
-        """
-        
-        # Order matters... equals should be last
-        transDict={'<':  '$lt', 
-                   '>':  '$gt',
-                   '<=': '$lte',
-                   '>=': '$gte',
-                   '!=': '$ne',
-                   '=': ''}
-
-        # Newlines cause problems
-        constraints=constraints.replace("\n", " ")
-        
-        # 'and' has precedence - which in practice means split on 'or' first, and then or all those together
-        # Still need to handle () though, which means some recursion?
-        orConstraints=constraints.split(' or ')
-        allConstraintsDict={'$or': []}
-        for orc in orConstraints:
-            andConstraints=orc.split(" and ")
-            constraintsDict={}
-            for c in andConstraints:
-                for op in transDict.keys():
-                    bits=c.split(op)
-                    if len(bits) == 2:
-                        # Better way of checking for valid constraints than what we did before
-                        key=bits[0].lstrip().rstrip()
-                        value=bits[1].lstrip().rstrip()
-                        before=c[c.find(op)-1]
-                        after=c[c.find(op)+len(op)]
-                        if before not in ['<', '>', '=', '!'] and after not in ['<', '>', '=', '!']:
-                            validConstraint=True
-                        else:
-                            validConstraint=False
-                        if validConstraint == True:    
-                            # Strip " or ' from strings (saves confusion by user)
-                            value=value.replace("'", "")
-                            value=value.replace('"', '')
-                            if key not in constraintsDict.keys():
-                                constraintsDict[key]={}
-                            # Queries won't work if we use strings instead of numbers when needed...
-                            if op not in ['=', '!=']:
-                                try:
-                                    constraintsDict[key][transDict[op]]=float(value)
-                                except:
-                                    constraintsDict[key][transDict[op]]=value
-                            else:
-                                if op == '=':
-                                    opStr="$in"
-                                elif op == '!=':
-                                    opStr="$nin"
-                                if opStr not in constraintsDict[key].keys():
-                                    constraintsDict[key][opStr]=[]
-                                try:
-                                    constraintsDict[key][opStr].append(float(value))
-                                except:
-                                    if '*' in value:
-                                        regex='(?i)'    # make case insensitive
-                                        if value[0] != '*':
-                                            regexStr=regex+"^"+value
-                                        else:
-                                            regexStr=regex+value
-                                        regexStr=regexStr.replace("*", ".*")
-                                        constraintsDict[key][opStr].append(re.compile(regexStr))
-                                    else:
-                                        constraintsDict[key][opStr].append(value)
-            allConstraintsDict['$or'].append(constraintsDict)
-            #IPython.embed()
-            #sys.exit()
-        #print constraintsDict
-        
-        return allConstraintsDict
+        """Returns a MongoDB query for the constraints string, parsing all the operators >, <, =, ! etc., 
+        'and', 'or' and parentheses (see queryTools.compileConstraints). Raises an exception if the 
+        constraints are not valid, e.g., if they use a column that does not exist.
+        
+        """
+        
+        # Field types only change with the schema generation, so that (plus the database, as the compiled
+        # constraints cache is shared) identifies them without going through all of the columns
+        schema=self.getSchema()
+        return queryTools.compileConstraints(constraints, schema['constraintFieldTypes'], 
+                                             fieldTypesKey = (self.dbName, schema['generation']))
+    
+    
+    def getConstraintFieldTypes(self):
+        """Returns a dictionary mapping the names of all the fields that can be used in constraints to their
+        types ('number' or 'text').
+        
+        """
+        
+        return self.getSchema()['constraintFieldTypes']
+    
+    
+    @cherrypy.expose
+    def changeTableSort(self, sortKey):
+        """Sorts the table view on the given column (one of self.sortableColumns). If the table is already
+        sorted on that column, the sort direction is reversed. Goes back to the first page.
+        
+        """
+        
+        if not cherrypy.session.loaded: cherrypy.session.load()
+        if sortKey not in self.sortableColumns:
+            raise cherrypy.HTTPError(400, "Can't sort on column '%s'" % (sortKey))
+        if cherrypy.session.get('querySortKey', self.tableSortKey) == sortKey:
+            cherrypy.session['querySortDirection']=-cherrypy.session.get('querySortDirection', self.tableSortDirection)
+        else:
+            cherrypy.session['querySortKey']=sortKey
+            cherrypy.session['querySortDirection']=pymongo.ASCENDING
+        cherrypy.session['querySortByDistance']=False
+        cherrypy.session['pageToken']=None
+        
+        raise cherrypy.HTTPRedirect(cherrypy.request.script_name)
     
     
     @cherrypy.expose
@@ -2334,8 +4701,8 @@ class SourceBrowser(object):
         """
         if not cherrypy.session.loaded: cherrypy.session.load()
         # Sometimes after a while we lose our session: need to check this out...
-        if 'viewTopRow' not in cherrypy.session:
-            cherrypy.session['viewTopRow']=0
+        if 'pageToken' not in cherrypy.session:
+            cherrypy.session['pageToken']=None
         if 'queryRADeg' not in cherrypy.session:
             cherrypy.session['queryRADeg']="0:360"
         if 'queryDecDeg' not in cherrypy.session:
@@ -2344,19 +4711,12 @@ class SourceBrowser(object):
             cherrypy.session['querySearchBoxArcmin']=""
         if 'queryOtherConstraints' not in cherrypy.session:
             cherrypy.session['queryOtherConstraints']=""
-            
-        if nextButton:
-            viewTopRow=cherrypy.session.get('viewTopRow')
-            viewTopRow=viewTopRow+self.tableViewRows
-            if viewTopRow >= cherrypy.session.get('numPosts'):
-                viewTopRow=cherrypy.session.get('numPosts')-self.tableViewRows
-            cherrypy.session['viewTopRow']=viewTopRow
-        if prevButton:
-            viewTopRow=cherrypy.session.get('viewTopRow')
-            viewTopRow=viewTopRow-self.tableViewRows
-            if viewTopRow < 0:
-                viewTopRow=0
-            cherrypy.session['viewTopRow']=viewTopRow
+        
+        # Page tokens are set by index when it shows a page (None = no next/prev page)
+        if nextButton and cherrypy.session.get('nextPageToken') is not None:
+            cherrypy.session['pageToken']=cherrypy.session.get('nextPageToken')
+        if prevButton and cherrypy.session.get('prevPageToken') is not None:
+            cherrypy.session['pageToken']=cherrypy.session.get('prevPageToken')
             
         raise cherrypy.HTTPRedirect(cherrypy.request.script_name)
     
@@ -2392,6 +4752,9 @@ class SourceBrowser(object):
         separated by 'and' or 'or', e.g.,</p>
         <p><tt>redshift >= 0 and redshift < 0.4</tt></p>
         <p><tt>RM_match = 1 or PSZ2_match = 1</tt></p>
+        <p>'and' takes precedence over 'or'. Parentheses can be used to group constraints, e.g.,</p>
+        <p><tt>redshift > 1 and (RM_match = 1 or PSZ2_match = 1)</tt></p>
+        <p>Queries that use columns that are not in the list below, or that give text values for number columns, are not applied - an error message is shown instead.</p>
         <p><b>Note that when querying for multiple values in the same column using '=' or '!=', 'and' acts like a delimiter, rather than in a strictly logical sense</b>. For example, to fetch all objects with classification of 'cluster' and 'not cluster', one can write</p>
         <tt>classification = 'cluster' and classification = 'not cluster'</tt> 
         <p>This will leave out all table rows which have classification set to some other value (e.g., 'probable cluster'
@@ -2401,15 +4764,18 @@ class SourceBrowser(object):
         <tt>classification = '* cluster'</tt> 
         <p>will return all objects flagged as 'probable cluster', 'possible cluster', or 'not cluster', but not objects with classification = 'cluster'.</p>
         <tt>notes = '*high-z*'</tt> 
-        <p>will return all objects where the string 'high-z' appears in the notes field somewhere. <b>Note that wildcard text searches are case insensitive</b>.
+        <p>will return all objects where the string 'high-z' appears in the notes field somewhere. <b>Note that wildcard text searches are case insensitive, except when the only wildcard is at the end</b>. For example,</p>
+        <tt>name = 'ACT-CL J01*'</tt>
+        <p>will return all objects with names starting with 'ACT-CL J01' (but not 'act-cl j01'). Searches of this kind are fast, because they can use the database indexes.
         </p>
         <br>
-        <table frame=border cellspacing=0 cols=3 rules=all border=2 width=85% align=center>
+        <table frame=border cellspacing=0 cols=4 rules=all border=2 width=85% align=center>
         <tbody>
             <tr style="background-color: rgb(0, 0, 0); font-family: sans-serif; color: rgb(255, 255, 255); 
                     text-align: center; vertical-align: middle; font-size: 110%;">
             <td><b>Column</td>
             <td><b>Type</b></td>
+            <td><b>Range</b></td>
             <td><b>Description</b></td>
             </tr>
             $TABLE_DATA
@@ -2432,12 +4798,24 @@ class SourceBrowser(object):
         tableData=""
         excludeKeys=['RADeg', 'decDeg', 'sourceryID', 'cacheBuilt'] # because we handle differently
         keysList, typeNamesList, descriptionsList=self.getFieldNamesAndTypes(excludeKeys = excludeKeys)
+        columnStats=self.getSchema()['columnStats']
         for key, typeName, description in zip(keysList, typeNamesList, descriptionsList):
+            # Range of values (from column statistics made when the database was built)
+            rangeStr="-"
+            if key in columnStats.keys():
+                stats=columnStats[key]
+                if 'min' in stats.keys():
+                    rangeStr="%g &ndash; %g" % (stats['min'], stats['max'])
+                elif 'numDistinct' in stats.keys():
+                    rangeStr="%d distinct values" % (stats['numDistinct'])
+                if stats['count'] > 0 and stats.get('numSentinel', 0) > 0:
+                    rangeStr=rangeStr+" (%.0f%% blank/-99)" % (100.0*stats['numSentinel']/stats['count'])
             # Row for each column in table
             rowString="<tr>\n"                
             rowString=rowString+"   <td style='background-color: "+bckColor+";' align=left width=10%><b>"+key+"</b></td>\n"
             rowString=rowString+"   <td style='background-color: "+bckColor+";' align=left width=10%>"+typeName+"</td>\n"
-            rowString=rowString+"   <td style='background-color: "+bckColor+";' align=left width=80%>"+description+"</td>\n"
+            rowString=rowString+"   <td style='background-color: "+bckColor+";' align=left width=15%>"+rangeStr+"</td>\n"
+            rowString=rowString+"   <td style='background-color: "+bckColor+";' align=left width=65%>"+description+"</td>\n"
             rowString=rowString+"</tr>\n"                           
             tableData=tableData+rowString
         html=html.replace("$TABLE_DATA", tableData)
@@ -2445,19 +4823,33 @@ class SourceBrowser(object):
         return html   
 
 
-    def getFieldNamesAndTypes(self, excludeKeys = []):
-        """Fetches lists of field names, types and descriptions, for when displaying constraints help and 
-        saving tables.
+    def loadSchema(self):
+        """Reads the schema of the database from the fieldTypes collection (and the config and column 
+        descriptions files). Returns a dictionary with keys:
+        
+            - fieldDicts: the fieldTypes entries (name, type, description, index, and anything else stored 
+              there), in display order
+            - keysList, typeNamesList, descList: names, types and descriptions of all fields (including 
+              classification and editable fields), in display order
+            - constraintFieldTypes: dictionary mapping the names of fields that can be used in constraints
+              to their types
+            - columnStats: dictionary of column statistics made when the database was built (see 
+              catalogTools.computeColumnStats), indexed by field name
+            - sparseSentinels: dictionary mapping the names of fields stored sparsely (see 
+              sparseCrossMatchStorage) to their sentinel values (empty if the database isn't sparse)
         
         """
+        
+        fieldDicts=[]
+        for post in self.fieldTypesCollection.find({}, {'_id': 0}).sort('index'):
+            fieldDicts.append(post)
         keysList=[]
         typeNamesList=[]
         descList=[]
-        for post in self.fieldTypesCollection.find().sort('index'):
-            if post['name'] not in excludeKeys:
-                keysList.append(post['name'])
-                typeNamesList.append(post['type'])
-                descList.append(post['description'])
+        for post in fieldDicts:
+            keysList.append(post['name'])
+            typeNamesList.append(post['type'])
+            descList.append(post['description'])
         # Add MongoDB object properties        
         if 'classifications' in self.configDict.keys():
             keysList.append('classification')
@@ -2474,6 +4866,75 @@ class SourceBrowser(object):
             if k in keysList:
                 index=keysList.index(k)
                 descList[index]=self.descriptionsDict[k]
+        
+        constraintFieldTypes={'name': 'text', 'RADeg': 'number', 'decDeg': 'number', 'sourceryID': 'text', 
+                              'cacheBuilt': 'number'}
+        for key, typeName in zip(keysList, typeNamesList):
+            constraintFieldTypes[key]=typeName
+        
+        columnStats={}
+        for post in fieldDicts:
+            if 'stats' in post.keys():
+                columnStats[post['name']]=post['stats']
+        
+        sparseSentinels={}
+        storageDoc=self.metaCollection.find_one({'_id': 'storage'})
+        if storageDoc is not None:
+            for key in storageDoc['sparseKeys']:
+                if key in constraintFieldTypes.keys() and constraintFieldTypes[key] == 'text':
+                    sparseSentinels[key]=""
+                else:
+                    sparseSentinels[key]=-99
+        
+        skyMapDoc=self.metaCollection.find_one({'_id': 'skyMap'})
+        if skyMapDoc is not None:
+            skyMapNside=skyMapDoc['nside']
+        else:
+            skyMapNside=None
+        
+        return {'fieldDicts': fieldDicts, 'keysList': keysList, 'typeNamesList': typeNamesList, 
+                'descList': descList, 'constraintFieldTypes': constraintFieldTypes, 'columnStats': columnStats,
+                'sparseSentinels': sparseSentinels, 'skyMapNside': skyMapNside}
+    
+    
+    def getSchema(self):
+        """Returns the schema (see loadSchema), which is kept in memory. It is reloaded when the schema 
+        generation changes (i.e., after the database is rebuilt, or image_* fields are added), which is 
+        checked at most every self.schemaCheckSeconds. So, request handlers don't need to go to MongoDB 
+        for field names and types. The schema generation it was loaded for is kept in the schema (as 
+        generation), for use in cache keys.
+        
+        """
+        
+        with self.schemaLock:
+            now=time.time()
+            if self.schema is not None and now-self.schema['checkedTime'] < self.schemaCheckSeconds:
+                return self.schema['schema']
+            generation=self.getGeneration(key = 'schemaGeneration', maxAgeSeconds = 0)
+            if self.schema is None or self.schema['generation'] != generation:
+                schema=self.loadSchema()
+                schema['generation']=generation
+                self.schema={'generation': generation, 'schema': schema}
+            self.schema['checkedTime']=now
+        
+        return self.schema['schema']
+    
+    
+    def getFieldNamesAndTypes(self, excludeKeys = []):
+        """Fetches lists of field names, types and descriptions, for when displaying constraints help and 
+        saving tables.
+        
+        """
+        
+        schema=self.getSchema()
+        keysList=[]
+        typeNamesList=[]
+        descList=[]
+        for key, typeName, desc in zip(schema['keysList'], schema['typeNamesList'], schema['descList']):
+            if key not in excludeKeys:
+                keysList.append(key)
+                typeNamesList.append(typeName)
+                descList.append(desc)
 
         return keysList, typeNamesList, descList
                 
@@ -2519,6 +4980,7 @@ class SourceBrowser(object):
         objs=self.sourceCollection.find({'name': name})
         for obj in objs:
             self.sourceCollection.update_one({'_id': obj['_id']}, {'$set': post}, upsert = False)
+        self.bumpGeneration()
         
         # Would reset zoom level if changed
         if 'defaultImageType' in self.configDict.keys():
@@ -2567,6 +5029,7 @@ class SourceBrowser(object):
         
         # Update source collection too
         self.sourceCollection.update_one({'_id': obj['_id']}, {'$set': post}, upsert = False)
+        self.bumpGeneration()
         
     
     @cherrypy.expose
@@ -2583,8 +5046,8 @@ class SourceBrowser(object):
         
         """
         if not cherrypy.session.loaded: cherrypy.session.load()
-        if 'viewTopRow' not in cherrypy.session:
-            cherrypy.session['viewTopRow']=0
+        if 'pageToken' not in cherrypy.session:
+            cherrypy.session['pageToken']=None
         if 'queryRADeg' not in cherrypy.session:
             cherrypy.session['queryRADeg']="0:360"
         if 'queryDecDeg' not in cherrypy.session:
@@ -2598,8 +5061,6 @@ class SourceBrowser(object):
         querySearchBoxArcmin=cherrypy.session.get('querySearchBoxArcmin')
         queryOtherConstraints=cherrypy.session.get('queryOtherConstraints')
         
-        user=cherrypy.session['_sourcery_username']
-
         sourceryID=self.URLToSourceName(sourceryID)
                 
         templatePage="""<html>
@@ -2675,6 +5136,7 @@ class SourceBrowser(object):
         #<tr><td align=center><b>$SIZE_ARC_MIN' x $SIZE_ARC_MIN'</b></td></tr>
 
         obj=self.sourceCollection.find_one({'sourceryID': sourceryID})
+        self.restoreSentinels([obj])
         mongoDict=self.matchTags(obj)
         name=obj['name']
         
@@ -2687,13 +5149,10 @@ class SourceBrowser(object):
                 skipColumnPrefixList.append(prefix)
         
         # For censoring some cross match tables from particular users
-        for userNameKey in self.usersDict.keys():
-            userDict=self.usersDict[userNameKey]
-            if userNameKey == user and 'hiddenXMatchTables' in userDict.keys():
-                for prefix in userDict['hiddenXMatchTables']:
-                    matchKey="%s_match" % (prefix)
-                    if matchKey in obj.keys() and obj[matchKey] == 1 and prefix not in skipColumnPrefixList:
-                        skipColumnPrefixList.append(prefix)
+        for prefix in self.getUserPolicy()['hiddenPrefixes']:
+            matchKey="%s_match" % (prefix)
+            if matchKey in obj.keys() and obj[matchKey] == 1 and prefix not in skipColumnPrefixList:
+                skipColumnPrefixList.append(prefix)
                 
         # Pick the best available image given the preference given in the config file
         if imageType == 'best':
@@ -3231,8 +5690,7 @@ class SourceBrowser(object):
             </th>
         </tr>
         """
-        fieldTypes=self.fieldTypesCollection.find().sort('index')
-        for f in fieldTypes:
+        for f in self.getSchema()['fieldDicts']:
             if f['name'] in obj.keys() and f['name'] not in ['sourceryID', 'cacheBuilt']:
                 pkey=f['name']
                 rowString="""<tr><td align=left width=50%><b>$KEY_LABEL</b></td>
@@ -3273,9 +5731,10 @@ class SourceBrowser(object):
                 fieldDict['description']='1 if object has image in the database; 0 otherwise'
                 fieldDict['index']=len(keysList)+1
                 self.fieldTypesCollection.insert_one(fieldDict)
+                self.bumpGeneration(key = 'schemaGeneration')
+                self.schema=None
         t0=time.time()
-        # We need to do this to avoid hitting 32 Mb limit below when using large databases
-        self.sourceCollection.create_index([("RADeg", pymongo.ASCENDING)])
+        # NOTE: the RADeg index (see ensureIndexes) avoids hitting the 32 Mb sort limit here for large databases
         posts=self.sourceCollection.find({}).sort('decDeg').sort('RADeg')
         for obj in posts:
             name=obj['name']
@@ -3296,6 +5755,7 @@ class SourceBrowser(object):
                     if skipImage == False:
                         post={'image_%s' % (label): 1}
                         self.sourceCollection.update_one({'_id': obj['_id']}, {'$set': post}, upsert = False)
+        self.bumpGeneration()
         t1=time.time()
         print("... took %.3f sec ..." % (t1-t0))
         
@@ -3331,9 +5791,6 @@ class SourceBrowser(object):
                                                                         sizePix = tileDirDict['sizePix'])
                 self.tileDirs[tileDirDict['label']].setUpWCSDict()
                                               
-        # We need to do this to avoid hitting 32 Mb limit below when using large databases
-        self.sourceCollection.create_index([("RADeg", pymongo.ASCENDING)])
-        
         # Threaded
         # NOTE: Threads have occassionally given weird issues (e.g., mismatched WISE images)
         # Check that when thread write to disk they don't clash with each other
@@ -3346,7 +5803,7 @@ class SourceBrowser(object):
             import multiprocessing
             from concurrent.futures import ThreadPoolExecutor
             with ThreadPoolExecutor(max_workers = multiprocessing.cpu_count()) as executor:
-                executor.map(self.buildCacheForObject, sourceryIDs)
+                executor.map(functools.partial(self.buildCacheForObject, updateGeneration = False), sourceryIDs)
         else:
             # Serial - still useful if debugging
             cursor=self.sourceCollection.find({'cacheBuilt': 0}, no_cursor_timeout = True, session = self.mongoSess).sort('decDeg').sort('RADeg')
@@ -3356,10 +5813,13 @@ class SourceBrowser(object):
                 if time.time()-lastRefreshTime > 600:
                     self.db.command({"refreshSessions" : [self.mongoSess.session_id]})
                     lastRefreshTime=time.time()
-                self.buildCacheForObject(obj['sourceryID'], refetch = False)
+                self.buildCacheForObject(obj['sourceryID'], refetch = False, updateGeneration = False)
             cursor.close()
                 
         self.addImageDirTags()
+        
+        # Once for the whole run, rather than per object (see buildCacheForObject)
+        self.bumpGeneration()
             
         # This will stop index displaying "cache rebuilding" message
         if os.path.exists(self.cacheLockFileName) == True:
@@ -3367,12 +5827,15 @@ class SourceBrowser(object):
 
     
     @cherrypy.expose
-    def buildCacheForObject(self, sourceryID, refetch = False, from_page = None):
+    def buildCacheForObject(self, sourceryID, refetch = False, from_page = None, updateGeneration = True):
         """Given a sourceryID (unique ID number), (re)fetch all the available imaging.
         As well as allowing threading, this also enables 'spot fixes' by clicking a button on the candidate 
         page (so if user spots image coords off, they can fix rather than manually deleting / re-running
         build cache). 
         
+        The data generation is bumped (see bumpGeneration) only if the object's image_* or cacheBuilt 
+        fields change, and not at all if updateGeneration is False (preprocess bumps it once at the end).
+        
         NOTE: We may remove the Rebuild Cache button if the change to coord-based file names is accurate
         enough.
         
@@ -3418,6 +5881,7 @@ class SourceBrowser(object):
         # Add imageDir tags
         # NOTE: we look in other survey dirs (e.g., SDSS) while we're here
         minSizeBytes=40000
+        post={}
         for label in self.imDirLabelsList:
             f=self.configDict['cacheDir']+os.path.sep+label+os.path.sep+fileNameLabel+".jpg"
             if os.path.exists(f) == True:
@@ -3425,12 +5889,16 @@ class SourceBrowser(object):
                 skipImage=False
                 if os.stat(f).st_size < minSizeBytes and label == 'SDSS':
                     skipImage=True
-                if skipImage == False:
-                    post={'image_%s' % (label): 1}
-                    self.sourceCollection.update_one({'_id': obj['_id']}, {'$set': post}, upsert = False)
+                if skipImage == False and obj.get('image_%s' % (label)) != 1:
+                    post['image_%s' % (label)]=1
         
         # Flag this as done
-        self.sourceCollection.update_one({'_id': obj['_id']}, {'$set': {'cacheBuilt': 1}}, upsert = False)
+        if obj.get('cacheBuilt') != 1:
+            post['cacheBuilt']=1
+        if len(post) > 0:
+            self.sourceCollection.update_one({'_id': obj['_id']}, {'$set': post}, upsert = False)
+            if updateGeneration == True:
+                self.bumpGeneration()
         
         # If using for spot fixes in web interface, need to refresh page when done
         if from_page != None:
@@ -3525,7 +5993,6 @@ class SourceBrowser(object):
             else:
                 self.mapPageEnabled=False
             
-            self.sourceCollection.create_index([("RADeg", pymongo.ASCENDING)])  # Avoid 32 Mb limit
             objList=self.sourceCollection.find(no_cursor_timeout = True, session = self.mongoSess).sort('decDeg').sort('RADeg')
             lastRefreshTime=time.time()
 